@@ -0,0 +1,121 @@
+"""Compare upstream call latency with a per-call session versus the shared
+application session, against a local stub of Dailymotion API
+
+Usage: python benchmarks/http_session.py [--requests N] [--concurrency C]
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from collections.abc import Awaitable, Callable
+from pathlib import Path
+
+import aiohttp
+
+from aiohttp import web
+
+from dm_stream_urls_server.session import create_http_session
+
+REPORTS_DIR = Path(__file__).parent.parent.joinpath("reports")
+
+
+async def stub_video(_: web.Request) -> web.Response:
+    return web.json_response({"stream_h264_url": "https://example.com/x"})
+
+
+async def start_stub_server() -> tuple[web.AppRunner, str]:
+    stub = web.Application()
+    stub.router.add_get("/rest/video/{video_id}", stub_video)
+
+    runner = web.AppRunner(stub, access_log=None)
+    await runner.setup()
+
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+
+    host, port = runner.addresses[0][:2]
+
+    return runner, f"http://{host}:{port}/rest/video/xVideoId"
+
+
+async def call_with_new_session(url: str) -> None:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url, raise_for_status=True) as response:
+            await response.read()
+
+
+def call_with_shared_session(
+    session: aiohttp.ClientSession,
+) -> Callable[[str], Awaitable[None]]:
+    async def call(url: str) -> None:
+        async with session.get(url, raise_for_status=True) as response:
+            await response.read()
+
+    return call
+
+
+async def measure(
+    call: Callable[[str], Awaitable[None]],
+    url: str,
+    requests: int,
+    concurrency: int,
+) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+
+    async def timed_call() -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            await call(url)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(timed_call() for _ in range(requests)))
+    elapsed = time.perf_counter() - start
+
+    quantiles = statistics.quantiles(latencies, n=100)
+
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "throughput_rps": round(requests / elapsed, 1),
+        "p50_ms": round(quantiles[49] * 1000, 3),
+        "p95_ms": round(quantiles[94] * 1000, 3),
+        "p99_ms": round(quantiles[98] * 1000, 3),
+    }
+
+
+async def main(requests: int, concurrency: int) -> dict:
+    runner, url = await start_stub_server()
+
+    try:
+        new_session = await measure(
+            call_with_new_session, url, requests, concurrency
+        )
+
+        async with create_http_session() as session:
+            shared_session = await measure(
+                call_with_shared_session(session), url, requests, concurrency
+            )
+    finally:
+        await runner.cleanup()
+
+    return {"new_session": new_session, "shared_session": shared_session}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+
+    report = asyncio.run(main(args.requests, args.concurrency))
+
+    REPORTS_DIR.joinpath("benchmark_http_session.json").write_text(
+        json.dumps(report, indent=2), encoding="utf8"
+    )
+
+    print(json.dumps(report, indent=2))
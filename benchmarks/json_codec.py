@@ -0,0 +1,107 @@
+"""Compare the CPU time spent per request to decode the Dailymotion API
+response and encode the API response, for the generic FastAPI path, the
+orjson-backed response class, and the pass-through mode
+
+Usage: python benchmarks/json_codec.py [--requests N] [--formats F]
+"""
+
+import argparse
+import json
+import time
+
+from collections.abc import Callable
+from pathlib import Path
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+
+from dm_stream_urls_server import json_codec
+from dm_stream_urls_server.json_codec import (
+    JSON_CONTENT_TYPE,
+    FastJSONResponse,
+    json_loads,
+)
+
+REPORTS_DIR = Path(__file__).parent.parent.joinpath("reports")
+
+
+def create_upstream_body(formats: int) -> bytes:
+    """Return a Dailymotion API response with signed stream URLs"""
+
+    return json.dumps(
+        {
+            f"stream_h264_{i}_url": (
+                f"https://www.dailymotion.com/cdn/manifest/video/x8abcd{i}"
+                ".m3u8?sec=Xs9nQn2rW1iOT6h1Z7-1dNq3uFfIYJ6eA0ycS1wVa7u2ZpLG"
+                "eK8o3tbm9rNhXqjF4dTsWv0yCk5lRzPaM2gHxI&dmTs=123456&dmV1st="
+                "a1b2c3d4-e5f6-7890-abcd-ef1234567890&client_ip=198.51.100.7"
+            )
+            for i in range(formats)
+        }
+    ).encode("utf8")
+
+
+def generic(body: bytes) -> bytes:
+    """`response.json()` then FastAPI encoding of the returned dict"""
+
+    return JSONResponse(jsonable_encoder(json.loads(body.decode()))).body
+
+
+def fast_json(body: bytes) -> bytes:
+    """Decoding and rendering with `json_codec`, skipping jsonable_encoder"""
+
+    return FastJSONResponse(json_loads(body)).body
+
+
+def pass_through(body: bytes) -> bytes:
+    """Forwarding the upstream body as is"""
+
+    return Response(content=body, media_type=JSON_CONTENT_TYPE).body
+
+
+def measure(
+    path: Callable[[bytes], bytes], body: bytes, requests: int
+) -> dict:
+    start = time.process_time()
+
+    for _ in range(requests):
+        path(body)
+
+    elapsed = time.process_time() - start
+
+    return {"cpu_us_per_request": round(elapsed / requests * 1e6, 2)}
+
+
+def main(requests: int, formats: int) -> dict:
+    body = create_upstream_body(formats)
+    report = {
+        "requests": requests,
+        "body_bytes": len(body),
+        "orjson": json_codec.orjson is not None,
+        "generic": measure(generic, body, requests),
+        "fast_json": measure(fast_json, body, requests),
+        "pass_through": measure(pass_through, body, requests),
+    }
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=100000)
+    parser.add_argument(
+        "--formats",
+        type=int,
+        default=6,
+        help="number of stream URLs in the upstream response",
+    )
+    args = parser.parse_args()
+
+    report = main(args.requests, args.formats)
+
+    REPORTS_DIR.mkdir(exist_ok=True)
+    REPORTS_DIR.joinpath("benchmark_json_codec.json").write_text(
+        json.dumps(report, indent=2), encoding="utf8"
+    )
+
+    print(json.dumps(report, indent=2))
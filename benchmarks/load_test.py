@@ -0,0 +1,446 @@
+"""Load test the API against a local stand-in of Dailymotion API
+
+The fake Dailymotion API serves OAuth tokens and video stream URLs with a
+configurable latency, share of slow responses, error rate and token lifetime.
+Redis is either the one given with `--redis-url` or a local fakeredis server.
+The API runs in its own uvicorn process and is driven at a fixed concurrency,
+then throughput and latency percentiles are written to
+`reports/benchmark_load_test.json`.
+
+Usage: python benchmarks/load_test.py [--requests N] [--concurrency C]
+    [--workers W] [--videos V] [--upstream-latency MS] [--upstream-jitter MS]
+    [--upstream-error-rate R] [--upstream-slow-rate R]
+    [--upstream-slow-latency MS] [--token-expires-in S] [--redis-url URL]
+    [--env NAME=VALUE ...]
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import multiprocessing
+import os
+import random
+import socket
+import statistics
+import subprocess  # nosec
+import sys
+import tempfile
+import time
+import uuid
+
+from pathlib import Path
+
+import aiohttp
+
+from aiohttp import web
+
+ROOT_DIR = Path(__file__).parent.parent
+REPORTS_DIR = ROOT_DIR.joinpath("reports")
+
+HOST = "127.0.0.1"
+CLIENT_IP = "198.51.100.7"
+VIDEO_FORMATS = "stream_h264_url,stream_h264_hd_url"
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+
+        return int(sock.getsockname()[1])
+
+
+def create_fake_dailymotion_api(
+    latency: float,
+    jitter: float,
+    error_rate: float,
+    token_expires_in: int,
+    slow_rate: float = 0,
+    slow_latency: float = 0,
+) -> web.Application:
+    """Return a stand-in of Dailymotion API
+
+    Video calls with an unknown or expired access token are rejected with a
+    401, as the actual API does.
+    """
+
+    tokens: dict[str, float] = {}
+    stats: collections.Counter[str] = collections.Counter()
+
+    async def issue_token(_: web.Request) -> web.Response:
+        stats["oauth_token"] += 1
+        access_token = uuid.uuid4().hex
+        tokens[access_token] = time.monotonic() + token_expires_in
+
+        return web.json_response(
+            {"access_token": access_token, "expires_in": token_expires_in}
+        )
+
+    async def get_video(request: web.Request) -> web.Response:
+        stats["video"] += 1
+
+        if random.random() < slow_rate:  # nosec
+            stats["video_slow"] += 1
+            await asyncio.sleep(slow_latency)
+        else:
+            await asyncio.sleep(
+                max(0.0, latency + random.uniform(-jitter, jitter))  # nosec
+            )
+
+        access_token = request.headers.get("Authorization", "")[7:]
+
+        if tokens.get(access_token, 0) < time.monotonic():
+            stats["video_401"] += 1
+
+            raise web.HTTPUnauthorized()
+
+        if random.random() < error_rate:  # nosec
+            stats["video_500"] += 1
+
+            raise web.HTTPInternalServerError()
+
+        video_id = request.match_info["video_id"]
+
+        return web.json_response(
+            {
+                field: f"https://example.com/{video_id}/{field}.m3u8"
+                for field in request.query.get("fields", "").split(",")
+            }
+        )
+
+    async def get_public_ip(_: web.Request) -> web.Response:
+        return web.json_response({"ip_addr": CLIENT_IP})
+
+    async def get_stats(_: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    fake_api = web.Application()
+    fake_api.router.add_post("/oauth/v1/token", issue_token)
+    fake_api.router.add_get("/rest/video/{video_id}", get_video)
+    fake_api.router.add_get("/all.json", get_public_ip)
+    fake_api.router.add_get("/_stats", get_stats)
+
+    return fake_api
+
+
+def serve_fake_dailymotion_api(port: int, options: dict) -> None:
+    web.run_app(
+        create_fake_dailymotion_api(**options),
+        host=HOST,
+        port=port,
+        access_log=None,
+        print=None,
+    )
+
+
+def serve_fake_redis(port: int) -> None:
+    try:
+        from fakeredis import (  # pylint: disable=import-outside-toplevel
+            TcpFakeServer,
+        )
+    except ImportError:
+        sys.exit("fakeredis[lua] is required unless --redis-url is given")
+
+    TcpFakeServer((HOST, port)).serve_forever()
+
+
+def get_cpu_seconds(pid: int) -> float | None:
+    """Return the CPU time used by a process so far, on Linux only"""
+
+    try:
+        stat = Path(f"/proc/{pid}/stat").read_text(encoding="utf8")
+    except OSError:
+        return None
+
+    utime, stime = stat.rsplit(")", 1)[1].split()[11:13]
+
+    return (int(utime) + int(stime)) / os.sysconf("SC_CLK_TCK")
+
+
+async def wait_until_ready(url: str, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url) as response:
+                    if response.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{url} is not ready")
+
+            await asyncio.sleep(0.1)
+
+
+async def fetch_json(url: str) -> dict:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as response:
+            response_json: dict = await response.json()
+
+            return response_json
+
+
+async def drive(
+    api_url: str,
+    requests: int,
+    concurrency: int,
+    videos: int,
+) -> dict:
+    """Send `requests` lookups through `concurrency` clients and measure
+    them"""
+
+    latencies: list[float] = []
+    status_codes: collections.Counter[str] = collections.Counter()
+    counter = iter(range(requests))
+
+    async def client(session: aiohttp.ClientSession) -> None:
+        for i in counter:
+            start = time.perf_counter()
+
+            try:
+                async with session.get(
+                    f"{api_url}/stream-urls",
+                    params={
+                        "video_id": f"x{i % videos}",
+                        "video_formats": VIDEO_FORMATS,
+                        "client_ip": CLIENT_IP,
+                    },
+                ) as response:
+                    await response.read()
+                    status_codes[str(response.status)] += 1
+            except aiohttp.ClientError as e:
+                status_codes[type(e).__name__] += 1
+
+            latencies.append(time.perf_counter() - start)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    quantiles = statistics.quantiles(latencies, n=100)
+
+    return {
+        "throughput_rps": round(requests / elapsed, 1),
+        "p50_ms": round(quantiles[49] * 1000, 3),
+        "p95_ms": round(quantiles[94] * 1000, 3),
+        "p99_ms": round(quantiles[98] * 1000, 3),
+        "max_ms": round(max(latencies) * 1000, 3),
+        "status_codes": dict(status_codes),
+    }
+
+
+def start_api(
+    port: int,
+    workers: int,
+    env: dict[str, str],
+) -> subprocess.Popen:
+    return subprocess.Popen(  # nosec
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "dm_stream_urls_server.api:app",
+            f"--host={HOST}",
+            f"--port={port}",
+            f"--workers={workers}",
+            "--log-level=warning",
+            "--no-access-log",
+        ],
+        env={
+            **os.environ,
+            "PYTHONPATH": str(ROOT_DIR.joinpath("src")),
+            **env,
+        },
+    )
+
+
+def main(args: argparse.Namespace) -> dict:
+    fake_api_port = get_free_port()
+    fake_api_url = f"http://{HOST}:{fake_api_port}"
+    fake_api = multiprocessing.Process(
+        target=serve_fake_dailymotion_api,
+        args=(
+            fake_api_port,
+            {
+                "latency": args.upstream_latency / 1000,
+                "jitter": args.upstream_jitter / 1000,
+                "error_rate": args.upstream_error_rate,
+                "token_expires_in": args.token_expires_in,
+                "slow_rate": args.upstream_slow_rate,
+                "slow_latency": args.upstream_slow_latency / 1000,
+            },
+        ),
+        daemon=True,
+    )
+    processes = [fake_api]
+
+    if args.redis_url:
+        cache_host = args.redis_url.removeprefix("redis://").rstrip("/")
+    else:
+        fake_redis_port = get_free_port()
+        cache_host = f"{HOST}:{fake_redis_port}"
+        processes.append(
+            multiprocessing.Process(
+                target=serve_fake_redis,
+                args=(fake_redis_port,),
+                daemon=True,
+            )
+        )
+
+    for process in processes:
+        process.start()
+
+    api_port = get_free_port()
+    api_url = f"http://{HOST}:{api_port}"
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as credentials:
+        json.dump(
+            {
+                "DAILYMOTION_API_KEY_ID": "benchmark",
+                "DAILYMOTION_API_KEY_SECRET": "benchmark",
+            },
+            credentials,
+        )
+        credentials.flush()
+
+        api = start_api(
+            api_port,
+            args.workers,
+            {
+                "DAILYMOTION_API_BASE_URL": fake_api_url,
+                "DAILYMOTION_API_CREDENTIALS_FILE": credentials.name,
+                "CACHE_HOST": cache_host,
+                "PUBLIC_IP_URL": f"{fake_api_url}/all.json",
+                # Stands in for the `refresh-access-token-cache` daemon
+                "ACCESS_TOKEN_REFRESHER_ENABLED": "1",
+                **dict(env.split("=", 1) for env in args.env),
+            },
+        )
+
+        try:
+            asyncio.run(wait_until_ready(f"{fake_api_url}/_stats"))
+            asyncio.run(wait_until_ready(f"{api_url}/metrics"))
+
+            if args.warmup:
+                asyncio.run(
+                    drive(api_url, args.warmup, args.concurrency, args.videos)
+                )
+
+            cpu_start = get_cpu_seconds(api.pid)
+            results = asyncio.run(
+                drive(api_url, args.requests, args.concurrency, args.videos)
+            )
+            cpu_end = get_cpu_seconds(api.pid)
+
+            # Only the single worker process is measured, uvicorn forks
+            # children when there are several
+            if args.workers == 1 and cpu_start is not None and cpu_end:
+                results["api_cpu_us_per_request"] = round(
+                    (cpu_end - cpu_start) / args.requests * 1e6, 1
+                )
+            upstream = asyncio.run(fetch_json(f"{fake_api_url}/_stats"))
+        finally:
+            api.terminate()
+            api.wait()
+
+            for process in processes:
+                process.terminate()
+                process.join()
+
+    return {
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "workers": args.workers,
+            "videos": args.videos,
+            "upstream_latency_ms": args.upstream_latency,
+            "upstream_jitter_ms": args.upstream_jitter,
+            "upstream_error_rate": args.upstream_error_rate,
+            "upstream_slow_rate": args.upstream_slow_rate,
+            "upstream_slow_latency_ms": args.upstream_slow_latency,
+            "token_expires_in": args.token_expires_in,
+            "redis": "external" if args.redis_url else "fakeredis",
+            "env": args.env,
+        },
+        "results": results,
+        "upstream_calls": upstream,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--videos",
+        type=int,
+        default=100,
+        help="number of distinct video IDs requested",
+    )
+    parser.add_argument(
+        "--upstream-latency",
+        type=float,
+        default=20,
+        help="mean latency of the fake video API in milliseconds",
+    )
+    parser.add_argument(
+        "--upstream-jitter",
+        type=float,
+        default=5,
+        help="max deviation from the mean latency in milliseconds",
+    )
+    parser.add_argument(
+        "--upstream-error-rate",
+        type=float,
+        default=0,
+        help="ratio of video calls failing with a 500",
+    )
+    parser.add_argument(
+        "--upstream-slow-rate",
+        type=float,
+        default=0,
+        help="ratio of video calls answered after --upstream-slow-latency",
+    )
+    parser.add_argument(
+        "--upstream-slow-latency",
+        type=float,
+        default=500,
+        help="latency of the slow video calls in milliseconds",
+    )
+    parser.add_argument(
+        "--token-expires-in",
+        type=int,
+        default=3600,
+        help="lifetime of the fake access tokens in seconds",
+    )
+    parser.add_argument(
+        "--redis-url",
+        help="Redis server to use instead of a local fakeredis",
+    )
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="environment variable of the API, e.g. RESPONSE_CACHE_ENABLED=1",
+    )
+
+    report = main(parser.parse_args())
+
+    REPORTS_DIR.mkdir(exist_ok=True)
+    REPORTS_DIR.joinpath("benchmark_load_test.json").write_text(
+        json.dumps(report, indent=2), encoding="utf8"
+    )
+
+    print(json.dumps(report, indent=2))
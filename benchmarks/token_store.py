@@ -0,0 +1,171 @@
+"""Compare the latency of reading the access token from each token store
+backend: Redis, a memory-mapped file shared by the processes of a node, and
+the memory of the process
+
+Redis is either the one given with `--redis-url` or a local fakeredis server,
+which is much slower than an actual one.
+
+Usage: python benchmarks/token_store.py [--reads N] [--redis-url URL]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+from redis.asyncio import Redis
+
+from dm_stream_urls_server.cache import (
+    AccessTokenRecord,
+    TokenStore,
+    read_access_token,
+)
+from dm_stream_urls_server.token_store import (
+    MemoryTokenStore,
+    MmapTokenStore,
+    RedisTokenStore,
+)
+
+REPORTS_DIR = Path(__file__).parent.parent.joinpath("reports")
+
+HOST = "127.0.0.1"
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+
+        return sock.getsockname()[1]
+
+
+def serve_fake_redis(port: int) -> None:
+    try:
+        from fakeredis import (  # pylint: disable=import-outside-toplevel
+            TcpFakeServer,
+        )
+    except ImportError:
+        sys.exit("fakeredis[lua] is required unless --redis-url is given")
+
+    logging.getLogger("fakeredis").setLevel(logging.WARNING)
+    TcpFakeServer((HOST, port)).serve_forever()
+
+
+async def wait_until_ready(cache: Redis, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+
+    while True:
+        try:
+            await cache.ping()
+
+            return
+        except Exception:  # pylint: disable=broad-except
+            if time.monotonic() > deadline:
+                raise
+
+            await asyncio.sleep(0.1)
+
+
+async def measure(token_store: TokenStore, reads: int) -> dict:
+    """Store an access token, then read it `reads` times"""
+
+    now = time.time()
+
+    await token_store.set_record(
+        AccessTokenRecord(
+            "benchmark-access-token", now, now + 3240, now + 3600
+        )
+    )
+
+    latencies = []
+
+    for _ in range(reads):
+        start = time.perf_counter()
+        access_token = await read_access_token(token_store)
+        latencies.append(time.perf_counter() - start)
+
+        assert access_token  # nosec
+
+    latencies.sort()
+
+    return {
+        "mean_us": round(statistics.mean(latencies) * 1e6, 2),
+        "p50_us": round(latencies[len(latencies) // 2] * 1e6, 2),
+        "p99_us": round(latencies[int(len(latencies) * 0.99)] * 1e6, 2),
+    }
+
+
+async def run(reads: int, redis_url: str) -> dict:
+    cache = Redis.from_url(redis_url)
+
+    try:
+        await wait_until_ready(cache)
+        await cache.flushdb()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mmap_token_store = MmapTokenStore(
+                str(Path(tmp_dir).joinpath("tokens")), 65536, 1
+            )
+
+            try:
+                return {
+                    "redis": await measure(RedisTokenStore(cache), reads),
+                    "mmap": await measure(mmap_token_store, reads),
+                    "memory": await measure(MemoryTokenStore(), reads),
+                }
+            finally:
+                await mmap_token_store.close()
+    finally:
+        await cache.aclose()
+
+
+def main(reads: int, redis_url: str | None) -> dict:
+    fake_redis = None
+
+    if not redis_url:
+        fake_redis_port = get_free_port()
+        redis_url = f"redis://{HOST}:{fake_redis_port}/"
+        fake_redis = multiprocessing.Process(
+            target=serve_fake_redis,
+            args=(fake_redis_port,),
+            daemon=True,
+        )
+        fake_redis.start()
+
+    try:
+        backends = asyncio.run(run(reads, redis_url))
+    finally:
+        if fake_redis:
+            fake_redis.terminate()
+
+    return {
+        "reads": reads,
+        "redis": "fakeredis" if fake_redis else "external",
+        **backends,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--reads", type=int, default=10000)
+    parser.add_argument(
+        "--redis-url",
+        help="Redis server to use instead of a local fakeredis",
+    )
+    args = parser.parse_args()
+
+    report = main(args.reads, args.redis_url)
+
+    REPORTS_DIR.mkdir(exist_ok=True)
+    REPORTS_DIR.joinpath("benchmark_token_store.json").write_text(
+        json.dumps(report, indent=2), encoding="utf8"
+    )
+
+    print(json.dumps(report, indent=2))
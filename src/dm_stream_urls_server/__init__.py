@@ -4,37 +4,22 @@ import sys
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 
+# pylint: disable=wrong-import-position
+from dm_stream_urls_server.config import (
+    LOG_FORMAT,
+    LOG_LEVELS,
+    LOG_QUEUE_ENABLED,
+    LOG_RATE_LIMIT_BURST,
+    LOG_RATE_LIMIT_INTERVAL,
+)
+from dm_stream_urls_server.logs import get_logging_config
+
 logging.config.dictConfig(
-    {
-        "version": 1,
-        "root": {
-            "level": "DEBUG",
-            "handlers": ["console"],
-        },
-        "formatters": {
-            "default": {
-                "format": "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-            },
-        },
-        "handlers": {
-            "console": {
-                "class": "logging.StreamHandler",
-                "level": "DEBUG",
-                "formatter": "default",
-                "stream": "ext://sys.stdout",
-            },
-        },
-        "loggers": {
-            "asyncio": {
-                "level": "INFO",
-                "handlers": ["console"],
-                "propagate": False,
-            },
-            "dm_stream_urls_server": {
-                "level": "DEBUG",
-                "handlers": ["console"],
-                "propagate": False,
-            },
-        },
-    },
+    get_logging_config(
+        LOG_FORMAT,
+        LOG_LEVELS,
+        LOG_QUEUE_ENABLED,
+        LOG_RATE_LIMIT_BURST,
+        LOG_RATE_LIMIT_INTERVAL,
+    ),
 )
@@ -12,21 +12,50 @@ def refresh_access_token_cache():
     # pylint: disable=import-outside-toplevel
     import asyncio
 
-    from time import sleep
-
-    from dm_stream_urls_server.cache import get_cache
+    from dm_stream_urls_server.cache import create_cache
+    from dm_stream_urls_server.config import (
+        ACCESS_TOKEN_REFRESH_INTERVAL,
+        ACCESS_TOKEN_REFRESH_JITTER,
+    )
+    from dm_stream_urls_server.session import create_http_session
     from dm_stream_urls_server.token import (
-        refresh_dailymotion_api_access_token,
+        refresh_dailymotion_api_access_token_periodically,
     )
+    from dm_stream_urls_server.token_store import create_token_store
 
-    try:
-        while True:
-            cache = get_cache()
+    async def refresh_forever():
+        cache = create_cache()
+        token_store = create_token_store(cache)
+
+        try:
+            if not token_store:
+                return
 
+            if not token_store.shared:
+                logger.error(
+                    "Failed to refresh access token cache: "
+                    "TOKEN_STORE_BACKEND=%s is private to each process",
+                    token_store.backend,
+                )
+
+                return
+
+            async with create_http_session() as session:
+                await refresh_dailymotion_api_access_token_periodically(
+                    token_store,
+                    session,
+                    interval=ACCESS_TOKEN_REFRESH_INTERVAL,
+                    jitter=ACCESS_TOKEN_REFRESH_JITTER,
+                )
+        finally:
             if cache:
-                asyncio.run(refresh_dailymotion_api_access_token(cache))
+                await cache.close()
+
+            if token_store:
+                await token_store.close()
 
-            sleep(60)
+    try:
+        asyncio.run(refresh_forever())
     except KeyboardInterrupt:  # CTRL+C (SIGINT) Here
         pass
     except Exception as e:  # pylint: disable=broad-except
@@ -42,17 +71,193 @@ def refresh_access_token_cache():
 
 
 @click.command
-def start_api():
-    """Start the API"""
+@click.argument("video_ids", nargs=-1)
+@click.option(
+    "--video-formats",
+    required=True,
+    help="Comma-separated formats whose availability is prefetched.",
+)
+@click.option(
+    "--video-ids-file",
+    type=click.File(),
+    help="File listing video IDs, one per line, in addition to the "
+    "arguments.",
+)
+def prefetch_video_metadata(video_ids, video_formats, video_ids_file):
+    """Prefetch the metadata of videos ahead of their traffic
+
+    Whether each video can be played and the formats it is available in are
+    stored in Redis, where API processes only read them with
+    `VIDEO_METADATA_REDIS_ENABLED=1`, hence the command refuses to run
+    without it. Stream URLs are bound to the client IP address, hence they
+    are not prefetched.
+    """
+
+    # pylint: disable=import-outside-toplevel,too-many-locals
+    import asyncio
+    import json
+
+    from dm_stream_urls_server import config, prefetch
+    from dm_stream_urls_server.cache import create_cache
+    from dm_stream_urls_server.response_cache import ResponseCache
+    from dm_stream_urls_server.session import create_http_session
+    from dm_stream_urls_server.token import get_dailymotion_api_access_token
+    from dm_stream_urls_server.token_store import create_token_store
+
+    if not config.VIDEO_METADATA_REDIS_ENABLED:
+        raise click.ClickException(
+            "VIDEO_METADATA_REDIS_ENABLED=1 is required for the API to read "
+            "prefetched metadata"
+        )
+
+    if video_ids_file:
+        video_ids += tuple(line.strip() for line in video_ids_file)
+
+    async def prefetch_all():
+        cache = create_cache()
+
+        if not cache:
+            raise click.ClickException("Redis is required to prefetch")
+
+        token_store = create_token_store(cache)
+
+        try:
+            async with create_http_session() as session:
+                access_token = await get_dailymotion_api_access_token(
+                    token_store, session
+                )
+
+                if not access_token:
+                    raise click.ClickException("No access token available")
+
+                return await prefetch.prefetch_video_metadata(
+                    session,
+                    ResponseCache(
+                        max_size=len(video_ids),
+                        ttl=config.VIDEO_METADATA_TTL,
+                        cache=cache,
+                    ),
+                    dict.fromkeys(filter(None, video_ids)),
+                    video_formats,
+                    access_token,
+                    concurrency=config.PREFETCH_CONCURRENCY,
+                )
+        finally:
+            if token_store:
+                await token_store.close()
+
+            await cache.close()
+
+    for result in asyncio.run(prefetch_all()):
+        click.echo(json.dumps(result))
+
+
+@click.command
+@click.option(
+    "--host",
+    default="0.0.0.0",  # nosec
+    envvar="API_HOST",
+    show_default=True,
+    help="Bind socket to this host.",
+)
+@click.option(
+    "--port",
+    default=8000,
+    envvar="API_PORT",
+    show_default=True,
+    help="Bind socket to this port.",
+)
+@click.option(
+    "--workers",
+    default=1,
+    envvar="API_WORKERS",
+    show_default=True,
+    help="Number of worker processes.",
+)
+@click.option(
+    "--backlog",
+    default=2048,
+    envvar="API_BACKLOG",
+    show_default=True,
+    help="Maximum number of connections to hold in backlog.",
+)
+@click.option(
+    "--timeout-keep-alive",
+    default=5,
+    envvar="API_TIMEOUT_KEEP_ALIVE",
+    show_default=True,
+    help="Close idle client connections after this many seconds.",
+)
+@click.option(
+    "--loop",
+    type=click.Choice(["auto", "asyncio", "uvloop"]),
+    default="auto",
+    envvar="API_LOOP",
+    show_default=True,
+    help="Event loop implementation, uvloop requires the speedups extra.",
+)
+@click.option(
+    "--http",
+    type=click.Choice(["auto", "h11", "httptools"]),
+    default="auto",
+    envvar="API_HTTP",
+    show_default=True,
+    help="HTTP protocol implementation, httptools requires the speedups "
+    "extra.",
+)
+@click.option(
+    "--log-level",
+    type=click.Choice(["debug", "info", "warning", "error"]),
+    default="debug",
+    envvar="API_LOG_LEVEL",
+    show_default=True,
+    help="Level of the uvicorn loggers.",
+)
+@click.option(
+    "--access-log/--no-access-log",
+    default=True,
+    envvar="API_ACCESS_LOG",
+    show_default=True,
+    help="Log every request.",
+)
+def start_api(  # pylint: disable=too-many-arguments
+    *,
+    host: str,
+    port: int,
+    workers: int,
+    backlog: int,
+    timeout_keep_alive: int,
+    loop: str,
+    http: str,
+    log_level: str,
+    access_log: bool,
+):
+    """Start the API
+
+    With several workers, uvicorn supervises one process per worker. Each of
+    them runs the app lifespan on its own, hence holds its own Redis and HTTP
+    connection pools, while the access token is shared through Redis.
+
+    The uvicorn loggers are not given handlers of their own, they write
+    through the handler of the package, as configured by the `LOG_*`
+    settings.
+    """
 
     # pylint: disable=import-outside-toplevel
     import uvicorn
 
     uvicorn.run(
         "dm_stream_urls_server.api:app",
-        host="0.0.0.0",  # nosec
-        access_log=True,
-        log_level=logging.DEBUG,
+        host=host,
+        port=port,
+        workers=workers,
+        backlog=backlog,
+        timeout_keep_alive=timeout_keep_alive,
+        loop=loop,
+        http=http,
+        access_log=access_log,
+        log_level=logging.getLevelName(log_level.upper()),
+        log_config=None,
         reload=False,
     )
 
@@ -64,6 +269,7 @@ def cli():
 
 if __name__ == "__main__":
     cli.add_command(refresh_access_token_cache)
+    cli.add_command(prefetch_video_metadata)
     cli.add_command(start_api)
 
     cli()
@@ -1,64 +1,381 @@
-import ipaddress
-import logging
+import asyncio
+import contextlib
 
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
 from pathlib import Path
 
-import aiohttp
-
-from fastapi import Depends, FastAPI, HTTPException, Request, status
+from fastapi import Depends, FastAPI, Response
+from fastapi.datastructures import State
 from fastapi.responses import RedirectResponse
 from fastapi.staticfiles import StaticFiles
 
-from dm_stream_urls_server.cache import Cache, get_cache
-from dm_stream_urls_server.stream import get_stream_urls
-from dm_stream_urls_server.token import get_dailymotion_api_access_token
+from dm_stream_urls_server.cache import (
+    Cache,
+    TokenStore,
+    create_cache,
+    get_cache_pool_stats,
+    local_access_token_cache,
+    watch_access_token_invalidation,
+)
+from dm_stream_urls_server.config import (
+    ACCESS_TOKEN_REFRESH_INTERVAL,
+    ACCESS_TOKEN_REFRESH_JITTER,
+    ACCESS_TOKEN_REFRESHER_ENABLED,
+    DAILYMOTION_API_BASE_URL,
+    MANIFEST_CACHE_ENABLED,
+    MANIFEST_CACHE_MAX_SIZE,
+    MANIFEST_CACHE_VOD_TTL,
+    PUBLIC_IP_REFRESH_INTERVAL,
+    RATE_LIMIT_CLIENT_BURST,
+    RATE_LIMIT_CLIENT_RATE,
+    RATE_LIMIT_MAX_KEYS,
+    RATE_LIMIT_REDIS_ENABLED,
+    RATE_LIMIT_VIDEO_BURST,
+    RATE_LIMIT_VIDEO_RATE,
+    RESPONSE_CACHE_ENABLED,
+    RESPONSE_CACHE_MAX_SIZE,
+    RESPONSE_CACHE_REDIS_ENABLED,
+    RESPONSE_CACHE_STALE_IF_ERROR,
+    RESPONSE_CACHE_STALE_TTL,
+    RESPONSE_CACHE_STALE_WHILE_REVALIDATE,
+    RESPONSE_CACHE_TTL,
+    STREAM_URLS_PASS_THROUGH,
+    VIDEO_METADATA_MAX_SIZE,
+    VIDEO_METADATA_REDIS_ENABLED,
+    VIDEO_METADATA_TTL,
+    WARMUP_CONNECTIONS,
+    WARMUP_TIMEOUT,
+)
+from dm_stream_urls_server.credentials import credential_pool
+from dm_stream_urls_server.dependencies import (
+    enforce_rate_limits,
+    get_cache,
+    get_lookup_context,
+    get_rate_limiters,
+    get_response_cache,
+    get_token_store,
+    get_video_metadata_cache,
+    public_ip_resolver,
+)
+from dm_stream_urls_server.json_codec import (
+    JSON_CONTENT_TYPE,
+    FastJSONResponse,
+)
+from dm_stream_urls_server.lookup import (
+    LookupContext,
+    lookup_stream_urls,
+    stream_urls_single_flight,
+)
+from dm_stream_urls_server.metrics import (
+    CallbackMetric,
+    MetricsMiddleware,
+    registry,
+)
+from dm_stream_urls_server.prefetch import warm_up
+from dm_stream_urls_server.ratelimit import TokenBucketLimiter
+from dm_stream_urls_server.response_cache import ResponseCache
+from dm_stream_urls_server.routers import admin, batch, manifest, metrics
+from dm_stream_urls_server.session import create_http_session
+from dm_stream_urls_server.token import (
+    refresh_dailymotion_api_access_token_periodically,
+)
+from dm_stream_urls_server.token_store import create_token_store
+from dm_stream_urls_server.upstream import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    upstream_endpoints,
+    upstream_rate_limiter,
+    video_hedge_budget,
+)
+
 
-logger = logging.getLogger(__name__)
+@asynccontextmanager
+async def lifespan(fastapi_app: FastAPI) -> AsyncIterator[None]:
+    """Hold the resources shared by every request for the app lifetime"""
 
-app = FastAPI()
+    cache = create_cache()
+    fastapi_app.state.cache = cache
+    token_store = create_token_store(cache)
+    fastapi_app.state.token_store = token_store
+    fastapi_app.state.response_cache = (
+        ResponseCache(
+            max_size=RESPONSE_CACHE_MAX_SIZE,
+            ttl=RESPONSE_CACHE_TTL,
+            cache=cache if RESPONSE_CACHE_REDIS_ENABLED else None,
+            stale_ttl=(
+                RESPONSE_CACHE_STALE_TTL
+                if RESPONSE_CACHE_STALE_WHILE_REVALIDATE
+                or RESPONSE_CACHE_STALE_IF_ERROR
+                else 0
+            ),
+        )
+        if RESPONSE_CACHE_ENABLED
+        else None
+    )
 
+    fastapi_app.state.manifest_cache = (
+        ResponseCache(
+            max_size=MANIFEST_CACHE_MAX_SIZE,
+            ttl=MANIFEST_CACHE_VOD_TTL,
+        )
+        if MANIFEST_CACHE_ENABLED
+        else None
+    )
 
-async def get_client_public_ip() -> str | None:
-    """Call ifconfig.me API to detect public IP address"""
+    fastapi_app.state.video_metadata_cache = ResponseCache(
+        max_size=VIDEO_METADATA_MAX_SIZE,
+        ttl=VIDEO_METADATA_TTL,
+        cache=cache if VIDEO_METADATA_REDIS_ENABLED else None,
+    )
+
+    rate_limit_cache = cache if RATE_LIMIT_REDIS_ENABLED else None
+    fastapi_app.state.client_rate_limiter = TokenBucketLimiter(
+        "client",
+        rate=RATE_LIMIT_CLIENT_RATE,
+        burst=RATE_LIMIT_CLIENT_BURST,
+        cache=rate_limit_cache,
+        max_keys=RATE_LIMIT_MAX_KEYS,
+    )
+    fastapi_app.state.video_rate_limiter = TokenBucketLimiter(
+        "video",
+        rate=RATE_LIMIT_VIDEO_RATE,
+        burst=RATE_LIMIT_VIDEO_BURST,
+        cache=rate_limit_cache,
+        max_keys=RATE_LIMIT_MAX_KEYS,
+    )
+    upstream_rate_limiter.use_cache(rate_limit_cache)
+
+    try:
+        async with create_http_session() as http_session:
+            fastapi_app.state.http_session = http_session
+
+            background_tasks = [
+                asyncio.create_task(
+                    public_ip_resolver.refresh_periodically(
+                        http_session, PUBLIC_IP_REFRESH_INTERVAL
+                    )
+                ),
+            ]
+
+            if WARMUP_CONNECTIONS:
+                background_tasks.append(
+                    asyncio.create_task(
+                        warm_up(
+                            token_store,
+                            http_session,
+                            DAILYMOTION_API_BASE_URL,
+                            connections=WARMUP_CONNECTIONS,
+                            timeout=WARMUP_TIMEOUT,
+                        )
+                    )
+                )
+
+            if token_store:
+                background_tasks.append(
+                    asyncio.create_task(
+                        watch_access_token_invalidation(
+                            token_store, local_access_token_cache
+                        )
+                    )
+                )
+
+            if token_store and ACCESS_TOKEN_REFRESHER_ENABLED:
+                background_tasks.append(
+                    asyncio.create_task(
+                        refresh_dailymotion_api_access_token_periodically(
+                            token_store,
+                            http_session,
+                            interval=ACCESS_TOKEN_REFRESH_INTERVAL,
+                            jitter=ACCESS_TOKEN_REFRESH_JITTER,
+                        )
+                    )
+                )
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            url="https://ifconfig.me/all.json",
-        ) as response:
             try:
-                response.raise_for_status()
-            except aiohttp.ClientResponseError:
-                return None
+                yield
+            finally:
+                for task in background_tasks:
+                    task.cancel()
 
-            response_json: dict[str, str] = await response.json()
+                    with contextlib.suppress(asyncio.CancelledError):
+                        await task
+    finally:
+        if token_store:
+            await token_store.close()
 
-            return response_json.get("ip_addr")
+        if cache:
+            await cache.close()
 
 
-async def get_client_ip(
-    request: Request,
-    client_ip: str | None = None,
-) -> str | None:
-    """Helper to get client IP address"""
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(
+    MetricsMiddleware,
+    routes=("/stream-urls", "/stream-urls/batch", "/stream-manifest"),
+)
 
-    if client_ip:
-        return client_ip
 
-    if request.client:
-        request_client_ip = request.client.host
+CIRCUIT_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
 
-        if ipaddress.ip_address(request_client_ip).is_private:
-            return await get_client_public_ip()
 
-        return request_client_ip
+def register_resource_metrics(state: State) -> None:
+    """Expose the state of the shared resources as metrics computed when
+    scraped
 
-    return None
+    Registered once per process: the resources are read from the state of
+    the app when scraped, as set by the lifespan.
+    """
 
+    def cache_pool_stats():
+        if cache := getattr(state, "cache", None):
+            for name, value in get_cache_pool_stats(cache).items():
+                yield (name,), value
 
-async def get_access_token(cache: Cache = Depends(get_cache)) -> str | None:
-    """Helper for FastAPI to get cached access token"""
+    def response_cache_lookups():
+        if response_cache := getattr(state, "response_cache", None):
+            yield ("hit",), response_cache.hits
+            yield ("stale_hit",), response_cache.stale_hits
+            yield ("miss",), response_cache.misses
 
-    return await get_dailymotion_api_access_token(cache)
+    def rate_limiters_rejected():
+        for rate_limiter in (
+            getattr(state, "client_rate_limiter", None),
+            getattr(state, "video_rate_limiter", None),
+            upstream_rate_limiter,
+        ):
+            if rate_limiter:
+                yield (rate_limiter.name,), rate_limiter.rejected
+
+    registry.register(
+        CallbackMetric(
+            "dm_stream_urls_cache_pool_connections",
+            "Connections of the Redis pool by state",
+            cache_pool_stats,
+            labelnames=("state",),
+        )
+    )
+    registry.register(
+        CallbackMetric(
+            "dm_stream_urls_response_cache_lookups_total",
+            "Lookups of the stream URLs response cache by result",
+            response_cache_lookups,
+            labelnames=("result",),
+            metric_type="counter",
+        )
+    )
+    registry.register(
+        CallbackMetric(
+            "dm_stream_urls_single_flight_calls_total",
+            "Upstream calls made, and collapsed into an in-flight one",
+            lambda: (
+                (("made",), stream_urls_single_flight.calls),
+                (("collapsed",), stream_urls_single_flight.collapsed),
+            ),
+            labelnames=("result",),
+            metric_type="counter",
+        )
+    )
+    registry.register(
+        CallbackMetric(
+            "dm_stream_urls_upstream_circuit_state",
+            "State of the upstream circuit breakers, 0 for closed, 1 for "
+            "half-open and 2 for open",
+            lambda: (
+                (
+                    (endpoint.name,),
+                    CIRCUIT_STATE_VALUES[endpoint.breaker.state],
+                )
+                for endpoint in upstream_endpoints
+            ),
+            labelnames=("endpoint",),
+        )
+    )
+    registry.register(
+        CallbackMetric(
+            "dm_stream_urls_upstream_rejected_calls_total",
+            "Upstream calls failed fast while their circuit was open",
+            lambda: (
+                ((endpoint.name,), endpoint.breaker.rejected)
+                for endpoint in upstream_endpoints
+            ),
+            labelnames=("endpoint",),
+            metric_type="counter",
+        )
+    )
+    registry.register(
+        CallbackMetric(
+            "dm_stream_urls_upstream_timeout_seconds",
+            "Current adaptive timeout of the upstream calls",
+            lambda: (
+                ((endpoint.name,), endpoint.latency.timeout)
+                for endpoint in upstream_endpoints
+            ),
+            labelnames=("endpoint",),
+        )
+    )
+    registry.register(
+        CallbackMetric(
+            "dm_stream_urls_upstream_hedges_total",
+            "Hedged calls to Dailymotion API sent, returned first, and denied "
+            "by the budget",
+            lambda: (
+                ((result,), value)
+                for result, value in video_hedge_budget.stats().items()
+            ),
+            labelnames=("result",),
+            metric_type="counter",
+        )
+    )
+    registry.register(
+        CallbackMetric(
+            "dm_stream_urls_rate_limited_total",
+            "Requests and upstream calls rejected by the rate limiters",
+            rate_limiters_rejected,
+            labelnames=("limiter",),
+            metric_type="counter",
+        )
+    )
+    registry.register(
+        CallbackMetric(
+            "dm_stream_urls_credential_selections_total",
+            "Calls to Dailymotion API made with each API key",
+            lambda: (
+                ((name,), stats["selected"])
+                for name, stats in credential_pool.stats().items()
+            ),
+            labelnames=("key",),
+            metric_type="counter",
+        )
+    )
+    registry.register(
+        CallbackMetric(
+            "dm_stream_urls_credential_available",
+            "Whether each API key is in the rotation, 0 while throttled",
+            lambda: (
+                ((name,), int(stats["available"]))
+                for name, stats in credential_pool.stats().items()
+            ),
+            labelnames=("key",),
+        )
+    )
+    registry.register(
+        CallbackMetric(
+            "dm_stream_urls_access_token_age_seconds",
+            "Seconds since the oldest in-process access token was issued",
+            lambda: (((), local_access_token_cache.age()),),
+        )
+    )
+    registry.register(
+        CallbackMetric(
+            "dm_stream_urls_access_token_time_to_expiry_seconds",
+            "Seconds left before an in-process access token is refreshed",
+            lambda: (((), local_access_token_cache.time_to_expiry()),),
+        )
+    )
+
+
+register_resource_metrics(app.state)
 
 
 @app.get("/")
@@ -68,47 +385,68 @@ async def redirect_homepage_to_docs():
     return RedirectResponse(url="/demo")
 
 
-@app.get("/stream-urls")
+@app.get("/stats")
+async def get_stats_route(  # pylint: disable=too-many-arguments
+    cache: Cache | None = Depends(get_cache),
+    response_cache: ResponseCache | None = Depends(get_response_cache),
+    rate_limiters: tuple[TokenBucketLimiter, ...] = Depends(get_rate_limiters),
+    video_metadata_cache: ResponseCache | None = Depends(
+        get_video_metadata_cache
+    ),
+    token_store: TokenStore | None = Depends(get_token_store),
+):
+    """Return the utilisation of the shared resources"""
+
+    return {
+        "cache_pool": get_cache_pool_stats(cache) if cache else None,
+        "token_store": token_store.backend if token_store else None,
+        "response_cache": response_cache.stats() if response_cache else None,
+        "video_metadata_cache": (
+            video_metadata_cache.stats() if video_metadata_cache else None
+        ),
+        "single_flight": stream_urls_single_flight.stats(),
+        "upstream": {
+            endpoint.name: endpoint.stats() for endpoint in upstream_endpoints
+        },
+        "hedging": video_hedge_budget.stats(),
+        "rate_limit": {
+            rate_limiter.name: rate_limiter.stats()
+            for rate_limiter in rate_limiters
+        },
+        "credentials": credential_pool.stats(),
+    }
+
+
+@app.get("/stream-urls", dependencies=[Depends(enforce_rate_limits)])
 async def get_stream_urls_route(
     video_id: str,
     video_formats: str,
-    client_ip: str = Depends(get_client_ip),
-    authorization: str = Depends(get_access_token),
+    context: LookupContext = Depends(get_lookup_context),
 ):
-    """Request Dailymotion API to get video stream URLs"""
+    """Request Dailymotion API to get video stream URLs
 
-    try:
-        return await get_stream_urls(
-            video_id=video_id,
-            video_formats=video_formats,
-            client_ip=client_ip,
-            authorization=authorization,
-        )
-    except aiohttp.ClientResponseError as e:
-        raise HTTPException(
-            status_code=e.status,
-            detail=e.message,
-        ) from e
-    except Exception as e:  # pylint: disable=broad-except
-        exception_type = type(e).__name__
-        exception_message = str(e)
-
-        logger.error(
-            "Failed to get stream URL: "
-            "client_ip=%s, video_id=%s, video_formats=%s, "
-            "exception_type=%s, exception_message=%s",
-            client_ip,
-            video_id,
-            video_formats,
-            exception_type,
-            exception_message,
-        )
+    The response is rendered directly rather than through the generic
+    encoder of FastAPI. In pass-through mode, the body of Dailymotion API is
+    forwarded as is.
+    """
+
+    stream_urls = await lookup_stream_urls(
+        context,
+        video_id,
+        video_formats,
+        pass_through=STREAM_URLS_PASS_THROUGH,
+    )
+
+    if isinstance(stream_urls, bytes):
+        return Response(content=stream_urls, media_type=JSON_CONTENT_TYPE)
+
+    return FastJSONResponse(stream_urls)
 
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Internal server error",
-        ) from e
 
+app.include_router(batch.router)
+app.include_router(manifest.router)
+app.include_router(metrics.router)
+app.include_router(admin.router)
 
 app.mount(
     "/demo",
@@ -1,10 +1,20 @@
+import asyncio
 import logging
+import time
 
-from datetime import datetime, timedelta
+from abc import ABC, abstractmethod
+from collections.abc import Callable
+from typing import NamedTuple
 
-from redis.asyncio import Redis
+from redis.asyncio import BlockingConnectionPool, Redis
 
-from dm_stream_urls_server.config import CACHE_HOST
+from dm_stream_urls_server.config import (
+    CACHE_HEALTH_CHECK_INTERVAL,
+    CACHE_HOST,
+    CACHE_MAX_CONNECTIONS,
+    CACHE_POOL_TIMEOUT,
+    CACHE_SOCKET_KEEPALIVE,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -12,13 +22,249 @@ Cache = Redis
 
 CACHE_KEY = "dailymotion_api_access_token"
 LOCK_KEY = f"{CACHE_KEY}_cached"
+RECORD_KEY = f"{CACHE_KEY}_record"
+INVALIDATION_CHANNEL = f"{CACHE_KEY}_invalidated"
+REFRESH_LEASE_KEY = f"{CACHE_KEY}_refresh_lease"
 
+# Version of the packed access token record, records of other versions being
+# considered missing
+ACCESS_TOKEN_RECORD_VERSION = "1"
 
-def get_cache() -> Cache | None:
-    """Return a connection to the cache server"""
+# Share of the access token lifetime after which it is refreshed, leaving room
+# for the refresh to happen before it actually expires
+ACCESS_TOKEN_REFRESH_RATIO = 0.9
+
+
+class AccessTokenRecord(NamedTuple):
+    """An access token along with its issue time, the time after which it
+    should be refreshed and the time it expires at, in seconds since the
+    epoch"""
+
+    access_token: str
+    issued_at: float
+    refresh_at: float
+    expires_at: float
+
+
+def pack_access_token_record(record: AccessTokenRecord) -> str:
+    """Pack a record into a single value, its version first and the access
+    token last so that it may hold any character"""
+
+    return ":".join(
+        (
+            ACCESS_TOKEN_RECORD_VERSION,
+            f"{record.issued_at:.3f}",
+            f"{record.refresh_at:.3f}",
+            f"{record.expires_at:.3f}",
+            record.access_token,
+        )
+    )
+
+
+def unpack_access_token_record(
+    value: bytes | str,
+) -> AccessTokenRecord | None:
+    """Unpack a record, unless of another version or malformed"""
+
+    if isinstance(value, bytes):
+        value = value.decode("utf8", "replace")
+
+    version, _, fields = value.partition(":")
+
+    if version != ACCESS_TOKEN_RECORD_VERSION:
+        return None
+
+    try:
+        issued_at, refresh_at, expires_at, access_token = fields.split(":", 3)
+
+        return AccessTokenRecord(
+            access_token,
+            float(issued_at),
+            float(refresh_at),
+            float(expires_at),
+        )
+    except ValueError:
+        return None
+
+
+def get_access_token_key(key: str, key_name: str | None) -> str:
+    """Return the cache key of the access token of an API key, unchanged for
+    the single key of the legacy credentials file"""
+
+    return f"{key}:{key_name}" if key_name else key
+
+
+class LocalAccessTokenCache:
+    """In-process copy of the cached access tokens, one per API key
+
+    A token is held until its `refresh_at`, i.e. until the refresh script is
+    expected to have renewed it, so reads are served without any I/O in
+    between.
+    """
+
+    def __init__(self) -> None:
+        self._access_tokens: dict[str | None, tuple[str, float, float]] = {}
+
+    def get(self, key_name: str | None = None) -> str | None:
+        """Return the access token of an API key unless it has expired"""
+
+        if entry := self._access_tokens.get(key_name):
+            access_token, _, expires_at = entry
+
+            if time.monotonic() < expires_at:
+                return access_token
+
+        return None
+
+    def set(
+        self,
+        access_token: str,
+        ttl: float,
+        key_name: str | None = None,
+        issued_at: float | None = None,
+    ) -> None:
+        """Hold the access token of an API key for `ttl` seconds, along with
+        the time it was issued at, now unless given"""
+
+        self._access_tokens[key_name] = (
+            access_token,
+            time.time() if issued_at is None else issued_at,
+            time.monotonic() + ttl,
+        )
+
+    def clear(self) -> None:
+        """Forget the access tokens"""
+
+        self._access_tokens.clear()
+
+    def age(self) -> float | None:
+        """Return the number of seconds since the oldest access token held
+        was issued, if any"""
+
+        now = time.monotonic()
+        issued_ats = [
+            issued_at
+            for _, issued_at, expires_at in self._access_tokens.values()
+            if now < expires_at
+        ]
+
+        return time.time() - min(issued_ats) if issued_ats else None
+
+    def time_to_expiry(self) -> float | None:
+        """Return the number of seconds left before the first access token
+        expires, if any"""
+
+        now = time.monotonic()
+        times_to_expiry = [
+            expires_at - now
+            for _, _, expires_at in self._access_tokens.values()
+            if now < expires_at
+        ]
+
+        return min(times_to_expiry) if times_to_expiry else None
+
+
+local_access_token_cache = LocalAccessTokenCache()
+
+
+class TokenStore(ABC):
+    """Storage of the access token records and of their refresh leases,
+    shared by the processes using the same API keys
+
+    Records and leases of each API key are told apart by its `key_name`.
+    Backends raise on failure, leaving the callers to log and fall back.
+    """
+
+    # Name of the backend, as set in TOKEN_STORE_BACKEND
+    backend = ""
+
+    # Whether other processes see the records, which the refresh daemon needs
+    shared = True
+
+    @abstractmethod
+    async def get_record(
+        self,
+        key_name: str | None = None,
+    ) -> AccessTokenRecord | None:
+        """Return the access token record of an API key, if any"""
+
+    @abstractmethod
+    async def set_record(
+        self,
+        record: AccessTokenRecord,
+        lease_owner: str | None = None,
+        key_name: str | None = None,
+    ) -> bool:
+        """Store the access token record of an API key until it expires, and
+        notify the watchers
+
+        With a `lease_owner`, the record is only stored, atomically, if the
+        refresh lease is still held by that owner. Return whether it was.
+        """
+
+    @abstractmethod
+    async def acquire_lease(
+        self,
+        owner: str,
+        ttl: float,
+        key_name: str | None = None,
+    ) -> bool:
+        """Take the refresh lease of an API key for `ttl` seconds, unless
+        held by another owner, and return whether it was taken"""
+
+    @abstractmethod
+    async def release_lease(
+        self,
+        owner: str,
+        key_name: str | None = None,
+    ) -> None:
+        """Release the refresh lease of an API key if still held by
+        `owner`"""
+
+    @abstractmethod
+    async def is_leased(self, key_name: str | None = None) -> bool:
+        """Return whether the refresh lease of an API key is held by any
+        owner"""
+
+    @abstractmethod
+    async def watch(self, callback: Callable[[], None]) -> None:
+        """Call `callback` once watching, then whenever a record is stored,
+        until cancelled"""
+
+    async def close(self) -> None:
+        """Release the resources held by the backend"""
+
+
+def create_cache() -> Cache | None:
+    """Return a cache client backed by its own connection pool
+
+    The client is meant to be created once per process and shared: every
+    command borrows a connection from the pool instead of opening a new one,
+    waiting for one to be released when all of them are in use.
+
+    No client is created when `CACHE_HOST` is empty, for deployments without
+    Redis.
+    """
+
+    if not CACHE_HOST:
+        logger.info("Cache disabled: CACHE_HOST is empty")
+
+        return None
 
     try:
-        return Redis.from_url(f"redis://{CACHE_HOST}/")
+        cache = Redis(
+            connection_pool=BlockingConnectionPool.from_url(
+                f"redis://{CACHE_HOST}/",
+                max_connections=CACHE_MAX_CONNECTIONS,
+                timeout=CACHE_POOL_TIMEOUT,
+                health_check_interval=CACHE_HEALTH_CHECK_INTERVAL,
+                socket_keepalive=CACHE_SOCKET_KEEPALIVE,
+            )
+        )
+        # Closing the client closes its pool, as with `Redis.from_url`
+        cache.auto_close_connection_pool = True
+
+        return cache
     except Exception as e:  # pylint: disable=broad-except
         exception_type = type(e).__name__
         exception_message = str(e)
@@ -34,17 +280,49 @@ def get_cache() -> Cache | None:
         return None
 
 
-async def is_access_token_expired(cache: Cache) -> bool:
-    """Check whether the access token cache has expired"""
+def get_cache_pool_stats(cache: Cache) -> dict[str, int | None]:
+    """Return the utilisation of the cache connection pool
+
+    The connection counts are read from private attributes of the pool,
+    which not every version of redis-py has: they are None otherwise.
+    """
+
+    pool = cache.connection_pool
+    available = getattr(pool, "_available_connections", None)
+    in_use = getattr(pool, "_in_use_connections", None)
+
+    if available is None or in_use is None:
+        return {
+            "max_connections": pool.max_connections,
+            "created_connections": None,
+            "available_connections": None,
+            "in_use_connections": None,
+        }
+
+    return {
+        "max_connections": pool.max_connections,
+        "created_connections": len(available) + len(in_use),
+        "available_connections": len(available),
+        "in_use_connections": len(in_use),
+    }
+
+
+async def is_access_token_expired(
+    cache: TokenStore,
+    key_name: str | None = None,
+) -> bool:
+    """Check whether the access token is due for refresh"""
 
     try:
-        return not bool(await cache.get(LOCK_KEY))
+        record = await cache.get_record(key_name)
+
+        return not record or time.time() >= record.refresh_at
     except Exception as e:  # pylint: disable=broad-except
         exception_type = type(e).__name__
         exception_message = str(e)
 
         logger.warning(
-            "Failed to get dailymotion access token lock: "
+            "Failed to get dailymotion access token from cache: "
             "exception_type=%s, exception_message=%s",
             exception_type,
             exception_message,
@@ -53,14 +331,44 @@ async def is_access_token_expired(cache: Cache) -> bool:
         return True
 
 
-async def read_access_token(cache: Cache) -> str | None:
+async def read_access_token(
+    cache: TokenStore,
+    key_name: str | None = None,
+) -> str | None:
     """Read access token from cache"""
 
-    try:
-        if cached_access_token := await cache.get(CACHE_KEY):
-            access_token: str = cached_access_token.decode("utf8")
+    access_token, _ = await read_access_token_with_ttl(cache, key_name)
+
+    return access_token
+
+
+async def read_access_token_with_ttl(
+    cache: TokenStore,
+    key_name: str | None = None,
+) -> tuple[str | None, float]:
+    """Read access token from cache along with the number of seconds left
+    before its refresh is due, in a single round-trip
+
+    The TTL is 0 when the refresh is already due.
+    """
+
+    if record := await read_access_token_record(cache, key_name):
+        return record.access_token, max(record.refresh_at - time.time(), 0)
+
+    return None, 0
+
 
-            return access_token
+async def read_access_token_record(
+    cache: TokenStore,
+    key_name: str | None = None,
+) -> AccessTokenRecord | None:
+    """Read the record of the access token from cache unless it has
+    expired"""
+
+    try:
+        if record := await cache.get_record(key_name):
+            if time.time() < record.expires_at:
+                return record
     except Exception as e:  # pylint: disable=broad-except
         exception_type = type(e).__name__
         exception_message = str(e)
@@ -75,29 +383,123 @@ async def read_access_token(cache: Cache) -> str | None:
     return None
 
 
+async def acquire_refresh_lease(
+    cache: TokenStore,
+    owner: str,
+    ttl: float,
+    key_name: str | None = None,
+) -> bool | None:
+    """Try to become the only process allowed to refresh the access token
+    for the next `ttl` seconds
+
+    Return `True` once acquired and `False` while held by another owner.
+
+    Fails open: if the cache cannot be reached, `None` is returned and the
+    caller is let through rather than waiting for a refresh that no one can
+    perform. It does not hold the lease though, so it must neither store the
+    token as `owner` nor release the lease.
+    """
+
+    try:
+        return await cache.acquire_lease(owner, ttl, key_name)
+    except Exception as e:  # pylint: disable=broad-except
+        exception_type = type(e).__name__
+        exception_message = str(e)
+
+        logger.warning(
+            "Failed to acquire dailymotion access token refresh lease: "
+            "exception_type=%s, exception_message=%s",
+            exception_type,
+            exception_message,
+        )
+
+        return None
+
+
+async def release_refresh_lease(
+    cache: TokenStore,
+    owner: str,
+    key_name: str | None = None,
+) -> None:
+    """Release the access token refresh lease if still held by `owner`"""
+
+    try:
+        await cache.release_lease(owner, key_name)
+    except Exception as e:  # pylint: disable=broad-except
+        exception_type = type(e).__name__
+        exception_message = str(e)
+
+        logger.warning(
+            "Failed to release dailymotion access token refresh lease: "
+            "exception_type=%s, exception_message=%s",
+            exception_type,
+            exception_message,
+        )
+
+
+async def is_refresh_lease_held(
+    cache: TokenStore,
+    key_name: str | None = None,
+) -> bool:
+    """Check whether a process holds the access token refresh lease
+
+    A lease that cannot be checked is considered released, so that waiters
+    stop waiting for a cache that cannot be reached.
+    """
+
+    try:
+        return await cache.is_leased(key_name)
+    except Exception as e:  # pylint: disable=broad-except
+        exception_type = type(e).__name__
+        exception_message = str(e)
+
+        logger.warning(
+            "Failed to check dailymotion access token refresh lease: "
+            "exception_type=%s, exception_message=%s",
+            exception_type,
+            exception_message,
+        )
+
+        return False
+
+
 async def store_access_token(
-    cache: Cache,
+    cache: TokenStore,
     access_token: str,
     expires_in: int,
+    lease_owner: str | None = None,
+    key_name: str | None = None,
 ) -> None:
-    """Store access token to cache along with a lock key whose expiry is 90% of
-    the actual access token expiry
+    """Store access token to cache as a single record, in a single
+    round-trip, due for refresh after 90% of its actual expiry
 
     The goal is to leave room for the refresh script to renew the token before
     it actually expires and to spare an API call from the latency of generating
-    a new token.
-    """
+    a new token. The record itself expires along with the token.
 
-    try:
-        await cache.set(CACHE_KEY, access_token)
+    Processes holding a local copy of the token are notified to drop it.
 
-        expiry = expires_in * 90 // 100
+    With a `lease_owner`, the token is only stored, atomically, if the refresh
+    lease is still held by that owner.
 
-        await cache.set(
-            LOCK_KEY,
-            f"{datetime.now() + timedelta(seconds=expiry)}",
-            ex=expiry,
-        )
+    With a `key_name`, the token is stored apart from the tokens of the other
+    API keys.
+    """
+
+    now = time.time()
+    record = AccessTokenRecord(
+        access_token=access_token,
+        issued_at=now,
+        refresh_at=now + expires_in * ACCESS_TOKEN_REFRESH_RATIO,
+        expires_at=now + expires_in,
+    )
+
+    try:
+        if not await cache.set_record(record, lease_owner, key_name):
+            logger.warning(
+                "Dailymotion access token refresh lease lost, "
+                "discarding access token"
+            )
     except Exception as e:  # pylint: disable=broad-except
         exception_type = type(e).__name__
         exception_message = str(e)
@@ -108,3 +510,35 @@ async def store_access_token(
             exception_type,
             exception_message,
         )
+
+
+async def watch_access_token_invalidation(
+    cache: TokenStore,
+    local_cache: LocalAccessTokenCache,
+    retry_delay: float = 1,
+) -> None:
+    """Drop the local access tokens whenever a new one is stored to cache
+
+    Runs until cancelled. The local tokens are also dropped whenever the
+    watch is (re)established since notifications may have been missed.
+    """
+
+    while True:
+        try:
+            await cache.watch(local_cache.clear)
+        except asyncio.CancelledError:  # pylint: disable=try-except-raise
+            raise
+        except Exception as e:  # pylint: disable=broad-except
+            exception_type = type(e).__name__
+            exception_message = str(e)
+
+            logger.warning(
+                "Failed to watch dailymotion access token invalidation: "
+                "exception_type=%s, exception_message=%s",
+                exception_type,
+                exception_message,
+            )
+
+        local_cache.clear()
+
+        await asyncio.sleep(retry_delay)
@@ -0,0 +1,190 @@
+import asyncio
+import ipaddress
+import logging
+import time
+
+from collections.abc import Mapping
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+IPNetwork = ipaddress.IPv4Network | ipaddress.IPv6Network
+
+
+def parse_trusted_proxies(trusted_proxies: str) -> list[IPNetwork]:
+    """Parse a comma-separated list of trusted proxy CIDRs"""
+
+    return [
+        ipaddress.ip_network(cidr.strip(), strict=False)
+        for cidr in trusted_proxies.split(",")
+        if cidr.strip()
+    ]
+
+
+def is_trusted_proxy(address: str, trusted_proxies: list[IPNetwork]) -> bool:
+    """Whether the address belongs to one of the trusted proxy networks"""
+
+    try:
+        ip_address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+
+    return any(ip_address in network for network in trusted_proxies)
+
+
+def parse_ip_address(address: str) -> str | None:
+    """Return the IP address from a forwarding header node, without port,
+    brackets or quotes, or None if it is not an IP address (e.g. "unknown")
+    """
+
+    address = address.strip().strip('"')
+
+    if address.startswith("["):
+        address = address[1 : address.find("]")]
+    elif address.count(":") == 1:
+        address = address.split(":")[0]
+
+    try:
+        return str(ipaddress.ip_address(address))
+    except ValueError:
+        return None
+
+
+def get_forwarding_chain(headers: Mapping[str, str]) -> list[str]:
+    """Return the addresses a request was forwarded for, from the `Forwarded`,
+    `X-Forwarded-For` or `X-Real-IP` header, client first"""
+
+    if forwarded := headers.get("forwarded"):
+        return [
+            pair.split("=", 1)[1]
+            for element in forwarded.split(",")
+            for pair in element.split(";")
+            if pair.strip().lower().startswith("for=")
+        ]
+
+    if x_forwarded_for := headers.get("x-forwarded-for"):
+        return x_forwarded_for.split(",")
+
+    if x_real_ip := headers.get("x-real-ip"):
+        return [x_real_ip]
+
+    return []
+
+
+def get_forwarded_client_ip(
+    remote_ip: str,
+    headers: Mapping[str, str],
+    trusted_proxies: list[IPNetwork],
+) -> str:
+    """Return the client IP address of a request that may come through
+    trusted proxies
+
+    The forwarding chain is walked from the nearest hop as long as the hop is
+    a trusted proxy, so that a client cannot spoof its address by sending
+    forwarding headers itself.
+    """
+
+    client_ip = remote_ip
+
+    for address in reversed(get_forwarding_chain(headers)):
+        if not is_trusted_proxy(client_ip, trusted_proxies):
+            break
+
+        if not (forwarded_ip := parse_ip_address(address)):
+            break
+
+        client_ip = forwarded_ip
+
+    return client_ip
+
+
+async def fetch_public_ip(
+    session: aiohttp.ClientSession,
+    url: str,
+    timeout: float,
+) -> str | None:
+    """Call an IP detection API such as ifconfig.me to detect the public IP
+    address of the server"""
+
+    async with session.get(
+        url=url,
+        timeout=aiohttp.ClientTimeout(total=timeout),
+    ) as response:
+        try:
+            response.raise_for_status()
+        except aiohttp.ClientResponseError:
+            return None
+
+        response_json: dict[str, str] = await response.json()
+
+        return response_json.get("ip_addr")
+
+
+class PublicIpResolver:
+    """Public IP address of the server, used for clients on a private network
+
+    The address is fetched once then refreshed periodically in the background
+    instead of on every request. While it is unknown, requests fetch it at
+    most once every `retry_delay` seconds.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        timeout: float,
+        retry_delay: float = 10,
+    ) -> None:
+        self.url = url
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.public_ip: str | None = None
+        self._retry_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def get(self, session: aiohttp.ClientSession) -> str | None:
+        """Return the public IP address, fetching it if it is unknown yet"""
+
+        if self.public_ip or time.monotonic() < self._retry_at:
+            return self.public_ip
+
+        async with self._lock:
+            if not self.public_ip and time.monotonic() >= self._retry_at:
+                await self.refresh(session)
+
+                self._retry_at = time.monotonic() + self.retry_delay
+
+        return self.public_ip
+
+    async def refresh(self, session: aiohttp.ClientSession) -> None:
+        """Fetch the public IP address, keeping the previous one on failure"""
+
+        try:
+            if public_ip := await fetch_public_ip(
+                session, self.url, self.timeout
+            ):
+                self.public_ip = public_ip
+        except Exception as e:  # pylint: disable=broad-except
+            exception_type = type(e).__name__
+            exception_message = str(e)
+
+            logger.warning(
+                "Failed to fetch public IP address: "
+                "url=%s, exception_type=%s, exception_message=%s",
+                self.url,
+                exception_type,
+                exception_message,
+            )
+
+    async def refresh_periodically(
+        self,
+        session: aiohttp.ClientSession,
+        interval: float,
+    ) -> None:
+        """Refresh the public IP address every `interval` seconds until
+        cancelled"""
+
+        while True:
+            await self.refresh(session)
+
+            await asyncio.sleep(interval)
@@ -1,10 +1,215 @@
 import os
+import tempfile
 
-DAILYMOTION_API_BASE_URL = "https://partner.api.dailymotion.com"
+# Logs are written to stdout as `text` or `json` lines, from a background
+# thread when LOG_QUEUE_ENABLED so that the event loop never blocks on it.
+# LOG_LEVELS overrides the level of loggers, e.g. `root=INFO,asyncio=WARNING`.
+# Warnings and errors of a same message beyond LOG_RATE_LIMIT_BURST per
+# LOG_RATE_LIMIT_INTERVAL seconds are dropped, a zero interval disabling it.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_QUEUE_ENABLED = os.getenv("LOG_QUEUE_ENABLED", "0") == "1"
+LOG_RATE_LIMIT_BURST = int(os.getenv("LOG_RATE_LIMIT_BURST", "10"))
+LOG_RATE_LIMIT_INTERVAL = float(os.getenv("LOG_RATE_LIMIT_INTERVAL", "0"))
+
+DAILYMOTION_API_BASE_URL = os.getenv(
+    "DAILYMOTION_API_BASE_URL", "https://partner.api.dailymotion.com"
+)
 
 DAILYMOTION_API_OAUTH_TOKEN_URL = f"{DAILYMOTION_API_BASE_URL}/oauth/v1/token"
 DAILYMOTION_API_VIDEO_URL = f"{DAILYMOTION_API_BASE_URL}/rest/video"
 
-DAILYMOTION_API_CREDENTIALS_FILE = ".secrets/dailymotion_api_credentials.json"
+DAILYMOTION_API_CREDENTIALS_FILE = os.getenv(
+    "DAILYMOTION_API_CREDENTIALS_FILE",
+    ".secrets/dailymotion_api_credentials.json",
+)
+
+# The credentials file may hold several API keys that calls are spread across.
+# It is loaded again once changed, checked at most every RELOAD_INTERVAL
+# seconds, and a key throttled by Dailymotion API is left out of the rotation
+# for THROTTLE_COOLDOWN seconds unless the API tells for how long.
+CREDENTIALS_RELOAD_INTERVAL = float(
+    os.getenv("CREDENTIALS_RELOAD_INTERVAL", "5")
+)
+CREDENTIALS_THROTTLE_COOLDOWN = float(
+    os.getenv("CREDENTIALS_THROTTLE_COOLDOWN", "60")
+)
+
+# Refresh the access token ahead of its expiry from within the API process, in
+# addition to or instead of the `refresh-access-token-cache` daemon
+ACCESS_TOKEN_REFRESHER_ENABLED = (
+    os.getenv("ACCESS_TOKEN_REFRESHER_ENABLED", "0") == "1"
+)
+ACCESS_TOKEN_REFRESH_INTERVAL = float(
+    os.getenv("ACCESS_TOKEN_REFRESH_INTERVAL", "60")
+)
+ACCESS_TOKEN_REFRESH_JITTER = float(
+    os.getenv("ACCESS_TOKEN_REFRESH_JITTER", "0.1")
+)
+
+# Only one process at a time may fetch a new access token, the others poll the
+# cache for it
+ACCESS_TOKEN_REFRESH_LEASE_TTL = float(
+    os.getenv("ACCESS_TOKEN_REFRESH_LEASE_TTL", "10")
+)
+ACCESS_TOKEN_REFRESH_POLL_INTERVAL = float(
+    os.getenv("ACCESS_TOKEN_REFRESH_POLL_INTERVAL", "0.1")
+)
+
+# Upstream calls time out after a multiple of a recent latency percentile,
+# within bounds, and fail fast once too many of them failed in a row
+UPSTREAM_MIN_TIMEOUT = float(os.getenv("UPSTREAM_MIN_TIMEOUT", "0.2"))
+UPSTREAM_MAX_TIMEOUT = float(os.getenv("UPSTREAM_MAX_TIMEOUT", "2"))
+UPSTREAM_TIMEOUT_PERCENTILE = float(
+    os.getenv("UPSTREAM_TIMEOUT_PERCENTILE", "99")
+)
+UPSTREAM_TIMEOUT_MULTIPLIER = float(
+    os.getenv("UPSTREAM_TIMEOUT_MULTIPLIER", "2")
+)
+UPSTREAM_LATENCY_WINDOW = int(os.getenv("UPSTREAM_LATENCY_WINDOW", "500"))
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(
+    os.getenv("CIRCUIT_BREAKER_FAILURE_THRESHOLD", "5")
+)
+CIRCUIT_BREAKER_RESET_TIMEOUT = float(
+    os.getenv("CIRCUIT_BREAKER_RESET_TIMEOUT", "10")
+)
+
+# Calls to Dailymotion API not answered within a percentile of the recent
+# latencies are sent a second time, within a budget ratio of the calls
+UPSTREAM_HEDGING_ENABLED = os.getenv("UPSTREAM_HEDGING_ENABLED", "0") == "1"
+UPSTREAM_HEDGE_PERCENTILE = float(os.getenv("UPSTREAM_HEDGE_PERCENTILE", "95"))
+UPSTREAM_HEDGE_BUDGET = float(os.getenv("UPSTREAM_HEDGE_BUDGET", "0.05"))
 
 CACHE_HOST = os.getenv("CACHE_HOST", "localhost")
+# Once `CACHE_MAX_CONNECTIONS` are in use, commands wait for a connection to
+# be released for up to `CACHE_POOL_TIMEOUT` seconds rather than failing
+CACHE_MAX_CONNECTIONS = int(os.getenv("CACHE_MAX_CONNECTIONS", "50"))
+CACHE_POOL_TIMEOUT = float(os.getenv("CACHE_POOL_TIMEOUT", "1"))
+CACHE_HEALTH_CHECK_INTERVAL = int(
+    os.getenv("CACHE_HEALTH_CHECK_INTERVAL", "30")
+)
+CACHE_SOCKET_KEEPALIVE = os.getenv("CACHE_SOCKET_KEEPALIVE", "1") == "1"
+
+# Access tokens are stored in `redis`, shared across nodes, in an `mmap` file,
+# shared by the processes of a node, or in `memory`, private to each process.
+# Processes sharing the file check it for new tokens every WATCH_INTERVAL.
+TOKEN_STORE_BACKEND = os.getenv("TOKEN_STORE_BACKEND", "redis")
+TOKEN_STORE_MMAP_PATH = os.getenv(
+    "TOKEN_STORE_MMAP_PATH",
+    os.path.join(tempfile.gettempdir(), "dm_stream_urls_server_tokens"),
+)
+TOKEN_STORE_MMAP_SIZE = int(os.getenv("TOKEN_STORE_MMAP_SIZE", "65536"))
+TOKEN_STORE_WATCH_INTERVAL = float(
+    os.getenv("TOKEN_STORE_WATCH_INTERVAL", "1")
+)
+
+# Upstream HTTP connection pool, shared by every call to Dailymotion API
+HTTP_CONNECTION_LIMIT = int(os.getenv("HTTP_CONNECTION_LIMIT", "100"))
+HTTP_CONNECTION_LIMIT_PER_HOST = int(
+    os.getenv("HTTP_CONNECTION_LIMIT_PER_HOST", "50")
+)
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+
+# Comma-separated CIDRs of the proxies allowed to forward the client address
+# through the `Forwarded`, `X-Forwarded-For` or `X-Real-IP` headers
+TRUSTED_PROXIES = os.getenv("TRUSTED_PROXIES", "")
+
+# Public IP address of the server, used for clients on a private network
+PUBLIC_IP_URL = os.getenv("PUBLIC_IP_URL", "https://ifconfig.me/all.json")
+PUBLIC_IP_REFRESH_INTERVAL = float(
+    os.getenv("PUBLIC_IP_REFRESH_INTERVAL", "300")
+)
+PUBLIC_IP_TIMEOUT = float(os.getenv("PUBLIC_IP_TIMEOUT", "2"))
+
+# Stream URLs are signed for a limited lifetime, no response may be served
+# from cache past it
+STREAM_URLS_LIFETIME = float(os.getenv("STREAM_URLS_LIFETIME", "300"))
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "0") == "1"
+RESPONSE_CACHE_REDIS_ENABLED = (
+    os.getenv("RESPONSE_CACHE_REDIS_ENABLED", "0") == "1"
+)
+RESPONSE_CACHE_MAX_SIZE = int(os.getenv("RESPONSE_CACHE_MAX_SIZE", "10000"))
+RESPONSE_CACHE_TTL = min(
+    float(os.getenv("RESPONSE_CACHE_TTL", "30")),
+    STREAM_URLS_LIFETIME,
+)
+
+# Past their TTL, cached responses may still be served while they are
+# refreshed in the background, and when Dailymotion API fails, as long as
+# their stream URLs remain valid
+RESPONSE_CACHE_STALE_WHILE_REVALIDATE = (
+    os.getenv("RESPONSE_CACHE_STALE_WHILE_REVALIDATE", "0") == "1"
+)
+RESPONSE_CACHE_STALE_IF_ERROR = (
+    os.getenv("RESPONSE_CACHE_STALE_IF_ERROR", "0") == "1"
+)
+RESPONSE_CACHE_STALE_TTL = min(
+    float(os.getenv("RESPONSE_CACHE_STALE_TTL", "240")),
+    STREAM_URLS_LIFETIME - RESPONSE_CACHE_TTL,
+)
+
+# Forward the body of Dailymotion API as is instead of decoding and encoding
+# it again, only its status and content type are checked
+STREAM_URLS_PASS_THROUGH = os.getenv("STREAM_URLS_PASS_THROUGH", "0") == "1"
+
+# HLS manifests streamed back by `/stream-manifest`, cached per video and client
+# IP address, briefly when live as they are updated as the stream goes
+MANIFEST_TIMEOUT = float(os.getenv("MANIFEST_TIMEOUT", "2"))
+MANIFEST_CACHE_ENABLED = os.getenv("MANIFEST_CACHE_ENABLED", "0") == "1"
+MANIFEST_CACHE_MAX_SIZE = int(os.getenv("MANIFEST_CACHE_MAX_SIZE", "1000"))
+MANIFEST_CACHE_LIVE_TTL = float(os.getenv("MANIFEST_CACHE_LIVE_TTL", "2"))
+MANIFEST_CACHE_VOD_TTL = min(
+    float(os.getenv("MANIFEST_CACHE_VOD_TTL", "30")),
+    STREAM_URLS_LIFETIME,
+)
+
+# Token buckets refilled with RATE tokens per second up to BURST, limiting the
+# requests per client IP address, per client IP address and video, and the
+# calls to Dailymotion API as a whole so that partner limits are never
+# exceeded. A zero rate disables a limit.
+RATE_LIMIT_CLIENT_RATE = float(os.getenv("RATE_LIMIT_CLIENT_RATE", "0"))
+RATE_LIMIT_CLIENT_BURST = float(os.getenv("RATE_LIMIT_CLIENT_BURST", "20"))
+RATE_LIMIT_VIDEO_RATE = float(os.getenv("RATE_LIMIT_VIDEO_RATE", "0"))
+RATE_LIMIT_VIDEO_BURST = float(os.getenv("RATE_LIMIT_VIDEO_BURST", "5"))
+RATE_LIMIT_UPSTREAM_RATE = float(os.getenv("RATE_LIMIT_UPSTREAM_RATE", "0"))
+RATE_LIMIT_UPSTREAM_BURST = float(os.getenv("RATE_LIMIT_UPSTREAM_BURST", "10"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+RATE_LIMIT_REDIS_ENABLED = os.getenv("RATE_LIMIT_REDIS_ENABLED", "0") == "1"
+
+# Connections opened to Dailymotion API and access token loaded in the
+# background at startup, ahead of the first requests
+WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", "4"))
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "5"))
+
+# Video metadata that is not bound to the client IP address, i.e. whether a
+# video can be played, prefetched ahead of expected traffic. It is kept in
+# memory, and shared through Redis when VIDEO_METADATA_REDIS_ENABLED at the
+# cost of a Redis round-trip per lookup not served from the response cache.
+VIDEO_METADATA_TTL = float(os.getenv("VIDEO_METADATA_TTL", "900"))
+VIDEO_METADATA_REDIS_ENABLED = (
+    os.getenv("VIDEO_METADATA_REDIS_ENABLED", "0") == "1"
+)
+VIDEO_METADATA_MAX_SIZE = int(os.getenv("VIDEO_METADATA_MAX_SIZE", "10000"))
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "10"))
+
+# Seconds a 404 or a 403 of Dailymotion API is remembered, answering lookups
+# of the video without calling it again. Since videos may be restricted by
+# country, a 403 only applies to the client IP address that got it. A zero TTL
+# disables the negative cache.
+NEGATIVE_CACHE_TTL = float(os.getenv("NEGATIVE_CACHE_TTL", "30"))
+
+# Token expected in the `Authorization: Bearer` header of the `/admin` routes,
+# which are disabled when empty
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# Profiles captured by `/admin/profile` last at most MAX_SECONDS, stacks being
+# sampled every SAMPLE_INTERVAL seconds
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+
+STREAM_URLS_BATCH_MAX_SIZE = int(os.getenv("STREAM_URLS_BATCH_MAX_SIZE", "50"))
+STREAM_URLS_BATCH_CONCURRENCY = int(
+    os.getenv("STREAM_URLS_BATCH_CONCURRENCY", "10")
+)
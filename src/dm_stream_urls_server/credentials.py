@@ -0,0 +1,252 @@
+import json
+import logging
+import os
+import time
+
+from typing import NamedTuple
+
+from dm_stream_urls_server.config import (
+    CREDENTIALS_RELOAD_INTERVAL,
+    CREDENTIALS_THROTTLE_COOLDOWN,
+    DAILYMOTION_API_CREDENTIALS_FILE,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Credential(NamedTuple):
+    """A Dailymotion API key pair
+
+    `name` tells its access token apart in cache, it is None for the single
+    key pair of the legacy file format so that its cache keys are unchanged.
+    """
+
+    key_id: str
+    key_secret: str
+    weight: int = 1
+    name: str | None = None
+
+
+def parse_credentials(creds: dict | list) -> list[Credential]:
+    """
+    File format is either a single key pair:
+    {
+        "DAILYMOTION_API_KEY_ID": <client_id>,
+        "DAILYMOTION_API_KEY_SECRET": <client_secret>
+    }
+    or a list of them, each with an optional weight and name, which tells the
+    key apart in stats and metrics and defaults to its position in the list,
+    not to disclose the client ID:
+    [
+        {
+            "DAILYMOTION_API_KEY_ID": <client_id>,
+            "DAILYMOTION_API_KEY_SECRET": <client_secret>,
+            "weight": <weight>,
+            "name": <name>
+        },
+        ...
+    ]"""
+
+    if isinstance(creds, dict):
+        return [
+            Credential(
+                creds["DAILYMOTION_API_KEY_ID"],
+                creds["DAILYMOTION_API_KEY_SECRET"],
+            )
+        ]
+
+    return [
+        Credential(
+            key_id=cred["DAILYMOTION_API_KEY_ID"],
+            key_secret=cred["DAILYMOTION_API_KEY_SECRET"],
+            weight=max(int(cred.get("weight", 1)), 1),
+            name=cred.get("name", f"key-{index}"),
+        )
+        for index, cred in enumerate(creds)
+    ]
+
+
+def load_credentials(credentials_filename: str) -> list[Credential]:
+    """Read the key pairs of a credentials file"""
+
+    with open(credentials_filename, "r", encoding="utf8") as fh:
+        return parse_credentials(json.load(fh))
+
+
+class CredentialPool:
+    """Key pairs of Dailymotion API that calls are spread across
+
+    Keys are picked by smooth weighted round-robin, so that each key gets a
+    share of the calls proportional to its weight, interleaved rather than in
+    bursts. A key throttled by Dailymotion API is left out of the rotation for
+    `throttle_cooldown` seconds, or as long as told by the API. When every key
+    is throttled, the one released the soonest is picked anyway.
+
+    The file is loaded on first use, then loaded again whenever its
+    modification time changes, checked at most every `reload_interval`
+    seconds. The previous keys are kept if it cannot be loaded.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        throttle_cooldown: float,
+        reload_interval: float,
+    ) -> None:
+        self.filename = filename
+        self.throttle_cooldown = throttle_cooldown
+        self.reload_interval = reload_interval
+        self._credentials: list[Credential] = []
+        self._mtime: float | None = None
+        self._checked_at: float | None = None
+        self._current_weights: dict[str | None, int] = {}
+        self._throttled_until: dict[str | None, float] = {}
+        self._selected: dict[str | None, int] = {}
+        self._throttled: dict[str | None, int] = {}
+
+    @property
+    def credentials(self) -> list[Credential]:
+        """Return the key pairs, loading the file again if it changed"""
+
+        self.reload_if_changed()
+
+        return self._credentials
+
+    def reload_if_changed(self) -> None:
+        """Load the file again if its modification time changed since the
+        last time it was loaded"""
+
+        now = time.monotonic()
+
+        if (
+            self._checked_at is not None
+            and now - self._checked_at < self.reload_interval
+        ):
+            return
+
+        self._checked_at = now
+
+        try:
+            mtime = os.stat(self.filename).st_mtime
+
+            if mtime == self._mtime:
+                return
+
+            credentials = load_credentials(self.filename)
+        except Exception as e:  # pylint: disable=broad-except
+            exception_type = type(e).__name__
+            exception_message = str(e)
+
+            logger.error(
+                "Failed to load dailymotion API credentials: "
+                "filename=%s, exception_type=%s, exception_message=%s",
+                self.filename,
+                exception_type,
+                exception_message,
+            )
+
+            return
+
+        self._mtime = mtime
+        self._credentials = credentials
+
+        logger.info(
+            "Loaded dailymotion API credentials: filename=%s, keys=%s",
+            self.filename,
+            len(credentials),
+        )
+
+    def select(self) -> Credential | None:
+        """Return the key pair the next call should use, if any"""
+
+        credentials = self.credentials
+
+        if not credentials:
+            return None
+
+        if len(credentials) == 1:
+            credential = credentials[0]
+        else:
+            now = time.monotonic()
+            available = [
+                credential
+                for credential in credentials
+                if self._throttled_until.get(credential.name, 0) <= now
+            ] or [
+                min(
+                    credentials,
+                    key=lambda credential: self._throttled_until.get(
+                        credential.name, 0
+                    ),
+                )
+            ]
+            credential = self._select_weighted(available)
+
+        self._selected[credential.name] = (
+            self._selected.get(credential.name, 0) + 1
+        )
+
+        return credential
+
+    def _select_weighted(self, credentials: list[Credential]) -> Credential:
+        total = 0
+        selected = credentials[0]
+
+        for credential in credentials:
+            current_weight = (
+                self._current_weights.get(credential.name, 0)
+                + credential.weight
+            )
+            self._current_weights[credential.name] = current_weight
+            total += credential.weight
+
+            if current_weight > self._current_weights[selected.name]:
+                selected = credential
+
+        self._current_weights[selected.name] -= total
+
+        return selected
+
+    def throttle(
+        self, name: str | None, retry_after: float | None = None
+    ) -> None:
+        """Leave a key out of the rotation for `retry_after` seconds, or for
+        the throttle cooldown"""
+
+        cooldown = (
+            self.throttle_cooldown if retry_after is None else retry_after
+        )
+        self._throttled_until[name] = time.monotonic() + cooldown
+        self._throttled[name] = self._throttled.get(name, 0) + 1
+
+        logger.warning(
+            "Dailymotion API key throttled: key=%s, cooldown=%s",
+            name,
+            cooldown,
+        )
+
+    def stats(self) -> dict[str, dict[str, int | bool]]:
+        """Return the weight, the number of calls and of throttles of each
+        key, and whether it is currently throttled"""
+
+        now = time.monotonic()
+
+        return {
+            credential.name
+            or "default": {
+                "weight": credential.weight,
+                "selected": self._selected.get(credential.name, 0),
+                "throttled": self._throttled.get(credential.name, 0),
+                "available": (
+                    self._throttled_until.get(credential.name, 0) <= now
+                ),
+            }
+            for credential in self.credentials
+        }
+
+
+credential_pool = CredentialPool(
+    DAILYMOTION_API_CREDENTIALS_FILE,
+    CREDENTIALS_THROTTLE_COOLDOWN,
+    CREDENTIALS_RELOAD_INTERVAL,
+)
@@ -0,0 +1,261 @@
+import ipaddress
+import time
+
+import aiohttp
+
+from fastapi import Depends, HTTPException, Request, status
+
+from dm_stream_urls_server.cache import Cache, TokenStore
+from dm_stream_urls_server.client_ip import (
+    PublicIpResolver,
+    get_forwarded_client_ip,
+    is_trusted_proxy,
+    parse_trusted_proxies,
+)
+from dm_stream_urls_server.config import (
+    PUBLIC_IP_TIMEOUT,
+    PUBLIC_IP_URL,
+    TRUSTED_PROXIES,
+)
+from dm_stream_urls_server.lookup import LookupContext
+from dm_stream_urls_server.metrics import (
+    access_token_phase_duration,
+    client_ip_phase_duration,
+)
+from dm_stream_urls_server.ratelimit import (
+    RateLimitExceededError,
+    TokenBucketLimiter,
+)
+from dm_stream_urls_server.response_cache import ResponseCache
+from dm_stream_urls_server.token import (
+    AccessToken,
+    get_dailymotion_api_access_token,
+)
+from dm_stream_urls_server.upstream import (
+    get_retry_after,
+    upstream_rate_limiter,
+)
+
+trusted_proxies = parse_trusted_proxies(TRUSTED_PROXIES)
+
+public_ip_resolver = PublicIpResolver(
+    url=PUBLIC_IP_URL,
+    timeout=PUBLIC_IP_TIMEOUT,
+)
+
+
+def get_http_session(request: Request) -> aiohttp.ClientSession:
+    """Helper for FastAPI to get the shared upstream HTTP session"""
+
+    http_session: aiohttp.ClientSession = request.app.state.http_session
+
+    return http_session
+
+
+def get_cache(request: Request) -> Cache | None:
+    """Helper for FastAPI to get the shared cache client"""
+
+    cache: Cache | None = request.app.state.cache
+
+    return cache
+
+
+def get_token_store(request: Request) -> TokenStore | None:
+    """Helper for FastAPI to get the shared access token store"""
+
+    token_store: TokenStore | None = request.app.state.token_store
+
+    return token_store
+
+
+def get_response_cache(request: Request) -> ResponseCache | None:
+    """Helper for FastAPI to get the stream URLs response cache, if enabled"""
+
+    response_cache: ResponseCache | None = request.app.state.response_cache
+
+    return response_cache
+
+
+def get_manifest_cache(request: Request) -> ResponseCache | None:
+    """Helper for FastAPI to get the HLS manifest cache, if enabled"""
+
+    manifest_cache: ResponseCache | None = request.app.state.manifest_cache
+
+    return manifest_cache
+
+
+def get_video_metadata_cache(request: Request) -> ResponseCache | None:
+    """Helper for FastAPI to get the cache of the video metadata"""
+
+    video_metadata_cache: ResponseCache | None = (
+        request.app.state.video_metadata_cache
+    )
+
+    return video_metadata_cache
+
+
+def get_rate_limiters(request: Request) -> tuple[TokenBucketLimiter, ...]:
+    """Helper for FastAPI to get the client, video and upstream rate
+    limiters"""
+
+    return (
+        request.app.state.client_rate_limiter,
+        request.app.state.video_rate_limiter,
+        upstream_rate_limiter,
+    )
+
+
+def is_response_cache_bypassed(request: Request) -> bool:
+    """Whether the client asked for fresh stream URLs with
+    `Cache-Control: no-cache`"""
+
+    return "no-cache" in request.headers.get("cache-control", "")
+
+
+async def get_connection_client_ip(
+    request: Request,
+    session: aiohttp.ClientSession = Depends(get_http_session),
+) -> str | None:
+    """Helper to get the IP address of the client from the connection
+
+    The address is read from forwarding headers when the request comes
+    through trusted proxies. Clients on a private network share the public IP
+    address of the server.
+    """
+
+    start = time.perf_counter()
+
+    try:
+        if request.client:
+            request_client_ip = request.client.host
+
+            if is_trusted_proxy(request_client_ip, trusted_proxies):
+                request_client_ip = get_forwarded_client_ip(
+                    request_client_ip,
+                    request.headers,
+                    trusted_proxies,
+                )
+
+            if ipaddress.ip_address(request_client_ip).is_private:
+                return await public_ip_resolver.get(session)
+
+            return request_client_ip
+
+        return None
+    finally:
+        client_ip_phase_duration.observe(time.perf_counter() - start)
+
+
+async def get_client_ip(
+    client_ip: str | None = None,
+    connection_client_ip: str | None = Depends(get_connection_client_ip),
+) -> str | None:
+    """Helper to get client IP address, the one given as `client_ip` query
+    parameter or else the one of the connection"""
+
+    return client_ip or connection_client_ip
+
+
+async def get_access_token(
+    cache: TokenStore = Depends(get_token_store),
+    session: aiohttp.ClientSession = Depends(get_http_session),
+) -> AccessToken:
+    """Helper for FastAPI to get cached access token, or to reject with a 503
+    when none can be had"""
+
+    start = time.perf_counter()
+
+    try:
+        access_token = await get_dailymotion_api_access_token(cache, session)
+    finally:
+        access_token_phase_duration.observe(time.perf_counter() - start)
+
+    if not access_token:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="No access token available",
+        )
+
+    return access_token
+
+
+async def get_lookup_context(  # pylint: disable=too-many-arguments
+    *,
+    client_ip: str = Depends(get_client_ip),
+    access_token: AccessToken = Depends(get_access_token),
+    session: aiohttp.ClientSession = Depends(get_http_session),
+    response_cache: ResponseCache | None = Depends(get_response_cache),
+    bypass_response_cache: bool = Depends(is_response_cache_bypassed),
+    video_metadata_cache: ResponseCache | None = Depends(
+        get_video_metadata_cache
+    ),
+) -> LookupContext:
+    """Helper for FastAPI to gather what the stream URLs lookups of a request
+    share, resolved once per request"""
+
+    return LookupContext(
+        session=session,
+        client_ip=client_ip,
+        access_token=access_token,
+        response_cache=response_cache,
+        bypass_response_cache=bypass_response_cache,
+        video_metadata_cache=video_metadata_cache,
+    )
+
+
+async def acquire_rate_limits(
+    request: Request,
+    client_ip: str | None,
+    video_ids: list[str],
+) -> None:
+    """Take a token from the bucket of the client for each requested video,
+    and one from the bucket of the video for the client, all at once, or
+    reject with a 429
+
+    A batch of more videos than the burst of the client takes a full bucket.
+
+    The client is the one of the connection, since the `client_ip` query
+    parameter is up to the client. Requests whose client IP address cannot be
+    resolved are not limited, rather than all sharing a single bucket.
+    """
+
+    if not client_ip:
+        return
+
+    client_rate_limiter: TokenBucketLimiter = (
+        request.app.state.client_rate_limiter
+    )
+    video_rate_limiter: TokenBucketLimiter = (
+        request.app.state.video_rate_limiter
+    )
+
+    try:
+        await TokenBucketLimiter.acquire_all(
+            [
+                (client_rate_limiter, client_ip, max(len(video_ids), 1)),
+                *(
+                    (video_rate_limiter, f"{client_ip}:{video_id}", 1)
+                    for video_id in video_ids
+                ),
+            ]
+        )
+    except RateLimitExceededError as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests",
+            headers={"Retry-After": get_retry_after(e)},
+        ) from e
+
+
+async def enforce_rate_limits(
+    request: Request,
+    client_ip: str | None = Depends(get_connection_client_ip),
+) -> None:
+    """Helper for FastAPI to reject with a 429 the requests of a client over
+    its rate limit, or over its rate limit for the requested video"""
+
+    video_id = request.query_params.get("video_id")
+
+    await acquire_rate_limits(
+        request, client_ip, [video_id] if video_id else []
+    )
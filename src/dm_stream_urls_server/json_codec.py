@@ -0,0 +1,46 @@
+import json
+
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore[assignment]
+
+JSON_CONTENT_TYPE = "application/json"
+
+
+def json_loads(data: bytes) -> Any:
+    """Decode JSON, with orjson when installed"""
+
+    if orjson:
+        return orjson.loads(data)  # pylint: disable=no-member
+
+    return json.loads(data)
+
+
+def json_dumps(content: Any) -> bytes:
+    """Encode JSON compactly, with orjson when installed"""
+
+    if orjson:
+        return orjson.dumps(content)  # pylint: disable=no-member
+
+    return json.dumps(
+        content,
+        ensure_ascii=False,
+        allow_nan=False,
+        separators=(",", ":"),
+    ).encode("utf8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response encoded with orjson when installed
+
+    Returned as is from a route, its content skips the generic
+    `jsonable_encoder` of FastAPI, hence it must only hold JSON types.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return json_dumps(content)
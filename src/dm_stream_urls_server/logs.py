@@ -0,0 +1,225 @@
+import copy
+import json
+import logging
+import queue
+import sys
+import time
+
+from logging.handlers import QueueHandler, QueueListener
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable lines, telling how many similar lines were suppressed
+    before a line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = super().format(record)
+
+        if suppressed := getattr(record, "suppressed", 0):
+            message += f" (suppressed={suppressed})"
+
+        return message
+
+
+class JSONFormatter(logging.Formatter):
+    """One compact JSON object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+
+        if suppressed := getattr(record, "suppressed", 0):
+            entry["suppressed"] = suppressed
+
+        return json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+
+
+class RateLimitFilter(
+    logging.Filter
+):  # pylint: disable=too-few-public-methods
+    """Let through at most `burst` records of a same message per `interval`
+    seconds, from `level` up
+
+    Records are told apart by logger, level and message template, i.e. before
+    their arguments are merged, so that the same failure of every request
+    counts as one message. The first record let through once a window is over
+    tells how many were dropped in it. A zero `interval` disables the filter.
+    """
+
+    def __init__(
+        self,
+        burst: int,
+        interval: float,
+        level: int = logging.WARNING,
+        max_keys: int = 1000,
+    ) -> None:
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.level = level
+        self.max_keys = max_keys
+        self.suppressed = 0
+        self._windows: dict[tuple[str, int, str], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.interval <= 0 or record.levelno < self.level:
+            return True
+
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        window = self._windows.get(key)
+
+        if window is None or now - window[0] >= self.interval:
+            if window and window[2]:
+                setattr(record, "suppressed", window[2])
+
+            if window is None and len(self._windows) >= self.max_keys:
+                self._windows.pop(next(iter(self._windows)), None)
+
+            self._windows[key] = [now, 1, 0]
+
+            return True
+
+        if window[1] < self.burst:
+            window[1] += 1
+
+            return True
+
+        window[2] += 1
+        self.suppressed += 1
+
+        return False
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """Hand records over to a thread writing them with `handler`, so that
+    logging never blocks the caller on I/O
+
+    Records are formatted by `handler` in that thread, only their message is
+    merged with its arguments, and their traceback rendered, by the caller.
+    """
+
+    def __init__(self, handler: logging.Handler) -> None:
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        super().__init__(log_queue)
+        self.listener = QueueListener(
+            log_queue, handler, respect_handler_level=True
+        )
+        self.listener.start()
+        self._exception_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Return a copy of the record that is safe to format from another
+        thread"""
+
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+
+        if record.exc_info:
+            record.exc_text = self._exception_formatter.formatException(
+                record.exc_info
+            )
+            record.exc_info = None
+
+        return record
+
+    def close(self) -> None:
+        """Write the pending records and stop the thread"""
+
+        # pylint: disable=protected-access
+        if self.listener._thread:
+            self.listener.stop()
+
+        super().close()
+
+
+def create_log_handler(
+    log_format: str,
+    queue_enabled: bool,
+) -> logging.Handler:
+    """Return a handler writing to stdout as text or JSON, from a background
+    thread if `queue_enabled`"""
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(
+        JSONFormatter() if log_format == "json" else TextFormatter(TEXT_FORMAT)
+    )
+
+    if queue_enabled:
+        return BackgroundQueueHandler(handler)
+
+    return handler
+
+
+def parse_log_levels(log_levels: str) -> dict[str, str]:
+    """Parse comma-separated `<logger>=<level>` pairs, `root` standing for
+    the root logger"""
+
+    levels = {}
+
+    for log_level in log_levels.split(","):
+        if not log_level.strip():
+            continue
+
+        name, _, level = log_level.partition("=")
+        levels[name.strip()] = level.strip().upper()
+
+    return levels
+
+
+def get_logging_config(  # pylint: disable=too-many-arguments
+    log_format: str,
+    log_levels: str,
+    queue_enabled: bool,
+    rate_limit_burst: int,
+    rate_limit_interval: float,
+) -> dict:
+    """Return the `logging.config.dictConfig` configuration of the package
+
+    Every logger, uvicorn ones included, writes through a single handler.
+    """
+
+    levels = {
+        "root": "DEBUG",
+        "asyncio": "INFO",
+        "dm_stream_urls_server": "DEBUG",
+        **parse_log_levels(log_levels),
+    }
+
+    return {
+        "version": 1,
+        "disable_existing_loggers": False,
+        "root": {
+            "level": levels.pop("root"),
+            "handlers": ["console"],
+        },
+        "filters": {
+            "rate_limit": {
+                "()": RateLimitFilter,
+                "burst": rate_limit_burst,
+                "interval": rate_limit_interval,
+            },
+        },
+        "handlers": {
+            "console": {
+                "()": create_log_handler,
+                "log_format": log_format,
+                "queue_enabled": queue_enabled,
+                "filters": ["rate_limit"],
+            },
+        },
+        "loggers": {name: {"level": level} for name, level in levels.items()},
+    }
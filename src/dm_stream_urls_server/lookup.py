@@ -0,0 +1,298 @@
+import asyncio
+import logging
+
+from collections.abc import Awaitable, Callable
+from typing import NamedTuple, NoReturn
+
+import aiohttp
+
+from fastapi import HTTPException, status
+
+from dm_stream_urls_server.config import (
+    NEGATIVE_CACHE_TTL,
+    RESPONSE_CACHE_STALE_IF_ERROR,
+    RESPONSE_CACHE_STALE_WHILE_REVALIDATE,
+)
+from dm_stream_urls_server.metrics import negative_cache_hits
+from dm_stream_urls_server.prefetch import (
+    UNAVAILABLE_VIDEO_STATUS_CODES,
+    get_video_metadata_cache_key,
+)
+from dm_stream_urls_server.ratelimit import RateLimitExceededError
+from dm_stream_urls_server.response_cache import (
+    ResponseCache,
+    StreamUrls,
+    get_response_cache_key,
+)
+from dm_stream_urls_server.singleflight import SingleFlight
+from dm_stream_urls_server.stream import get_stream_urls, get_stream_urls_body
+from dm_stream_urls_server.token import AccessToken
+from dm_stream_urls_server.upstream import (
+    CircuitOpenError,
+    get_retry_after,
+    is_upstream_failure,
+)
+
+logger = logging.getLogger(__name__)
+
+stream_urls_single_flight: SingleFlight[StreamUrls] = SingleFlight()
+
+revalidation_tasks: set[asyncio.Task] = set()
+
+# Statuses of Dailymotion API remembered by the negative cache, a 403 only for
+# the client IP address that got it
+NEGATIVE_CACHE_STATUS_CODES = (
+    *UNAVAILABLE_VIDEO_STATUS_CODES,
+    status.HTTP_403_FORBIDDEN,
+)
+
+
+class LookupContext(NamedTuple):
+    """Resources of a request shared by all its stream URLs lookups"""
+
+    session: aiohttp.ClientSession
+    client_ip: str
+    access_token: AccessToken
+    response_cache: ResponseCache | None = None
+    bypass_response_cache: bool = False
+    video_metadata_cache: ResponseCache | None = None
+
+
+async def lookup_stream_urls(  # pylint: disable=too-many-locals
+    context: LookupContext,
+    video_id: str,
+    video_formats: str,
+    pass_through: bool = False,
+) -> StreamUrls:
+    """Return the stream URLs of a video, turning failures into HTTP errors
+
+    In pass-through mode, the raw JSON body of Dailymotion API is returned
+    instead of the decoded stream URLs.
+
+    Responses are served from cache when enabled, unless the client bypasses
+    it, in which case the cache is refreshed. Stale responses are served
+    right away while they are refreshed in the background, or in place of an
+    error when Dailymotion API fails, if enabled. Concurrent identical lookups
+    share a single upstream call. While Dailymotion API is failing, lookups
+    fail fast with a 503. Videos whose metadata says that they cannot be
+    played are rejected without calling Dailymotion API, as are videos it
+    recently answered with a 404, or with a 403 for the same client, unless
+    the negative cache is disabled.
+    """
+
+    (
+        session,
+        client_ip,
+        access_token,
+        response_cache,
+        bypass_response_cache,
+        video_metadata_cache,
+    ) = context
+
+    response_cache_key = get_response_cache_key(
+        video_id, video_formats, client_ip, pass_through
+    )
+
+    def fetch_stream_urls() -> Awaitable[StreamUrls]:
+        return stream_urls_single_flight.do(
+            response_cache_key,
+            lambda: (
+                get_stream_urls_body if pass_through else get_stream_urls
+            )(
+                session=session,
+                video_id=video_id,
+                video_formats=video_formats,
+                client_ip=client_ip,
+                authorization=access_token.access_token,
+                key_name=access_token.key_name,
+            ),
+        )
+
+    stale_response = None
+
+    if response_cache and not bypass_response_cache:
+        if cached := await response_cache.get_entry(response_cache_key):
+            if not cached.stale:
+                return cached.response
+
+            if RESPONSE_CACHE_STALE_WHILE_REVALIDATE:
+                revalidate_in_background(
+                    response_cache, response_cache_key, fetch_stream_urls
+                )
+
+                return cached.response
+
+            stale_response = cached.response
+
+    if video_metadata_cache and NEGATIVE_CACHE_TTL:
+        await raise_if_video_unavailable(
+            video_metadata_cache, video_id, client_ip
+        )
+
+    try:
+        response = await fetch_stream_urls()
+    except Exception as e:  # pylint: disable=broad-except
+        if (
+            stale_response
+            and RESPONSE_CACHE_STALE_IF_ERROR
+            and (
+                is_upstream_failure(e)
+                or getattr(e, "status", None)
+                == status.HTTP_429_TOO_MANY_REQUESTS
+                or isinstance(e, (CircuitOpenError, RateLimitExceededError))
+            )
+        ):
+            logger.warning(
+                "Serving stale stream URLs: video_id=%s, exception_type=%s",
+                video_id,
+                type(e).__name__,
+            )
+
+            return stale_response
+
+        if video_metadata_cache and NEGATIVE_CACHE_TTL:
+            await cache_unavailable_video(
+                video_metadata_cache, video_id, client_ip, e
+            )
+
+        raise_stream_urls_error(e, client_ip, video_id, video_formats)
+
+    if response_cache:
+        await response_cache.set(response_cache_key, response)
+
+    return response
+
+
+async def raise_if_video_unavailable(
+    video_metadata_cache: ResponseCache,
+    video_id: str,
+    client_ip: str,
+) -> None:
+    """Raise the HTTP error of a video known to be unavailable, to everyone
+    or to the client IP address
+
+    Only called while the negative cache is enabled, which covers both the
+    statuses of every client and those of the client IP address.
+    """
+
+    keys = [
+        get_video_metadata_cache_key(video_id),
+        get_video_metadata_cache_key(video_id, client_ip),
+    ]
+
+    for metadata in await video_metadata_cache.get_many(keys):
+        if isinstance(metadata, dict) and (
+            metadata["status_code"] != status.HTTP_200_OK
+        ):
+            negative_cache_hits.labels(str(metadata["status_code"])).inc()
+
+            raise HTTPException(
+                status_code=metadata["status_code"],
+                detail="Video is unavailable",
+            )
+
+
+async def cache_unavailable_video(
+    video_metadata_cache: ResponseCache,
+    video_id: str,
+    client_ip: str,
+    e: Exception,
+) -> None:
+    """Remember for `NEGATIVE_CACHE_TTL` seconds that Dailymotion API
+    answered a lookup with a 404, or with a 403 for the client IP address"""
+
+    if not isinstance(e, aiohttp.ClientResponseError) or (
+        e.status not in NEGATIVE_CACHE_STATUS_CODES
+    ):
+        return
+
+    await video_metadata_cache.set(
+        get_video_metadata_cache_key(
+            video_id,
+            client_ip if e.status == status.HTTP_403_FORBIDDEN else None,
+        ),
+        {"status_code": e.status},
+        ttl=NEGATIVE_CACHE_TTL,
+    )
+
+
+def raise_stream_urls_error(
+    e: Exception,
+    client_ip: str,
+    video_id: str,
+    video_formats: str,
+) -> NoReturn:
+    """Turn a failed stream URLs lookup into an HTTP error"""
+
+    if isinstance(e, aiohttp.ClientResponseError):
+        raise HTTPException(
+            status_code=e.status,
+            detail=e.message,
+        ) from e
+
+    if isinstance(e, RateLimitExceededError):
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Dailymotion API rate limit reached",
+            headers={"Retry-After": get_retry_after(e)},
+        ) from e
+
+    if isinstance(e, CircuitOpenError):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Dailymotion API is unavailable",
+            headers={"Retry-After": get_retry_after(e)},
+        ) from e
+
+    exception_type = type(e).__name__
+    exception_message = str(e)
+
+    logger.error(
+        "Failed to get stream URL: "
+        "client_ip=%s, video_id=%s, video_formats=%s, "
+        "exception_type=%s, exception_message=%s",
+        client_ip,
+        video_id,
+        video_formats,
+        exception_type,
+        exception_message,
+    )
+
+    raise HTTPException(
+        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        detail="Internal server error",
+    ) from e
+
+
+def revalidate_in_background(
+    response_cache: ResponseCache,
+    response_cache_key: str,
+    fetch_stream_urls: Callable[[], Awaitable[StreamUrls]],
+) -> None:
+    """Refresh a stale cached response without making the client wait
+
+    The task is referenced until done so that it is not garbage collected.
+    """
+
+    async def revalidate() -> None:
+        try:
+            response = await fetch_stream_urls()
+        except Exception as e:  # pylint: disable=broad-except
+            exception_type = type(e).__name__
+            exception_message = str(e)
+
+            logger.warning(
+                "Failed to revalidate stream URLs: "
+                "key=%s, exception_type=%s, exception_message=%s",
+                response_cache_key,
+                exception_type,
+                exception_message,
+            )
+
+            return
+
+        await response_cache.set(response_cache_key, response)
+
+    task = asyncio.create_task(revalidate())
+    revalidation_tasks.add(task)
+    task.add_done_callback(revalidation_tasks.discard)
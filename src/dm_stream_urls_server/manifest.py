@@ -0,0 +1,125 @@
+import logging
+import re
+
+from collections.abc import AsyncIterator
+from urllib.parse import urljoin
+
+import aiohttp
+
+from dm_stream_urls_server.response_cache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_CACHE_KEY_PREFIX = "dailymotion_stream_manifest"
+MANIFEST_MEDIA_TYPE = "application/vnd.apple.mpegurl"
+
+# Whether the video is live is requested along with its HLS stream URL
+MANIFEST_VIDEO_FIELDS = "stream_hls_url,mode"
+
+URI_ATTRIBUTE_PATTERN = re.compile(rb'URI="([^"]*)"')
+
+VOD_MANIFEST_TAGS = (b"#EXT-X-ENDLIST", b"#EXT-X-PLAYLIST-TYPE:VOD")
+
+
+def get_manifest_cache_key(video_id: str, client_ip: str) -> str:
+    """Return the cache key of an HLS manifest, whose URIs are signed for
+    the client IP address"""
+
+    return f"{MANIFEST_CACHE_KEY_PREFIX}:{video_id}:{client_ip}"
+
+
+def is_vod_manifest(manifest: bytes | bytearray) -> bool:
+    """Whether an HLS manifest is a complete VOD playlist
+
+    Master playlists hold neither tag, hence they are considered live.
+    """
+
+    return any(tag in manifest for tag in VOD_MANIFEST_TAGS)
+
+
+def resolve_manifest_line(line: bytes, base_url: str) -> bytes:
+    """Make the URIs of an HLS manifest line absolute, so that the manifest
+    still resolves once served from another origin"""
+
+    if not line.strip():
+        return line
+
+    if line.startswith(b"#"):
+        return URI_ATTRIBUTE_PATTERN.sub(
+            lambda match: b'URI="%s"'
+            % resolve_manifest_uri(match.group(1), base_url),
+            line,
+        )
+
+    uri = line.rstrip(b"\r\n")
+
+    return resolve_manifest_uri(uri, base_url) + line[len(uri) :]
+
+
+def resolve_manifest_uri(uri: bytes, base_url: str) -> bytes:
+    """Resolve a manifest URI against the manifest URL"""
+
+    return urljoin(base_url, uri.decode("utf8")).encode("utf8")
+
+
+async def open_manifest(
+    session: aiohttp.ClientSession,
+    url: str,
+    timeout: float,
+) -> aiohttp.ClientResponse:
+    """Request an HLS manifest, returning as soon as its headers are read
+
+    The response must be released by the caller. `timeout` bounds the
+    connection and every read, not the whole transfer.
+    """
+
+    return await session.get(
+        url,
+        raise_for_status=True,
+        timeout=aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=timeout,
+            sock_read=timeout,
+        ),
+    )
+
+
+async def stream_manifest(  # pylint: disable=too-many-arguments
+    response: aiohttp.ClientResponse,
+    manifest_cache: ResponseCache | None,
+    key: str,
+    *,
+    live: bool | None,
+    live_ttl: float,
+    vod_ttl: float,
+    max_cached_size: int = 1 << 20,
+) -> AsyncIterator[bytes]:
+    """Stream an HLS manifest line by line with its URIs made absolute,
+    releasing the upstream response once done
+
+    A copy of the manifest is cached once fully streamed, for `live_ttl` or
+    `vod_ttl` seconds. Unless known, whether it is live is found out from its
+    content. Manifests larger than `max_cached_size` are not cached.
+    """
+
+    base_url = str(response.url)
+    manifest = bytearray()
+
+    try:
+        async for line in response.content:
+            line = resolve_manifest_line(line, base_url)
+
+            if manifest_cache and len(manifest) <= max_cached_size:
+                manifest += line
+
+            yield line
+    finally:
+        response.release()
+
+    if manifest_cache and len(manifest) <= max_cached_size:
+        if live is None:
+            live = not is_vod_manifest(manifest)
+
+        await manifest_cache.set(
+            key, bytes(manifest), live_ttl if live else vod_ttl
+        )
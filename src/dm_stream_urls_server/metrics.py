@@ -0,0 +1,303 @@
+import bisect
+import time
+
+from collections.abc import Callable, Iterable, Iterator
+from typing import Any
+
+Labels = tuple[str, ...]
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+
+def format_labels(labelnames: Labels, labelvalues: Labels) -> str:
+    """Return the Prometheus text representation of a set of labels"""
+
+    if not labelnames:
+        return ""
+
+    pairs = ",".join(
+        f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)
+    )
+
+    return f"{{{pairs}}}"
+
+
+class Counter:
+    """Monotonic counter, optionally broken down by labels
+
+    Children are created once per set of label values, so incrementing a
+    bound child on the hot path only updates a float.
+    """
+
+    type = "counter"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Labels = (),
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._children: dict[Labels, CounterChild] = {}
+
+    def labels(self, *labelvalues: str) -> "CounterChild":
+        """Return the child counter of a set of label values"""
+
+        if not (child := self._children.get(labelvalues)):
+            child = self._children[labelvalues] = CounterChild()
+
+        return child
+
+    def inc(self, amount: float = 1) -> None:
+        """Increment the counter without labels"""
+
+        self.labels().inc(amount)
+
+    def collect(self) -> Iterator[str]:
+        """Yield the samples of the counter"""
+
+        for labelvalues, child in self._children.items():
+            labels = format_labels(self.labelnames, labelvalues)
+
+            yield f"{self.name}{labels} {child.value}"
+
+
+class CounterChild:  # pylint: disable=too-few-public-methods
+    """Counter bound to a set of label values"""
+
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        """Increment the counter"""
+
+        self.value += amount
+
+
+class Histogram:
+    """Distribution of observed values in cumulative buckets, optionally
+    broken down by labels"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Labels = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._children: dict[Labels, HistogramChild] = {}
+
+    def labels(self, *labelvalues: str) -> "HistogramChild":
+        """Return the child histogram of a set of label values"""
+
+        if not (child := self._children.get(labelvalues)):
+            child = self._children[labelvalues] = HistogramChild(self.buckets)
+
+        return child
+
+    def observe(self, value: float) -> None:
+        """Observe a value without labels"""
+
+        self.labels().observe(value)
+
+    def collect(self) -> Iterator[str]:
+        """Yield the samples of the histogram"""
+
+        for labelvalues, child in self._children.items():
+            cumulative_count = 0
+
+            for upper_bound, count in zip(
+                (*self.buckets, "+Inf"), child.counts
+            ):
+                cumulative_count += count
+                labels = format_labels(
+                    (*self.labelnames, "le"),
+                    (*labelvalues, str(upper_bound)),
+                )
+
+                yield f"{self.name}_bucket{labels} {cumulative_count}"
+
+            labels = format_labels(self.labelnames, labelvalues)
+
+            yield f"{self.name}_sum{labels} {child.sum}"
+            yield f"{self.name}_count{labels} {cumulative_count}"
+
+
+class HistogramChild:  # pylint: disable=too-few-public-methods
+    """Histogram bound to a set of label values
+
+    Observing a value only increments a preallocated bucket count.
+    """
+
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """Observe a value"""
+
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class CallbackMetric:  # pylint: disable=too-few-public-methods
+    """Metric whose samples are computed at collection time, such as the
+    utilisation of a pool, so that it costs nothing on the request path"""
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        name: str,
+        documentation: str,
+        callback: Callable[[], Iterable[tuple[Labels, float | None]]],
+        labelnames: Labels = (),
+        metric_type: str = "gauge",
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labelnames = labelnames
+        self.type = metric_type
+
+    def collect(self) -> Iterator[str]:
+        """Yield the samples returned by the callback, skipping unknown
+        values"""
+
+        for labelvalues, value in self.callback():
+            if value is not None:
+                labels = format_labels(self.labelnames, labelvalues)
+
+                yield f"{self.name}{labels} {value}"
+
+
+Metric = Counter | Histogram | CallbackMetric
+
+
+class Registry:
+    """Collection of metrics exposed in the Prometheus text format"""
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Any:
+        """Register a metric, replacing any previous one of the same name"""
+
+        self._metrics[metric.name] = metric
+
+        return metric
+
+    def render(self) -> str:
+        """Return all the metrics in the Prometheus text format"""
+
+        lines = []
+
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.collect())
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_duration: Histogram = registry.register(
+    Histogram(
+        "dm_stream_urls_request_duration_seconds",
+        "Duration of the HTTP requests by route and status code",
+        labelnames=("route", "status_code"),
+    )
+)
+
+phase_duration: Histogram = registry.register(
+    Histogram(
+        "dm_stream_urls_phase_duration_seconds",
+        "Duration of each phase of a stream URLs lookup",
+        labelnames=("phase",),
+    )
+)
+
+upstream_responses: Counter = registry.register(
+    Counter(
+        "dm_stream_urls_upstream_responses_total",
+        "Responses of Dailymotion API by status code",
+        labelnames=("status_code",),
+    )
+)
+
+negative_cache_hits: Counter = registry.register(
+    Counter(
+        "dm_stream_urls_negative_cache_hits_total",
+        "Lookups of unavailable videos answered without calling Dailymotion "
+        "API, by status code",
+        labelnames=("status_code",),
+    )
+)
+
+client_ip_phase_duration = phase_duration.labels("client_ip")
+access_token_phase_duration = phase_duration.labels("access_token")
+upstream_phase_duration = phase_duration.labels("upstream")
+
+
+class MetricsMiddleware:  # pylint: disable=too-few-public-methods
+    """ASGI middleware observing the duration of the HTTP requests
+
+    Only the given routes are broken down, any other path is reported as
+    "other" so that the number of series stays bounded.
+    """
+
+    def __init__(self, app: Any, routes: Iterable[str]) -> None:
+        self.app = app
+        self.routes = frozenset(routes)
+
+    async def __call__(self, scope: dict, receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+
+            return
+
+        start = time.perf_counter()
+        status_code = "500"
+
+        async def send_and_capture_status(message: dict) -> None:
+            nonlocal status_code
+
+            if message["type"] == "http.response.start":
+                status_code = str(message["status"])
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_capture_status)
+        finally:
+            path = scope["path"]
+            route = path if path in self.routes else "other"
+
+            request_duration.labels(route, status_code).observe(
+                time.perf_counter() - start
+            )
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+
+from collections.abc import Awaitable, Iterable
+
+import aiohttp
+
+from fastapi import status
+
+from dm_stream_urls_server.cache import TokenStore
+from dm_stream_urls_server.config import NEGATIVE_CACHE_TTL
+from dm_stream_urls_server.json_codec import json_loads
+from dm_stream_urls_server.response_cache import ResponseCache
+from dm_stream_urls_server.session import warm_up_http_session
+from dm_stream_urls_server.stream import request_stream_urls
+from dm_stream_urls_server.token import (
+    AccessToken,
+    get_dailymotion_api_access_token,
+)
+
+logger = logging.getLogger(__name__)
+
+VIDEO_METADATA_KEY_PREFIX = "dailymotion_video_metadata"
+
+# Status of Dailymotion API meaning that a video cannot be played by anyone,
+# as opposed to failures of the call itself. A 403 is left out: videos may be
+# restricted by country, so it only applies to the IP address that got it,
+# the server one when prefetching.
+UNAVAILABLE_VIDEO_STATUS_CODES = (status.HTTP_404_NOT_FOUND,)
+
+
+def get_video_metadata_cache_key(
+    video_id: str,
+    client_ip: str | None = None,
+) -> str:
+    """Return the cache key of the metadata of a video, which is the same for
+    every client unless a client IP address is given"""
+
+    if client_ip:
+        return f"{VIDEO_METADATA_KEY_PREFIX}:{video_id}:{client_ip}"
+
+    return f"{VIDEO_METADATA_KEY_PREFIX}:{video_id}"
+
+
+async def request_video_metadata(
+    session: aiohttp.ClientSession,
+    video_id: str,
+    video_formats: str,
+    access_token: AccessToken,
+) -> dict:
+    """Return whether a video can be played and which of the formats it is
+    available in
+
+    Stream URLs are requested for the server IP address, to learn which
+    formats exist, and dropped: none of the returned metadata depends on the
+    client IP address.
+    """
+
+    formats = [
+        video_format.strip()
+        for video_format in video_formats.split(",")
+        if video_format.strip()
+    ]
+
+    try:
+        stream_urls = json_loads(
+            await request_stream_urls(
+                session,
+                video_id,
+                ",".join(formats),
+                None,
+                access_token.access_token,
+                key_name=access_token.key_name,
+            )
+        )
+    except aiohttp.ClientResponseError as e:
+        if e.status not in UNAVAILABLE_VIDEO_STATUS_CODES:
+            raise
+
+        return {"status_code": e.status, "formats": {}}
+
+    return {
+        "status_code": status.HTTP_200_OK,
+        "formats": {
+            video_format: bool(stream_urls.get(video_format))
+            for video_format in formats
+        },
+    }
+
+
+async def prefetch_video_metadata(  # pylint: disable=too-many-arguments
+    session: aiohttp.ClientSession,
+    video_metadata_cache: ResponseCache,
+    video_ids: Iterable[str],
+    video_formats: str,
+    access_token: AccessToken,
+    *,
+    concurrency: int,
+) -> list[dict]:
+    """Request and cache the metadata of videos ahead of their traffic
+
+    Each result holds the `video_id` along with either its metadata or the
+    `error` that prevented getting it. Only the status is cached, the formats
+    are only reported. Videos that cannot be played are cached by the
+    negative cache, for `NEGATIVE_CACHE_TTL` seconds, and not at all when it
+    is disabled, so that a video published right after is not blocked.
+    """
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def prefetch(video_id: str) -> dict:
+        async with semaphore:
+            try:
+                metadata = await request_video_metadata(
+                    session, video_id, video_formats, access_token
+                )
+            except Exception as e:  # pylint: disable=broad-except
+                exception_type = type(e).__name__
+                exception_message = str(e)
+
+                logger.warning(
+                    "Failed to prefetch video metadata: "
+                    "video_id=%s, exception_type=%s, exception_message=%s",
+                    video_id,
+                    exception_type,
+                    exception_message,
+                )
+
+                return {"video_id": video_id, "error": exception_type}
+
+        if metadata["status_code"] == status.HTTP_200_OK:
+            await video_metadata_cache.set(
+                get_video_metadata_cache_key(video_id),
+                {"status_code": metadata["status_code"]},
+            )
+        elif NEGATIVE_CACHE_TTL:
+            await video_metadata_cache.set(
+                get_video_metadata_cache_key(video_id),
+                {"status_code": metadata["status_code"]},
+                ttl=NEGATIVE_CACHE_TTL,
+            )
+
+        return {"video_id": video_id, **metadata}
+
+    return await asyncio.gather(
+        *(prefetch(video_id) for video_id in video_ids)
+    )
+
+
+async def warm_up(
+    cache: TokenStore | None,
+    session: aiohttp.ClientSession,
+    url: str,
+    connections: int,
+    timeout: float,
+) -> None:
+    """Open connections to Dailymotion API and load the access token, so
+    that the first requests do not pay for them
+
+    Failures are only logged, the app starting regardless.
+    """
+
+    warm_ups: list[Awaitable[object]] = [
+        warm_up_http_session(session, url, connections)
+    ]
+
+    if cache:
+        warm_ups.append(get_dailymotion_api_access_token(cache, session))
+
+    try:
+        await asyncio.wait_for(asyncio.gather(*warm_ups), timeout)
+    except Exception as e:  # pylint: disable=broad-except
+        exception_type = type(e).__name__
+        exception_message = str(e)
+
+        logger.warning(
+            "Failed to warm up: exception_type=%s, exception_message=%s",
+            exception_type,
+            exception_message,
+        )
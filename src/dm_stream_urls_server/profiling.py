@@ -0,0 +1,186 @@
+import asyncio
+import cProfile
+import marshal
+import pstats
+import sys
+import threading
+import time
+
+from collections import Counter
+from types import FrameType
+
+# Stack of the samples taken while the event loop runs no task, i.e. while it
+# waits for I/O or runs callbacks
+IDLE_TASK = "<idle>"
+
+PROFILE_FORMATS = ("collapsed", "pstats")
+
+# A single profile at a time: cProfile cannot run twice on the same thread,
+# and concurrent samplers would slow the process down for nothing
+profiling_lock = asyncio.Lock()
+
+
+class ProfilerBusyError(Exception):
+    """Raised when a profile is requested while another one is captured"""
+
+
+def format_frame(frame: FrameType) -> str:
+    """Return the `<module>:<function>` name of a frame"""
+
+    return f"{frame.f_globals.get('__name__')}:{frame.f_code.co_qualname}"
+
+
+def get_coroutine_name(coro: object) -> str:
+    """Return the qualified name of the coroutine of a task"""
+
+    return getattr(coro, "__qualname__", type(coro).__name__)
+
+
+def format_stack(frame: FrameType | None, task: asyncio.Task | None) -> str:
+    """Return a stack in the collapsed format, i.e. its frames from the
+    outermost one separated by semicolons, under the coroutine of the running
+    task"""
+
+    frames = []
+
+    while frame is not None:
+        frames.append(format_frame(frame))
+        frame = frame.f_back
+
+    frames.append(get_coroutine_name(task.get_coro()) if task else IDLE_TASK)
+
+    return ";".join(reversed(frames))
+
+
+def sample_stacks(
+    thread_id: int,
+    loop: asyncio.AbstractEventLoop,
+    seconds: float,
+    interval: float,
+) -> Counter[str]:
+    """Sample the stack of a thread running an event loop every `interval`
+    seconds for `seconds` seconds, counting the samples of each stack
+
+    Samples are taken on wall-clock time, so that time spent waiting, e.g.
+    on I/O or on the GIL, shows up as well as time spent computing.
+    """
+
+    samples: Counter[str] = Counter()
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        # pylint: disable=protected-access
+        if frame := sys._current_frames().get(thread_id):
+            samples[format_stack(frame, asyncio.current_task(loop))] += 1
+
+        del frame
+
+        time.sleep(interval)
+
+    return samples
+
+
+def format_collapsed_stacks(samples: Counter[str]) -> str:
+    """Render samples in the collapsed stacks format of flame graph tools,
+    one `<stack> <count>` line per stack"""
+
+    return "".join(
+        f"{stack} {count}\n" for stack, count in samples.most_common()
+    )
+
+
+async def profile_stacks(seconds: float, interval: float) -> str:
+    """Sample the stacks of the event loop thread from another thread for
+    `seconds` seconds and return them as collapsed stacks
+
+    Stacks are rooted at the coroutine of the task running when sampled.
+    Nothing is sampled outside of a profile.
+    """
+
+    async with acquire_profiling_lock():
+        samples = await asyncio.to_thread(
+            sample_stacks,
+            threading.get_ident(),
+            asyncio.get_running_loop(),
+            seconds,
+            interval,
+        )
+
+    return format_collapsed_stacks(samples)
+
+
+async def profile_calls(seconds: float) -> bytes:
+    """Profile every call made on the event loop thread for `seconds`
+    seconds with cProfile and return the stats in the `pstats` file format
+
+    The profiler is only set for the duration of the profile.
+    """
+
+    async with acquire_profiling_lock():
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+
+    return marshal.dumps(pstats.Stats(profiler).stats)  # type: ignore[attr-defined]
+
+
+def acquire_profiling_lock() -> asyncio.Lock:
+    """Return the profiling lock, unless already held
+
+    Raises `ProfilerBusyError` otherwise, rather than queueing profiles.
+    """
+
+    if profiling_lock.locked():
+        raise ProfilerBusyError("A profile is already being captured")
+
+    return profiling_lock
+
+
+def get_awaiting_location(coro: object) -> str:
+    """Return the innermost coroutine frame a coroutine is suspended in,
+    following the coroutines it awaits"""
+
+    location = "<unknown>"
+
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(
+            coro, "gi_frame", None
+        )
+
+        if frame is None:
+            break
+
+        location = f"{format_frame(frame)}:{frame.f_lineno}"
+        coro = getattr(coro, "cr_await", None) or getattr(
+            coro, "gi_yieldfrom", None
+        )
+
+    return location
+
+
+def get_pending_tasks_stats() -> list[dict]:
+    """Return the number of pending tasks of each coroutine, along with the
+    locations they are suspended at, most frequent first"""
+
+    stats: dict[str, dict] = {}
+
+    for task in asyncio.all_tasks():
+        coro = task.get_coro()
+        name = get_coroutine_name(coro)
+        coroutine_stats = stats.setdefault(
+            name, {"coroutine": name, "count": 0, "awaiting": Counter()}
+        )
+        coroutine_stats["count"] += 1
+        coroutine_stats["awaiting"][get_awaiting_location(coro)] += 1
+
+    return [
+        {**coroutine_stats, "awaiting": dict(coroutine_stats["awaiting"])}
+        for coroutine_stats in sorted(
+            stats.values(),
+            key=lambda coroutine_stats: -coroutine_stats["count"],
+        )
+    ]
@@ -0,0 +1,251 @@
+import logging
+import time
+
+from collections.abc import Iterable
+
+from redis.asyncio import Redis
+from redis.commands.core import AsyncScript
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_KEY_PREFIX = "dm_stream_urls_rate_limit"
+
+# Refill the buckets for the time elapsed since their last update, on the clock
+# of Redis so that nodes share it, then take `cost` tokens from each of them if
+# enough are left in all of them, or from none. Each bucket is given its
+# `rate`, `burst` and `cost` in turn. Return the index of the bucket the
+# longest to refill and the seconds to wait before enough tokens are left in
+# it, as a string since Lua numbers are truncated to integers in replies. The
+# buckets expire once they would be full again.
+ACQUIRE_TOKENS_SCRIPT = """
+local clock = redis.call("time")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local buckets = {}
+local rejected = 0
+local retry_after = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 3 - 2])
+    local burst = tonumber(ARGV[i * 3 - 1])
+    local cost = tonumber(ARGV[i * 3])
+    local bucket = redis.call("hmget", key, "tokens", "updated_at")
+    local tokens = tonumber(bucket[1]) or burst
+    local updated_at = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(now - updated_at, 0) * rate)
+    if tokens < cost and (cost - tokens) / rate > retry_after then
+        rejected = i - 1
+        retry_after = (cost - tokens) / rate
+    end
+    buckets[i] = {tokens, rate, burst, cost}
+end
+for i, key in ipairs(KEYS) do
+    local tokens, rate, burst, cost = unpack(buckets[i])
+    if retry_after == 0 then
+        tokens = tokens - cost
+    end
+    redis.call("hset", key, "tokens", tokens, "updated_at", now)
+    redis.call("pexpire", key, math.ceil((burst - tokens) / rate * 1000) + 1)
+end
+return {rejected, tostring(retry_after)}
+"""
+
+# Tokens to take from the bucket of a key of a limiter
+Acquisition = tuple["TokenBucketLimiter", str, float]
+
+
+class RateLimitExceededError(Exception):
+    """Raised when a call is over its rate limit"""
+
+    def __init__(self, scope: str, retry_after: float) -> None:
+        super().__init__(f"Rate limit of {scope} exceeded")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class TokenBucketLimiter:
+    """Token buckets limiting the rate of calls per key, in memory with an
+    optional Redis tier
+
+    Every bucket holds up to `burst` tokens and is refilled with `rate`
+    tokens per second, a call taking one token. Buckets are kept in memory,
+    the least recently created ones being dropped beyond `max_keys`, which
+    only resets them to full. When Redis is given, buckets are updated there
+    by a Lua script instead, so that the limits hold across workers and
+    nodes, falling back to memory while Redis fails. A zero `rate` disables
+    the limiter.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        burst: float,
+        cache: Redis | None = None,
+        max_keys: int = 100000,
+    ) -> None:
+        self.name = name
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_keys = max_keys
+        self.rejected = 0
+        self._buckets: dict[str, tuple[float, float]] = {}
+        self.script: AsyncScript | None = None
+        self.use_cache(cache)
+
+    def use_cache(self, cache: Redis | None) -> None:
+        """Update the buckets in Redis rather than in memory, if given"""
+
+        self.script = (
+            cache.register_script(ACQUIRE_TOKENS_SCRIPT) if cache else None
+        )
+
+    @property
+    def enabled(self) -> bool:
+        """Whether calls are limited"""
+
+        return self.rate > 0
+
+    async def acquire(self, key: str, cost: float = 1) -> None:
+        """Take `cost` tokens from the bucket of `key`
+
+        Raises `RateLimitExceededError` with the seconds to wait before
+        enough tokens are left otherwise.
+        """
+
+        await self.acquire_all([(self, key, cost)])
+
+    @staticmethod
+    async def acquire_all(acquisitions: Iterable[Acquisition]) -> None:
+        """Take tokens from the buckets of several keys, of one or several
+        limiters, all at once: from every bucket if enough tokens are left in
+        all of them, or from none
+
+        A cost above the `burst` of its limiter is capped at it, since the
+        bucket never holds more. Buckets are updated in Redis when every
+        limiter has a Redis tier, the one of the first limiter, in memory
+        otherwise.
+
+        Raises `RateLimitExceededError` for the bucket the longest to refill
+        otherwise.
+        """
+
+        costs: dict[tuple[TokenBucketLimiter, str], float] = {}
+
+        for limiter, key, cost in acquisitions:
+            if limiter.enabled:
+                costs[limiter, key] = costs.get((limiter, key), 0) + cost
+
+        if not costs:
+            return
+
+        buckets = [
+            (limiter, key, min(cost, limiter.burst))
+            for (limiter, key), cost in costs.items()
+        ]
+        rejection = None
+
+        if all(limiter.script for limiter, _, _ in buckets):
+            rejection = await TokenBucketLimiter._acquire_from_cache(buckets)
+
+        if rejection is None:
+            rejection = TokenBucketLimiter._acquire_in_memory(buckets)
+
+        index, retry_after = rejection
+
+        if retry_after > 0:
+            limiter = buckets[index][0]
+            limiter.rejected += 1
+
+            raise RateLimitExceededError(limiter.name, retry_after)
+
+    @staticmethod
+    def _acquire_in_memory(
+        buckets: list[Acquisition],
+    ) -> tuple[int, float]:
+        now = time.monotonic()
+        tokens = [limiter.refill(key, now) for limiter, key, _ in buckets]
+        rejected, retry_after = 0, 0.0
+
+        for i, ((limiter, _, cost), bucket_tokens) in enumerate(
+            zip(buckets, tokens)
+        ):
+            if (cost - bucket_tokens) / limiter.rate > retry_after:
+                rejected, retry_after = (
+                    i,
+                    (cost - bucket_tokens) / limiter.rate,
+                )
+
+        for (limiter, key, cost), bucket_tokens in zip(buckets, tokens):
+            limiter.update(
+                key,
+                bucket_tokens if retry_after else bucket_tokens - cost,
+                now,
+            )
+
+        return rejected, retry_after
+
+    @staticmethod
+    async def _acquire_from_cache(
+        buckets: list[Acquisition],
+    ) -> tuple[int, float] | None:
+        script = buckets[0][0].script
+        assert script  # nosec
+
+        try:
+            rejected, retry_after = await script(
+                keys=[
+                    f"{RATE_LIMIT_KEY_PREFIX}:{limiter.name}:{key}"
+                    for limiter, key, _ in buckets
+                ],
+                args=[
+                    arg
+                    for limiter, _, cost in buckets
+                    for arg in (limiter.rate, limiter.burst, cost)
+                ],
+            )
+        except Exception as e:  # pylint: disable=broad-except
+            exception_type = type(e).__name__
+            exception_message = str(e)
+
+            logger.warning(
+                "Failed to acquire rate limit tokens from cache: "
+                "limiters=%s, exception_type=%s, exception_message=%s",
+                ",".join(sorted({limiter.name for limiter, _, _ in buckets})),
+                exception_type,
+                exception_message,
+            )
+
+            return None
+
+        return int(rejected), float(retry_after)
+
+    def refill(self, key: str, now: float) -> float:
+        """Return the tokens in the bucket of `key` at `now`, on the monotonic
+        clock, a bucket being full until first used"""
+
+        if bucket := self._buckets.get(key):
+            tokens, updated_at = bucket
+
+            return min(self.burst, tokens + (now - updated_at) * self.rate)
+
+        return self.burst
+
+    def update(self, key: str, tokens: float, now: float) -> None:
+        """Set the tokens left in the bucket of `key` at `now`, dropping the
+        least recently created bucket beyond `max_keys`"""
+
+        if key not in self._buckets and len(self._buckets) >= self.max_keys:
+            del self._buckets[next(iter(self._buckets))]
+
+        self._buckets[key] = (tokens, now)
+
+    def stats(self) -> dict[str, int | float]:
+        """Return the rate, the number of calls rejected and the number of
+        buckets in memory"""
+
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "rejected": self.rejected,
+            "buckets": len(self._buckets),
+        }
@@ -0,0 +1,321 @@
+import json
+import logging
+import time
+
+from collections import OrderedDict
+from typing import NamedTuple
+
+from dm_stream_urls_server.cache import Cache
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_KEY_PREFIX = "dailymotion_stream_urls"
+
+# Either decoded, or the raw JSON body in pass-through mode
+StreamUrls = dict | bytes
+
+
+def get_response_cache_key(
+    video_id: str,
+    video_formats: str,
+    client_ip: str,
+    pass_through: bool = False,
+) -> str:
+    """Return the cache key of a stream URLs response
+
+    Formats are normalised so that "a,b" and "b, a" share the same entry.
+    Raw bodies of the pass-through mode are kept apart from decoded
+    responses.
+    """
+
+    formats = ",".join(
+        sorted(
+            {
+                video_format.strip()
+                for video_format in video_formats.split(",")
+                if video_format.strip()
+            }
+        )
+    )
+
+    prefix = RESPONSE_CACHE_KEY_PREFIX
+
+    if pass_through:
+        prefix = f"{prefix}_body"
+
+    return f"{prefix}:{video_id}:{formats}:{client_ip}"
+
+
+class CachedResponse(NamedTuple):
+    """Cached stream URLs response, stale once past its TTL"""
+
+    response: StreamUrls
+    stale: bool
+
+
+class ResponseCache:
+    """In-process LRU of stream URLs responses with a TTL, optionally backed
+    by the shared Redis cache
+
+    Responses are either decoded or raw JSON bodies, the latter being stored
+    as strings in Redis.
+
+    Stream URLs are signed for a limited lifetime, hence the TTL of an entry
+    never exceeds it. Past its TTL, an entry is kept `stale_ttl` more seconds
+    so that it can still be served while it is being refreshed or when
+    Dailymotion API fails.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl: float,
+        cache: Cache | None = None,
+        stale_ttl: float = 0,
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.cache = cache
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, float, StreamUrls]] = (
+            OrderedDict()
+        )
+
+    async def get(self, key: str) -> StreamUrls | None:
+        """Return the cached response unless it is stale"""
+
+        if (cached := await self.get_entry(key)) and not cached.stale:
+            return cached.response
+
+        return None
+
+    async def get_many(self, keys: list[str]) -> list[StreamUrls | None]:
+        """Return the cached responses unless they are stale, reading those
+        missing from memory from Redis in a single round-trip"""
+
+        responses: list[StreamUrls | None] = [None] * len(keys)
+        missing = []
+
+        for index, key in enumerate(keys):
+            if cached := self._get_from_memory(key):
+                if not cached.stale:
+                    responses[index] = cached.response
+            else:
+                missing.append(index)
+
+        if self.cache and missing:
+            values = await self._read_many_from_cache(
+                [keys[index] for index in missing]
+            )
+
+            for index, cached_value in zip(missing, values):
+                if cached_value:
+                    ttl, stale_ttl, response = cached_value
+                    self._store_in_memory(
+                        keys[index], response, ttl, stale_ttl
+                    )
+
+                    if not self._count_hit(response, ttl <= 0).stale:
+                        responses[index] = response
+                else:
+                    self.misses += 1
+        else:
+            self.misses += len(missing)
+
+        return responses
+
+    async def get_entry(self, key: str) -> CachedResponse | None:
+        """Return the cached response along with whether it is stale, from
+        memory first then from Redis"""
+
+        if cached_response := self._get_from_memory(key):
+            return cached_response
+
+        if self.cache and (cached := await self._read_from_cache(key)):
+            ttl, stale_ttl, response = cached
+            self._store_in_memory(key, response, ttl, stale_ttl)
+
+            return self._count_hit(response, ttl <= 0)
+
+        self.misses += 1
+
+        return None
+
+    async def set(
+        self,
+        key: str,
+        response: StreamUrls,
+        ttl: float | None = None,
+    ) -> None:
+        """Cache a response in memory and in Redis, for `ttl` seconds rather
+        than the default TTL if given"""
+
+        if ttl is None:
+            ttl = self.ttl
+
+        self._store_in_memory(key, response, ttl, self.stale_ttl)
+
+        if self.cache:
+            await self._write_to_cache(key, response, ttl)
+
+    def stats(self) -> dict[str, int]:
+        """Return the hit/miss counters and the number of entries in memory"""
+
+        return {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+        }
+
+    def _get_from_memory(self, key: str) -> CachedResponse | None:
+        if entry := self._entries.get(key):
+            fresh_until, stale_until, response = entry
+            now = time.monotonic()
+
+            if now < stale_until:
+                self._entries.move_to_end(key)
+
+                return self._count_hit(response, now >= fresh_until)
+
+            del self._entries[key]
+
+        return None
+
+    def _count_hit(self, response: StreamUrls, stale: bool) -> CachedResponse:
+        if stale:
+            self.stale_hits += 1
+        else:
+            self.hits += 1
+
+        return CachedResponse(response, stale)
+
+    def _store_in_memory(
+        self,
+        key: str,
+        response: StreamUrls,
+        ttl: float,
+        stale_ttl: float,
+    ) -> None:
+        fresh_until = time.monotonic() + ttl
+        self._entries[key] = (fresh_until, fresh_until + stale_ttl, response)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def _read_from_cache(
+        self, key: str
+    ) -> tuple[float, float, StreamUrls] | None:
+        """Return the cached response along with its remaining TTL, negative
+        once stale, and its remaining stale TTL
+
+        The expiry is stored with the response since it is shared across
+        nodes, whose monotonic clocks differ.
+        """
+
+        assert self.cache  # nosec
+
+        try:
+            return self._parse_cached_response(await self.cache.get(key))
+        except Exception as e:  # pylint: disable=broad-except
+            exception_type = type(e).__name__
+            exception_message = str(e)
+
+            logger.warning(
+                "Failed to get stream URLs from cache: "
+                "key=%s, exception_type=%s, exception_message=%s",
+                key,
+                exception_type,
+                exception_message,
+            )
+
+        return None
+
+    async def _read_many_from_cache(
+        self, keys: list[str]
+    ) -> list[tuple[float, float, StreamUrls] | None]:
+        """Same as `_read_from_cache` for several keys, with a single MGET"""
+
+        assert self.cache  # nosec
+
+        try:
+            return [
+                self._parse_cached_response(cached_response)
+                for cached_response in await self.cache.mget(keys)
+            ]
+        except Exception as e:  # pylint: disable=broad-except
+            exception_type = type(e).__name__
+            exception_message = str(e)
+
+            logger.warning(
+                "Failed to get stream URLs from cache: "
+                "keys=%s, exception_type=%s, exception_message=%s",
+                keys,
+                exception_type,
+                exception_message,
+            )
+
+        return [None] * len(keys)
+
+    @staticmethod
+    def _parse_cached_response(
+        cached_response: bytes | str | None,
+    ) -> tuple[float, float, StreamUrls] | None:
+        if cached_response:
+            cached = json.loads(cached_response)
+            now = time.time()
+            ttl = cached["expires_at"] - now
+            stale_ttl = cached.get("stale_until", 0) - now
+
+            if ttl > 0 or stale_ttl > 0:
+                response: StreamUrls = (
+                    cached["body"].encode("utf8")
+                    if "body" in cached
+                    else cached["response"]
+                )
+
+                return ttl, max(stale_ttl - ttl, 0), response
+
+        return None
+
+    async def _write_to_cache(
+        self,
+        key: str,
+        response: StreamUrls,
+        ttl: float,
+    ) -> None:
+        assert self.cache  # nosec
+
+        try:
+            expires_at = time.time() + ttl
+
+            await self.cache.set(
+                key,
+                json.dumps(
+                    {
+                        "expires_at": expires_at,
+                        "stale_until": expires_at + self.stale_ttl,
+                        **(
+                            {"body": response.decode("utf8")}
+                            if isinstance(response, bytes)
+                            else {"response": response}
+                        ),
+                    }
+                ),
+                px=int((ttl + self.stale_ttl) * 1000),
+            )
+        except Exception as e:  # pylint: disable=broad-except
+            exception_type = type(e).__name__
+            exception_message = str(e)
+
+            logger.warning(
+                "Failed to cache stream URLs: "
+                "key=%s, exception_type=%s, exception_message=%s",
+                key,
+                exception_type,
+                exception_message,
+            )
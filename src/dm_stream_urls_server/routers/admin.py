@@ -0,0 +1,160 @@
+import secrets
+
+import aiohttp
+
+from fastapi import (
+    APIRouter,
+    Depends,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    status,
+)
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+
+from dm_stream_urls_server.config import (
+    ADMIN_TOKEN,
+    PREFETCH_CONCURRENCY,
+    PROFILE_MAX_SECONDS,
+    PROFILE_SAMPLE_INTERVAL,
+)
+from dm_stream_urls_server.dependencies import (
+    get_access_token,
+    get_http_session,
+    get_video_metadata_cache,
+)
+from dm_stream_urls_server.json_codec import FastJSONResponse
+from dm_stream_urls_server.prefetch import prefetch_video_metadata
+from dm_stream_urls_server.profiling import (
+    PROFILE_FORMATS,
+    ProfilerBusyError,
+    get_pending_tasks_stats,
+    profile_calls,
+    profile_stacks,
+)
+from dm_stream_urls_server.response_cache import ResponseCache
+from dm_stream_urls_server.token import AccessToken
+
+
+def require_admin_token(request: Request) -> None:
+    """Helper for FastAPI to only let requests bearing `ADMIN_TOKEN` through
+    to the admin routes, which do not exist without it"""
+
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
+    if not secrets.compare_digest(
+        request.headers.get("authorization", ""), f"Bearer {ADMIN_TOKEN}"
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid admin token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
+router = APIRouter(
+    prefix="/admin",
+    dependencies=[Depends(require_admin_token)],
+)
+
+
+class PrefetchRequest(BaseModel):
+    """Videos whose metadata is prefetched ahead of expected traffic"""
+
+    video_ids: list[str]
+    video_formats: str
+
+
+@router.post("/prefetch")
+async def prefetch_route(
+    prefetch: PrefetchRequest,
+    access_token: AccessToken = Depends(get_access_token),
+    session: aiohttp.ClientSession = Depends(get_http_session),
+    video_metadata_cache: ResponseCache = Depends(get_video_metadata_cache),
+):
+    """Prefetch whether videos can be played, shared with every node through
+    Redis when `VIDEO_METADATA_REDIS_ENABLED`, and report the formats they
+    are available in
+
+    Stream URLs are bound to the client IP address, hence they are not
+    prefetched.
+    """
+
+    return FastJSONResponse(
+        {
+            "results": await prefetch_video_metadata(
+                session,
+                video_metadata_cache,
+                prefetch.video_ids,
+                prefetch.video_formats,
+                access_token,
+                concurrency=PREFETCH_CONCURRENCY,
+            ),
+        }
+    )
+
+
+@router.get("/profile")
+async def profile_route(
+    seconds: float = 5,
+    output_format: str = Query("collapsed", alias="format"),
+):
+    """Profile the event loop of this process for `seconds` seconds
+
+    The `collapsed` format holds the stacks sampled on wall-clock time, rooted
+    at the coroutine of the task running when sampled, for flame graph tools.
+    The `pstats` format holds the stats of every call made, for
+    `python -m pstats` or snakeviz. Requests are served meanwhile, slowed down
+    by the profiler, which only runs for the duration of the profile.
+    """
+
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Profiles last at most {PROFILE_MAX_SECONDS} seconds",
+        )
+
+    if output_format not in PROFILE_FORMATS:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Profile format is one of {', '.join(PROFILE_FORMATS)}",
+        )
+
+    try:
+        if output_format == "pstats":
+            return Response(
+                content=await profile_calls(seconds),
+                media_type="application/octet-stream",
+                headers={
+                    "Content-Disposition": (
+                        'attachment; filename="profile.pstats"'
+                    ),
+                },
+            )
+
+        return PlainTextResponse(
+            await profile_stacks(seconds, PROFILE_SAMPLE_INTERVAL)
+        )
+    except ProfilerBusyError as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e),
+        ) from e
+
+
+@router.get("/tasks")
+async def tasks_route():
+    """Return the pending asyncio tasks of this process, counted by coroutine
+    and by the location they are suspended at"""
+
+    tasks = get_pending_tasks_stats()
+
+    return FastJSONResponse(
+        {
+            "pending": sum(coroutine["count"] for coroutine in tasks),
+            "coroutines": tasks,
+        }
+    )
@@ -0,0 +1,85 @@
+import asyncio
+
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from pydantic import BaseModel, Field
+
+from dm_stream_urls_server.config import (
+    STREAM_URLS_BATCH_CONCURRENCY,
+    STREAM_URLS_BATCH_MAX_SIZE,
+)
+from dm_stream_urls_server.dependencies import (
+    acquire_rate_limits,
+    get_connection_client_ip,
+    get_lookup_context,
+)
+from dm_stream_urls_server.json_codec import FastJSONResponse
+from dm_stream_urls_server.lookup import LookupContext, lookup_stream_urls
+
+router = APIRouter()
+
+
+class StreamUrlsBatchRequest(BaseModel):
+    """Videos whose stream URLs are requested in a single call
+
+    Oversized batches are rejected with a 422 when the body is validated,
+    before any rate limit token is taken.
+    """
+
+    video_ids: list[str] = Field(max_length=STREAM_URLS_BATCH_MAX_SIZE)
+    video_formats: str
+
+
+async def enforce_batch_rate_limits(
+    request: Request,
+    batch: StreamUrlsBatchRequest,
+    client_ip: str | None = Depends(get_connection_client_ip),
+) -> None:
+    """Helper for FastAPI to reject with a 429 the batches of a client over
+    its rate limit, counting each video of the batch"""
+
+    await acquire_rate_limits(request, client_ip, batch.video_ids)
+
+
+@router.post(
+    "/stream-urls/batch",
+    dependencies=[Depends(enforce_batch_rate_limits)],
+)
+async def get_stream_urls_batch_route(
+    batch: StreamUrlsBatchRequest,
+    context: LookupContext = Depends(get_lookup_context),
+):
+    """Request Dailymotion API to get the stream URLs of several videos
+
+    The client IP address and the access token are resolved once for the
+    whole batch, then videos are looked up concurrently. Each result holds
+    either the stream URLs or the error of its video.
+    """
+
+    semaphore = asyncio.Semaphore(STREAM_URLS_BATCH_CONCURRENCY)
+
+    async def lookup(video_id: str) -> dict:
+        async with semaphore:
+            try:
+                stream_urls = await lookup_stream_urls(
+                    context, video_id, batch.video_formats
+                )
+            except HTTPException as e:
+                return {
+                    "video_id": video_id,
+                    "status_code": e.status_code,
+                    "detail": e.detail,
+                }
+
+        return {
+            "video_id": video_id,
+            "status_code": status.HTTP_200_OK,
+            "stream_urls": stream_urls,
+        }
+
+    return FastJSONResponse(
+        {
+            "results": await asyncio.gather(
+                *(lookup(video_id) for video_id in batch.video_ids)
+            ),
+        }
+    )
@@ -0,0 +1,93 @@
+import asyncio
+
+import aiohttp
+
+from fastapi import APIRouter, Depends, HTTPException, Response, status
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+
+from dm_stream_urls_server.config import (
+    MANIFEST_CACHE_LIVE_TTL,
+    MANIFEST_CACHE_VOD_TTL,
+    MANIFEST_TIMEOUT,
+)
+from dm_stream_urls_server.dependencies import (
+    enforce_rate_limits,
+    get_lookup_context,
+    get_manifest_cache,
+)
+from dm_stream_urls_server.lookup import LookupContext, lookup_stream_urls
+from dm_stream_urls_server.manifest import (
+    MANIFEST_MEDIA_TYPE,
+    MANIFEST_VIDEO_FIELDS,
+    get_manifest_cache_key,
+    open_manifest,
+    stream_manifest,
+)
+from dm_stream_urls_server.response_cache import ResponseCache
+
+router = APIRouter()
+
+
+@router.get("/stream-manifest", dependencies=[Depends(enforce_rate_limits)])
+async def get_stream_manifest_route(
+    video_id: str,
+    context: LookupContext = Depends(get_lookup_context),
+    manifest_cache: ResponseCache | None = Depends(get_manifest_cache),
+):
+    """Stream the HLS manifest of a video back, sparing the client a
+    round-trip and cross-origin requests
+
+    The manifest is streamed as it is received, with its URIs made absolute.
+    When enabled, it is cached for a short time if the video is live and
+    longer otherwise. The upstream response is released once the manifest
+    is sent, even if streaming never started.
+    """
+
+    manifest_cache_key = get_manifest_cache_key(video_id, context.client_ip)
+
+    if manifest_cache and not context.bypass_response_cache:
+        if manifest := await manifest_cache.get(manifest_cache_key):
+            return Response(content=manifest, media_type=MANIFEST_MEDIA_TYPE)
+
+    stream_urls = await lookup_stream_urls(
+        context, video_id, MANIFEST_VIDEO_FIELDS
+    )
+
+    assert isinstance(stream_urls, dict)  # nosec
+
+    if not (manifest_url := stream_urls.get("stream_hls_url")):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No HLS stream for this video",
+        )
+
+    try:
+        manifest_response = await open_manifest(
+            context.session, manifest_url, MANIFEST_TIMEOUT
+        )
+    except aiohttp.ClientResponseError as e:
+        raise HTTPException(
+            status_code=e.status,
+            detail=e.message,
+        ) from e
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail="Failed to get HLS manifest",
+        ) from e
+
+    mode = stream_urls.get("mode")
+
+    return StreamingResponse(
+        stream_manifest(
+            manifest_response,
+            manifest_cache,
+            manifest_cache_key,
+            live=None if mode is None else mode == "live",
+            live_ttl=MANIFEST_CACHE_LIVE_TTL,
+            vod_ttl=MANIFEST_CACHE_VOD_TTL,
+        ),
+        media_type=MANIFEST_MEDIA_TYPE,
+        background=BackgroundTask(manifest_response.release),
+    )
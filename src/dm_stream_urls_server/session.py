@@ -0,0 +1,47 @@
+import asyncio
+
+import aiohttp
+
+from dm_stream_urls_server.config import (
+    HTTP_CONNECTION_LIMIT,
+    HTTP_CONNECTION_LIMIT_PER_HOST,
+    HTTP_DNS_CACHE_TTL,
+    HTTP_KEEPALIVE_TIMEOUT,
+)
+
+
+def create_http_session() -> aiohttp.ClientSession:
+    """Return an HTTP client session backed by a keep-alive connection pool
+
+    The session is meant to live as long as the application: connections to
+    Dailymotion API are reused across requests instead of paying a new TCP +
+    TLS handshake for every call, and DNS resolutions are cached.
+    """
+
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_CONNECTION_LIMIT,
+        limit_per_host=HTTP_CONNECTION_LIMIT_PER_HOST,
+        use_dns_cache=True,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+    )
+
+    return aiohttp.ClientSession(connector=connector)
+
+
+async def warm_up_http_session(
+    session: aiohttp.ClientSession,
+    url: str,
+    connections: int,
+) -> None:
+    """Open connections to the host of `url` ahead of the first requests
+
+    Requests are made concurrently so that each of them opens its own
+    connection, which is then kept alive in the pool.
+    """
+
+    async def request() -> None:
+        async with session.head(url) as response:
+            await response.read()
+
+    await asyncio.gather(*(request() for _ in range(connections)))
@@ -0,0 +1,52 @@
+import asyncio
+
+from collections.abc import Awaitable, Callable
+from typing import Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight(Generic[T]):
+    """Share a single in-flight call between concurrent callers of the same
+    key
+
+    The call runs in its own task so that a caller being cancelled (e.g. a
+    client disconnecting) does not cancel it for the other callers. Its result
+    or exception is propagated to every caller.
+    """
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.collapsed = 0
+        self._tasks: dict[str, asyncio.Task[T]] = {}
+
+    async def do(self, key: str, call: Callable[[], Awaitable[T]]) -> T:
+        """Return the result of `call`, joining the in-flight one for `key`
+        if any"""
+
+        if task := self._tasks.get(key):
+            self.collapsed += 1
+        else:
+            task = asyncio.ensure_future(call())
+            task.add_done_callback(lambda _: self._forget(key, task))
+            self._tasks[key] = task
+            self.calls += 1
+
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict[str, int]:
+        """Return the number of calls made and collapsed, and in flight"""
+
+        return {
+            "calls": self.calls,
+            "collapsed": self.collapsed,
+            "in_flight": len(self._tasks),
+        }
+
+    def _forget(self, key: str, task: asyncio.Task[T]) -> None:
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+        # The exception is retrieved by the callers, if any is still waiting
+        if not task.cancelled():
+            task.exception()
@@ -1,31 +1,186 @@
+import asyncio
+import functools
+import time
+
 import aiohttp
 
-from dm_stream_urls_server.config import DAILYMOTION_API_VIDEO_URL
+from fastapi import status
+
+from dm_stream_urls_server.config import (
+    DAILYMOTION_API_VIDEO_URL,
+    UPSTREAM_HEDGE_PERCENTILE,
+    UPSTREAM_HEDGING_ENABLED,
+)
+from dm_stream_urls_server.json_codec import JSON_CONTENT_TYPE, json_loads
+from dm_stream_urls_server.metrics import (
+    upstream_phase_duration,
+    upstream_responses,
+)
+from dm_stream_urls_server.ratelimit import RateLimitExceededError
+from dm_stream_urls_server.token import throttle_access_token
+from dm_stream_urls_server.upstream import (
+    CircuitOpenError,
+    hedge,
+    upstream_rate_limiter,
+    video_endpoint,
+    video_hedge_budget,
+)
+
+# Every call to Dailymotion API takes a token from this single bucket
+UPSTREAM_RATE_LIMIT_KEY = "video"
 
 
-async def get_stream_urls(
+async def get_stream_urls(  # pylint: disable=too-many-arguments
+    session: aiohttp.ClientSession,
     video_id: str,
     video_formats: str,
     client_ip: str,
     authorization: str,
+    *,
+    key_name: str | None = None,
 ) -> dict:
     """Return the stream URLs for a video
 
     URLs will only be valid for the provided client IP address.
     """
 
-    async with aiohttp.ClientSession(raise_for_status=True) as session:
-        async with session.get(
-            url=f"{DAILYMOTION_API_VIDEO_URL}/{video_id}",
-            params={
-                "client_ip": client_ip,
-                "fields": video_formats,
-            },
-            headers={
-                "Authorization": f"Bearer {authorization}",
-            },
-            timeout=2,
-        ) as response:
-            response_json: dict = await response.json()
-
-            return response_json
+    stream_urls: dict = json_loads(
+        await get_stream_urls_body(
+            session,
+            video_id,
+            video_formats,
+            client_ip,
+            authorization,
+            key_name=key_name,
+        )
+    )
+
+    return stream_urls
+
+
+async def get_stream_urls_body(  # pylint: disable=too-many-arguments
+    session: aiohttp.ClientSession,
+    video_id: str,
+    video_formats: str,
+    client_ip: str,
+    authorization: str,
+    *,
+    key_name: str | None = None,
+) -> bytes:
+    """Return the JSON body of the Dailymotion API response holding the
+    stream URLs for a video, as is
+
+    With hedging enabled, the call is sent a second time if it has not
+    returned within a percentile of the recent latencies.
+
+    Raises `CircuitOpenError` without calling Dailymotion API while it is
+    failing, and `RateLimitExceededError` when calling it would exceed the
+    upstream rate limit.
+    """
+
+    request = functools.partial(
+        request_stream_urls,
+        session,
+        video_id,
+        video_formats,
+        client_ip,
+        authorization,
+        key_name=key_name,
+    )
+
+    start = time.perf_counter()
+
+    try:
+        if UPSTREAM_HEDGING_ENABLED:
+            return await hedge(
+                request,
+                video_endpoint.latency.get_percentile(
+                    UPSTREAM_HEDGE_PERCENTILE
+                ),
+                video_hedge_budget,
+            )
+
+        return await request()
+    finally:
+        upstream_phase_duration.observe(time.perf_counter() - start)
+
+
+async def request_stream_urls(  # pylint: disable=too-many-arguments
+    session: aiohttp.ClientSession,
+    video_id: str,
+    video_formats: str,
+    client_ip: str | None,
+    authorization: str,
+    *,
+    key_name: str | None = None,
+) -> bytes:
+    """Make a single call to Dailymotion API for the stream URLs of a video
+    and return its JSON body
+
+    Only the status and the content type of the response are checked, the
+    body is neither decoded nor validated. Without client IP address, URLs
+    are signed for the server one. The API key the access token was
+    generated for, named `key_name`, is left out of the credential pool
+    rotation when throttled.
+    """
+
+    status_code = "error"
+
+    try:
+        await upstream_rate_limiter.acquire(UPSTREAM_RATE_LIMIT_KEY)
+
+        with video_endpoint.guard() as timeout:
+            async with session.get(
+                url=f"{DAILYMOTION_API_VIDEO_URL}/{video_id}",
+                params={
+                    **({"client_ip": client_ip} if client_ip else {}),
+                    "fields": video_formats,
+                },
+                headers={
+                    "Authorization": f"Bearer {authorization}",
+                },
+                raise_for_status=True,
+                timeout=timeout,
+            ) as response:
+                status_code = str(response.status)
+
+                if response.content_type != JSON_CONTENT_TYPE:
+                    raise aiohttp.ContentTypeError(
+                        response.request_info,
+                        response.history,
+                        status=status.HTTP_502_BAD_GATEWAY,
+                        message=(
+                            "Unexpected content type of Dailymotion API "
+                            f"response: {response.content_type}"
+                        ),
+                    )
+
+                return await response.read()
+    except aiohttp.ClientResponseError as e:
+        status_code = str(e.status)
+
+        if e.status == status.HTTP_429_TOO_MANY_REQUESTS:
+            throttle_access_token(
+                key_name,
+                e.headers.get("Retry-After") if e.headers else None,
+            )
+
+        raise
+    except asyncio.TimeoutError:
+        status_code = "timeout"
+
+        raise
+    except CircuitOpenError:
+        status_code = "circuit_open"
+
+        raise
+    except RateLimitExceededError:
+        status_code = "rate_limited"
+
+        raise
+    except asyncio.CancelledError:
+        status_code = "cancelled"
+
+        raise
+    finally:
+        upstream_responses.labels(status_code).inc()
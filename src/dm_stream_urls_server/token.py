@@ -1,89 +1,175 @@
-import json
+import asyncio
 import logging
+import random
+import time
+import uuid
+
+from typing import NamedTuple
 
 import aiohttp
 
+from fastapi import status
+
 from dm_stream_urls_server.cache import (
-    Cache,
+    TokenStore,
+    acquire_refresh_lease,
     is_access_token_expired,
-    read_access_token,
+    is_refresh_lease_held,
+    local_access_token_cache,
+    read_access_token_record,
+    read_access_token_with_ttl,
+    release_refresh_lease,
     store_access_token,
 )
 from dm_stream_urls_server.config import (
-    DAILYMOTION_API_CREDENTIALS_FILE,
+    ACCESS_TOKEN_REFRESH_LEASE_TTL,
+    ACCESS_TOKEN_REFRESH_POLL_INTERVAL,
     DAILYMOTION_API_OAUTH_TOKEN_URL,
 )
+from dm_stream_urls_server.credentials import Credential, credential_pool
+from dm_stream_urls_server.upstream import oauth_token_endpoint
 
 logger = logging.getLogger(__name__)
 
 
-def get_dailymotion_api_credentials(
-    credentials_filename: str,
-) -> tuple[str, str]:
-    """
-    File format is:
-    {
-        "DAILYMOTION_API_KEY_ID": <client_id>,
-        "DAILYMOTION_API_KEY_SECRET": <client_secret>
-    }"""
-
-    with open(credentials_filename, "r", encoding="utf8") as fh:
-        creds = json.load(fh)
-
-    return (
-        creds.get("DAILYMOTION_API_KEY_ID"),
-        creds.get("DAILYMOTION_API_KEY_SECRET"),
-    )
+class AccessToken(NamedTuple):
+    """An access token along with the name of the API key it was generated
+    for, so that the key can be throttled"""
 
+    access_token: str
+    key_name: str | None = None
 
-async def fetch_dailymotion_api_oauth_token() -> dict:
-    """Generate an access token from Dailymotion API"""
 
-    client_id, client_secret = get_dailymotion_api_credentials(
-        DAILYMOTION_API_CREDENTIALS_FILE
-    )
+async def fetch_dailymotion_api_oauth_token(
+    session: aiohttp.ClientSession,
+    credential: Credential,
+) -> dict:
+    """Generate an access token for an API key from Dailymotion API"""
 
-    async with aiohttp.ClientSession(raise_for_status=True) as session:
+    with oauth_token_endpoint.guard() as timeout:
         async with session.post(
             url=DAILYMOTION_API_OAUTH_TOKEN_URL,
             data={
                 "scope": "read_video_streams",
                 "grant_type": "client_credentials",
-                "client_id": client_id,
-                "client_secret": client_secret,
+                "client_id": credential.key_id,
+                "client_secret": credential.key_secret,
             },
             headers={
                 "Content-Type": "application/x-www-form-urlencoded",
             },
-            timeout=2,
+            raise_for_status=True,
+            timeout=timeout,
         ) as response:
             response_json: dict = await response.json()
 
             return response_json
 
 
-async def get_dailymotion_api_access_token(cache: Cache) -> str | None:
-    """Return cached access token
+async def get_dailymotion_api_access_token(
+    cache: TokenStore,
+    session: aiohttp.ClientSession,
+) -> AccessToken | None:
+    """Return cached access token of the API key picked from the credential
+    pool, along with the name of the key
+
+    The in-process copy is served first, without any I/O. Otherwise the token
+    is read from cache and kept locally until its refresh is due.
 
     If the cache is missing, fetch a new token and save it to cache and
     return it."""
 
-    if access_token := await read_access_token(cache):
-        return access_token
+    credential = credential_pool.select()
+    key_name = credential.name if credential else None
+
+    if access_token := local_access_token_cache.get(key_name):
+        return AccessToken(access_token, key_name)
 
-    await refresh_dailymotion_api_access_token(cache)
+    if access_token := await read_and_keep_access_token(cache, key_name):
+        return AccessToken(access_token, key_name)
 
-    return await read_access_token(cache)
+    if credential:
+        await refresh_dailymotion_api_access_token(cache, session, credential)
+
+    if access_token := await read_and_keep_access_token(cache, key_name):
+        return AccessToken(access_token, key_name)
+
+    return None
+
+
+async def read_and_keep_access_token(
+    cache: TokenStore,
+    key_name: str | None = None,
+) -> str | None:
+    """Read access token from cache and keep an in-process copy of it until
+    its `refresh_at`"""
+
+    if not (record := await read_access_token_record(cache, key_name)):
+        return None
+
+    if (ttl := record.refresh_at - time.time()) > 0:
+        local_access_token_cache.set(
+            record.access_token, ttl, key_name, record.issued_at
+        )
 
+    return record.access_token
 
-async def refresh_dailymotion_api_access_token(cache: Cache) -> None:
-    """Fetch a new access token if the cache has expired"""
 
-    if not await is_access_token_expired(cache):
+def throttle_access_token(
+    key_name: str | None,
+    retry_after: str | None = None,
+) -> None:
+    """Leave the API key an access token was generated for out of the
+    rotation, Dailymotion API throttling it
+
+    The key is left out for as many seconds as the `retry_after` header
+    value, if given in seconds, or for the throttle cooldown otherwise.
+    """
+
+    try:
+        cooldown = float(retry_after) if retry_after else None
+    except ValueError:
+        cooldown = None
+
+    credential_pool.throttle(key_name, cooldown)
+
+
+async def refresh_dailymotion_api_access_token(
+    cache: TokenStore,
+    session: aiohttp.ClientSession,
+    credential: Credential,
+) -> None:
+    """Fetch a new access token for an API key if the cache has expired
+
+    Only the holder of the refresh lease fetches a new token, so that API
+    workers and refresh daemons across nodes do not all call Dailymotion API
+    at once. The others wait for the new token to be stored instead. Once
+    leased, the expiry is checked again, since the previous holder may have
+    stored a new token since the first check.
+
+    An API key throttled by Dailymotion API is left out of the rotation.
+    """
+
+    key_name = credential.name
+
+    if not await is_access_token_expired(cache, key_name):
+        return
+
+    lease_owner = uuid.uuid4().hex
+    leased = await acquire_refresh_lease(
+        cache, lease_owner, ACCESS_TOKEN_REFRESH_LEASE_TTL, key_name
+    )
+
+    if leased is False:
+        await wait_for_dailymotion_api_access_token_refresh(cache, key_name)
+
         return
 
     try:
-        response = await fetch_dailymotion_api_oauth_token()
+        if not await is_access_token_expired(cache, key_name):
+            return
+
+        response = await fetch_dailymotion_api_oauth_token(session, credential)
         access_token = response["access_token"]
 
         if access_token:
@@ -93,6 +179,8 @@ async def refresh_dailymotion_api_access_token(cache: Cache) -> None:
                 cache=cache,
                 access_token=access_token,
                 expires_in=response["expires_in"],
+                lease_owner=lease_owner if leased else None,
+                key_name=key_name,
             )
     except Exception as e:  # pylint: disable=broad-except
         exception_type = type(e).__name__
@@ -100,7 +188,74 @@ async def refresh_dailymotion_api_access_token(cache: Cache) -> None:
 
         logger.error(
             "Failed to get dailymotion access token: "
-            "exception_type=%s, exception_message=%s",
+            "key=%s, exception_type=%s, exception_message=%s",
+            key_name,
             exception_type,
             exception_message,
         )
+
+        if getattr(e, "status", None) == status.HTTP_429_TOO_MANY_REQUESTS:
+            credential_pool.throttle(key_name)
+    finally:
+        if leased:
+            await release_refresh_lease(cache, lease_owner, key_name)
+
+
+async def wait_for_dailymotion_api_access_token_refresh(
+    cache: TokenStore,
+    key_name: str | None = None,
+) -> None:
+    """Poll the cache until the refresh lease holder has stored a new access
+    token, or until the lease would have expired
+
+    Polling stops as soon as the lease is released without a new token, the
+    holder having failed, rather than holding the caller until the lease TTL.
+    """
+
+    deadline = time.monotonic() + ACCESS_TOKEN_REFRESH_LEASE_TTL
+
+    while time.monotonic() < deadline:
+        await asyncio.sleep(ACCESS_TOKEN_REFRESH_POLL_INTERVAL)
+
+        if not await is_access_token_expired(cache, key_name):
+            return
+
+        if not await is_refresh_lease_held(cache, key_name):
+            logger.warning(
+                "Dailymotion access token refresh lease released without a "
+                "new token: key=%s",
+                key_name,
+            )
+
+            return
+
+
+async def refresh_dailymotion_api_access_token_periodically(
+    cache: TokenStore,
+    session: aiohttp.ClientSession,
+    interval: float,
+    jitter: float,
+) -> None:
+    """Refresh the access tokens of every API key ahead of their expiry until
+    cancelled
+
+    After each refresh, sleep until the first `refresh_at`, i.e. until the
+    next refresh is due, but no longer than `interval` seconds. The delay is
+    shortened by up to `jitter` (a ratio) so that several refreshers do not
+    wake up all at once.
+    """
+
+    while True:
+        delay = interval
+
+        for credential in credential_pool.credentials:
+            await refresh_dailymotion_api_access_token(
+                cache, session, credential
+            )
+
+            _, ttl = await read_access_token_with_ttl(cache, credential.name)
+
+            if ttl > 0:
+                delay = min(delay, ttl)
+
+        await asyncio.sleep(delay * (1 - jitter * random.random()))  # nosec
@@ -0,0 +1,490 @@
+import asyncio
+import contextlib
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import time
+
+from collections.abc import Callable, Iterator
+
+from dm_stream_urls_server.cache import (
+    CACHE_KEY,
+    INVALIDATION_CHANNEL,
+    LOCK_KEY,
+    RECORD_KEY,
+    REFRESH_LEASE_KEY,
+    AccessTokenRecord,
+    Cache,
+    TokenStore,
+    get_access_token_key,
+    pack_access_token_record,
+    unpack_access_token_record,
+)
+from dm_stream_urls_server.config import (
+    TOKEN_STORE_BACKEND,
+    TOKEN_STORE_MMAP_PATH,
+    TOKEN_STORE_MMAP_SIZE,
+    TOKEN_STORE_WATCH_INTERVAL,
+)
+from dm_stream_urls_server.json_codec import json_dumps, json_loads
+
+logger = logging.getLogger(__name__)
+
+TOKEN_STORE_BACKENDS = ("redis", "memory", "mmap")
+
+# Delete the lease only if it is still held by the given owner
+RELEASE_REFRESH_LEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+# Store the access token record only if the lease is still held by the given
+# owner, so that a refresher whose lease expired meanwhile cannot overwrite a
+# newer token
+STORE_LEASED_ACCESS_TOKEN_SCRIPT = """
+if redis.call("get", KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call("set", KEYS[2], ARGV[2], "PXAT", ARGV[3])
+redis.call("publish", ARGV[4], ARGV[5])
+return 1
+"""
+
+# Header of the token store file: the number of writes, the number of records
+# stored and the length of the JSON entries that follow
+MMAP_HEADER = struct.Struct("<QQI")
+
+# Value along with the time it expires at, in seconds since the epoch
+Entry = tuple[str, float]
+
+
+class RedisTokenStore(TokenStore):
+    """Access token records and refresh leases in Redis, shared by every
+    process of every node
+
+    A record is read along with the legacy `CACHE_KEY` and `LOCK_KEY` keys in
+    a single round-trip, those being migrated to a record on read, and stored
+    in a single round-trip along with a pub/sub notification.
+    """
+
+    backend = "redis"
+
+    def __init__(self, cache: Cache) -> None:
+        self.cache = cache
+
+    async def get_record(
+        self,
+        key_name: str | None = None,
+    ) -> AccessTokenRecord | None:
+        """Return the access token record of an API key, if any
+
+        The record and the legacy keys are read in a single round-trip.
+        Without a record, the access token is read from the legacy keys
+        instead, and migrated to a record if its refresh is not due yet. Not
+        knowing when it was issued, it is then considered to expire when its
+        refresh is due.
+        """
+
+        record_key = get_access_token_key(RECORD_KEY, key_name)
+
+        async with self.cache.pipeline(transaction=False) as pipe:
+            pipe.get(record_key)
+            pipe.get(get_access_token_key(CACHE_KEY, key_name))
+            pipe.pttl(get_access_token_key(LOCK_KEY, key_name))
+            value, cached_access_token, lock_ttl = await pipe.execute()
+
+        if value:
+            return unpack_access_token_record(value)
+
+        if not cached_access_token or lock_ttl <= 0:
+            return None
+
+        now = time.time()
+        refresh_at = now + lock_ttl / 1000
+        record = AccessTokenRecord(
+            cached_access_token.decode("utf8"), now, refresh_at, refresh_at
+        )
+
+        await self.cache.set(
+            record_key,
+            pack_access_token_record(record),
+            pxat=int(record.expires_at * 1000),
+            nx=True,
+        )
+
+        return record
+
+    async def set_record(
+        self,
+        record: AccessTokenRecord,
+        lease_owner: str | None = None,
+        key_name: str | None = None,
+    ) -> bool:
+        record_key = get_access_token_key(RECORD_KEY, key_name)
+        expires_at_ms = int(record.expires_at * 1000)
+
+        if lease_owner:
+            return bool(
+                await self.cache.eval(
+                    STORE_LEASED_ACCESS_TOKEN_SCRIPT,
+                    2,
+                    get_access_token_key(REFRESH_LEASE_KEY, key_name),
+                    record_key,
+                    lease_owner,
+                    pack_access_token_record(record),
+                    expires_at_ms,
+                    INVALIDATION_CHANNEL,
+                    f"{record.refresh_at:.3f}",
+                )
+            )
+
+        async with self.cache.pipeline(transaction=True) as pipe:
+            pipe.set(
+                record_key,
+                pack_access_token_record(record),
+                pxat=expires_at_ms,
+            )
+            pipe.publish(INVALIDATION_CHANNEL, f"{record.refresh_at:.3f}")
+            await pipe.execute()
+
+        return True
+
+    async def acquire_lease(
+        self,
+        owner: str,
+        ttl: float,
+        key_name: str | None = None,
+    ) -> bool:
+        return bool(
+            await self.cache.set(
+                get_access_token_key(REFRESH_LEASE_KEY, key_name),
+                owner,
+                nx=True,
+                px=int(ttl * 1000),
+            )
+        )
+
+    async def release_lease(
+        self,
+        owner: str,
+        key_name: str | None = None,
+    ) -> None:
+        await self.cache.eval(
+            RELEASE_REFRESH_LEASE_SCRIPT,
+            1,
+            get_access_token_key(REFRESH_LEASE_KEY, key_name),
+            owner,
+        )
+
+    async def is_leased(self, key_name: str | None = None) -> bool:
+        return bool(
+            await self.cache.exists(
+                get_access_token_key(REFRESH_LEASE_KEY, key_name)
+            )
+        )
+
+    async def watch(self, callback: Callable[[], None]) -> None:
+        async with self.cache.pubsub() as pubsub:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            callback()
+
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    callback()
+
+
+def get_entry(entries: dict[str, Entry], key: str) -> str | None:
+    """Return the value of an entry unless it has expired"""
+
+    if entry := entries.get(key):
+        value, expires_at = entry
+
+        if time.time() < expires_at:
+            return value
+
+    return None
+
+
+def prune_entries(entries: dict[str, Entry]) -> None:
+    """Drop the expired entries"""
+
+    now = time.time()
+
+    for key in [key for key, (_, exp) in entries.items() if exp <= now]:
+        del entries[key]
+
+
+class MemoryTokenStore(TokenStore):
+    """Access token records and refresh leases in the memory of the process
+
+    Reads involve no I/O at all, and no Redis server is needed, but each
+    process fetches and refreshes its own access tokens.
+    """
+
+    backend = "memory"
+    shared = False
+
+    def __init__(self) -> None:
+        self._entries: dict[str, Entry] = {}
+        self._record_stored = asyncio.Event()
+
+    @contextlib.contextmanager
+    def transaction(self, write: bool = False) -> Iterator[dict[str, Entry]]:
+        """Yield the entries, to be read, or updated if `write`, at once"""
+
+        if write:
+            prune_entries(self._entries)
+
+        yield self._entries
+
+    def notify(self) -> None:
+        """Tell the watchers a record was stored, from within a write
+        transaction"""
+
+        self._record_stored.set()
+        self._record_stored.clear()
+
+    async def get_record(
+        self,
+        key_name: str | None = None,
+    ) -> AccessTokenRecord | None:
+        with self.transaction() as entries:
+            value = get_entry(
+                entries, get_access_token_key(RECORD_KEY, key_name)
+            )
+
+        return unpack_access_token_record(value) if value else None
+
+    async def set_record(
+        self,
+        record: AccessTokenRecord,
+        lease_owner: str | None = None,
+        key_name: str | None = None,
+    ) -> bool:
+        lease_key = get_access_token_key(REFRESH_LEASE_KEY, key_name)
+
+        with self.transaction(write=True) as entries:
+            if lease_owner and get_entry(entries, lease_key) != lease_owner:
+                return False
+
+            entries[get_access_token_key(RECORD_KEY, key_name)] = (
+                pack_access_token_record(record),
+                record.expires_at,
+            )
+            self.notify()
+
+        return True
+
+    async def acquire_lease(
+        self,
+        owner: str,
+        ttl: float,
+        key_name: str | None = None,
+    ) -> bool:
+        lease_key = get_access_token_key(REFRESH_LEASE_KEY, key_name)
+
+        with self.transaction(write=True) as entries:
+            if get_entry(entries, lease_key) is not None:
+                return False
+
+            entries[lease_key] = (owner, time.time() + ttl)
+
+        return True
+
+    async def release_lease(
+        self,
+        owner: str,
+        key_name: str | None = None,
+    ) -> None:
+        lease_key = get_access_token_key(REFRESH_LEASE_KEY, key_name)
+
+        with self.transaction(write=True) as entries:
+            if get_entry(entries, lease_key) == owner:
+                del entries[lease_key]
+
+    async def is_leased(self, key_name: str | None = None) -> bool:
+        lease_key = get_access_token_key(REFRESH_LEASE_KEY, key_name)
+
+        with self.transaction() as entries:
+            owner = get_entry(entries, lease_key)
+
+        return owner is not None
+
+    async def watch(self, callback: Callable[[], None]) -> None:
+        callback()
+
+        while True:
+            await self._record_stored.wait()
+            callback()
+
+
+class MmapTokenStore(MemoryTokenStore):
+    """Access token records and refresh leases in a memory-mapped file,
+    shared by the processes of a node
+
+    The file holds a header followed by the entries as JSON. Transactions
+    hold an advisory lock on the file, shared to read and exclusive to write,
+    for the few microseconds it takes to copy the entries in or out. Entries
+    are only decoded again once another process wrote them, so reads usually
+    cost two system calls.
+
+    Watchers check every `watch_interval` seconds whether a record was
+    stored, since the file offers no notification.
+    """
+
+    backend = "mmap"
+    shared = True
+
+    def __init__(self, path: str, size: int, watch_interval: float) -> None:
+        super().__init__()
+        self.path = path
+        self.size = size
+        self.watch_interval = watch_interval
+        self._generation = -1
+        self._record_stored_flag = False
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+            try:
+                if os.fstat(self._fd).st_size < size:
+                    os.ftruncate(self._fd, size)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+            self._mmap = mmap.mmap(self._fd, size)
+        except Exception:
+            os.close(self._fd)
+
+            raise
+
+    def read_header(self) -> tuple[int, int, int]:
+        """Return the number of writes, the number of records stored and the
+        length of the entries"""
+
+        generation, records, length = MMAP_HEADER.unpack_from(self._mmap)
+
+        return generation, records, length
+
+    @contextlib.contextmanager
+    def transaction(self, write: bool = False) -> Iterator[dict[str, Entry]]:
+        fcntl.flock(self._fd, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+
+        try:
+            generation, records, length = self.read_header()
+
+            if generation != self._generation:
+                self._entries = {
+                    key: (value, expires_at)
+                    for key, (value, expires_at) in (
+                        json_loads(
+                            self._mmap[
+                                MMAP_HEADER.size : MMAP_HEADER.size + length
+                            ]
+                        )
+                        if length
+                        else {}
+                    ).items()
+                }
+                self._generation = generation
+
+            if not write:
+                yield self._entries
+
+                return
+
+            entries = dict(self._entries)
+            prune_entries(entries)
+            self._record_stored_flag = False
+
+            yield entries
+
+            if entries == self._entries and not self._record_stored_flag:
+                return
+
+            data = json_dumps(entries)
+
+            if MMAP_HEADER.size + len(data) > self.size:
+                raise ValueError(f"Token store file is full: {self.path}")
+
+            self._mmap[MMAP_HEADER.size : MMAP_HEADER.size + len(data)] = data
+            MMAP_HEADER.pack_into(
+                self._mmap,
+                0,
+                generation + 1,
+                records + self._record_stored_flag,
+                len(data),
+            )
+            self._entries = entries
+            self._generation = generation + 1
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def notify(self) -> None:
+        self._record_stored_flag = True
+
+    async def watch(self, callback: Callable[[], None]) -> None:
+        records = None
+
+        while True:
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+
+            try:
+                _, stored_records, _ = self.read_header()
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+            if stored_records != records:
+                records = stored_records
+                callback()
+
+            await asyncio.sleep(self.watch_interval)
+
+    async def close(self) -> None:
+        self._mmap.close()
+        os.close(self._fd)
+
+
+def create_token_store(cache: Cache | None) -> TokenStore | None:
+    """Return the access token store of the configured backend
+
+    The Redis backend needs the cache client, none is returned without it.
+    """
+
+    if TOKEN_STORE_BACKEND not in TOKEN_STORE_BACKENDS:
+        raise ValueError(
+            f"Unknown token store backend: {TOKEN_STORE_BACKEND}, "
+            f"expected one of {', '.join(TOKEN_STORE_BACKENDS)}"
+        )
+
+    if TOKEN_STORE_BACKEND == "memory":
+        return MemoryTokenStore()
+
+    if TOKEN_STORE_BACKEND == "mmap":
+        try:
+            return MmapTokenStore(
+                TOKEN_STORE_MMAP_PATH,
+                TOKEN_STORE_MMAP_SIZE,
+                TOKEN_STORE_WATCH_INTERVAL,
+            )
+        except Exception as e:  # pylint: disable=broad-except
+            exception_type = type(e).__name__
+            exception_message = str(e)
+
+            logger.error(
+                "Failed to open token store file: "
+                "TOKEN_STORE_MMAP_PATH=%s, exception_type=%s, "
+                "exception_message=%s",
+                TOKEN_STORE_MMAP_PATH,
+                exception_type,
+                exception_message,
+            )
+
+            return None
+
+    return RedisTokenStore(cache) if cache else None
@@ -0,0 +1,376 @@
+import asyncio
+import contextlib
+import math
+import statistics
+import time
+
+from collections import deque
+from collections.abc import Awaitable, Callable, Iterator
+from typing import TypeVar
+
+import aiohttp
+
+from dm_stream_urls_server.config import (
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+    CIRCUIT_BREAKER_RESET_TIMEOUT,
+    RATE_LIMIT_UPSTREAM_BURST,
+    RATE_LIMIT_UPSTREAM_RATE,
+    UPSTREAM_HEDGE_BUDGET,
+    UPSTREAM_LATENCY_WINDOW,
+    UPSTREAM_MAX_TIMEOUT,
+    UPSTREAM_MIN_TIMEOUT,
+    UPSTREAM_TIMEOUT_MULTIPLIER,
+    UPSTREAM_TIMEOUT_PERCENTILE,
+)
+from dm_stream_urls_server.ratelimit import (
+    RateLimitExceededError,
+    TokenBucketLimiter,
+)
+
+T = TypeVar("T")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream endpoint that is failing"""
+
+    def __init__(self, endpoint: str, retry_after: float) -> None:
+        super().__init__(f"Circuit of {endpoint} is open")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+def is_upstream_failure(exception: BaseException) -> bool:
+    """Whether an exception means that the upstream endpoint is failing,
+    rather than rejecting that specific call (e.g. a 404)
+
+    A 429 is not a failure: Dailymotion API throttles the API key, which is
+    left out of the credential rotation, while the endpoint serves the
+    others.
+    """
+
+    if isinstance(exception, aiohttp.ClientResponseError):
+        return exception.status >= 500
+
+    return isinstance(exception, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+class CircuitBreaker:
+    """Stop calling an endpoint after consecutive failures
+
+    Once `failure_threshold` calls in a row have failed, the circuit opens
+    and calls fail fast for `reset_timeout` seconds. It then half-opens: a
+    single probe call is let through, which closes the circuit if it succeeds
+    or opens it again otherwise.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int,
+        reset_timeout: float,
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def before_call(self) -> None:
+        """Raise `CircuitOpenError` unless the call may go through"""
+
+        if self.state == CLOSED:
+            return
+
+        retry_after = self._opened_at + self.reset_timeout - time.monotonic()
+
+        if self.state == OPEN and retry_after <= 0:
+            self.state = HALF_OPEN
+
+        if self.state == HALF_OPEN and not self._probing:
+            self._probing = True
+
+            return
+
+        self.rejected += 1
+
+        raise CircuitOpenError(self.name, max(retry_after, 0))
+
+    def record_success(self) -> None:
+        """Close the circuit"""
+
+        self.state = CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_cancellation(self) -> None:
+        """Let another call probe the endpoint, the outcome of this one being
+        unknown"""
+
+        self._probing = False
+
+    def record_failure(self) -> None:
+        """Open the circuit if the probe or too many calls in a row failed"""
+
+        self.failures += 1
+        self._probing = False
+
+        if self.state == HALF_OPEN or (
+            self.failures >= self.failure_threshold
+        ):
+            self.state = OPEN
+            self._opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """Timeout adapted to the recent latencies of an endpoint
+
+    The timeout is a multiple of a high percentile of the last `window`
+    latencies, clamped between `min_timeout` and `max_timeout`. Until enough
+    latencies are known, it is `max_timeout`. Percentiles are recomputed
+    every `window // 10` latencies rather than on every call.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        window: int,
+        percentile: float,
+        multiplier: float,
+        min_timeout: float,
+        max_timeout: float,
+    ) -> None:
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout = max_timeout
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._quantiles: list[float] = []
+        self._recompute_every = max(window // 10, 1)
+        self._observed = 0
+
+    def observe(self, latency: float) -> None:
+        """Record the latency of a successful call"""
+
+        self._latencies.append(latency)
+        self._observed += 1
+
+        if self._observed % self._recompute_every == 0 and (
+            len(self._latencies) == self._latencies.maxlen
+        ):
+            self._quantiles = statistics.quantiles(
+                self._latencies, n=100, method="inclusive"
+            )
+            self.timeout = min(
+                max(
+                    self._select_percentile(self.percentile) * self.multiplier,
+                    self.min_timeout,
+                ),
+                self.max_timeout,
+            )
+
+    def get_percentile(self, percentile: float) -> float | None:
+        """Return a percentile of the recent latencies, once enough of them
+        are known"""
+
+        if not self._quantiles:
+            return None
+
+        return self._select_percentile(percentile)
+
+    def _select_percentile(self, percentile: float) -> float:
+        return self._quantiles[min(max(int(percentile), 1), 99) - 1]
+
+
+class HedgeBudget:
+    """Cap on the ratio of calls that may be hedged
+
+    Every call deposits `ratio` of a token, up to `max_tokens`, and every
+    hedge spends a whole one, so that hedges never add more than `ratio` of
+    extra load, even when the endpoint slows down as a whole.
+    """
+
+    def __init__(self, ratio: float, max_tokens: float = 10) -> None:
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = 0.0
+        self.hedged = 0
+        self.won = 0
+        self.denied = 0
+
+    def deposit(self) -> None:
+        """Earn hedging allowance for a call"""
+
+        self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self) -> bool:
+        """Spend allowance for a hedge, if there is enough left"""
+
+        if self.tokens < 1:
+            self.denied += 1
+
+            return False
+
+        self.tokens -= 1
+        self.hedged += 1
+
+        return True
+
+    def stats(self) -> dict[str, int]:
+        """Return the number of hedges sent, won and denied"""
+
+        return {
+            "hedged": self.hedged,
+            "won": self.won,
+            "denied": self.denied,
+        }
+
+
+async def hedge(
+    call: Callable[[], Awaitable[T]],
+    delay: float | None,
+    budget: HedgeBudget,
+) -> T:
+    """Make a call, and a second identical one if the first has not returned
+    after `delay` seconds and the budget allows it
+
+    The first successful result is returned and the other call is cancelled.
+    If both calls fail, the error of the first one is raised.
+    """
+
+    budget.deposit()
+
+    first = asyncio.ensure_future(call())
+    calls = [first]
+
+    try:
+        if delay is None:
+            return await first
+
+        done, _ = await asyncio.wait(calls, timeout=delay)
+
+        if done or not budget.withdraw():
+            return await first
+
+        second = asyncio.ensure_future(call())
+        calls.append(second)
+        pending = set(calls)
+
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+
+            for task in done:
+                if not task.exception():
+                    if task is second:
+                        budget.won += 1
+
+                    return task.result()
+
+        return first.result()
+    finally:
+        for task in calls:
+            task.cancel()
+
+
+class UpstreamEndpoint:
+    """Circuit breaker and adaptive timeout of an upstream endpoint"""
+
+    def __init__(
+        self,
+        name: str,
+        breaker: CircuitBreaker,
+        latency: LatencyTracker,
+    ) -> None:
+        self.name = name
+        self.breaker = breaker
+        self.latency = latency
+
+    @contextlib.contextmanager
+    def guard(self) -> Iterator[aiohttp.ClientTimeout]:
+        """Wrap a call to the endpoint, yielding its timeout
+
+        Raises `CircuitOpenError` without calling the endpoint when its
+        circuit is open. The outcome and latency of the call are recorded.
+        """
+
+        self.breaker.before_call()
+
+        start = time.perf_counter()
+
+        try:
+            yield aiohttp.ClientTimeout(total=self.latency.timeout)
+        except Exception as e:
+            if is_upstream_failure(e):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+
+            raise
+        except asyncio.CancelledError:
+            self.breaker.record_cancellation()
+
+            raise
+
+        self.breaker.record_success()
+        self.latency.observe(time.perf_counter() - start)
+
+    def stats(self) -> dict[str, str | int | float]:
+        """Return the circuit state and the current timeout"""
+
+        return {
+            "state": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "rejected_calls": self.breaker.rejected,
+            "timeout": self.latency.timeout,
+        }
+
+
+def get_retry_after(error: CircuitOpenError | RateLimitExceededError) -> str:
+    """Return the `Retry-After` header value of a fast-failed or rate limited
+    call"""
+
+    return str(max(math.ceil(error.retry_after), 1))
+
+
+def create_upstream_endpoint(name: str) -> UpstreamEndpoint:
+    """Return an upstream endpoint configured from the environment"""
+
+    return UpstreamEndpoint(
+        name,
+        breaker=CircuitBreaker(
+            name,
+            failure_threshold=CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+            reset_timeout=CIRCUIT_BREAKER_RESET_TIMEOUT,
+        ),
+        latency=LatencyTracker(
+            window=UPSTREAM_LATENCY_WINDOW,
+            percentile=UPSTREAM_TIMEOUT_PERCENTILE,
+            multiplier=UPSTREAM_TIMEOUT_MULTIPLIER,
+            min_timeout=UPSTREAM_MIN_TIMEOUT,
+            max_timeout=UPSTREAM_MAX_TIMEOUT,
+        ),
+    )
+
+
+video_endpoint = create_upstream_endpoint("video")
+oauth_token_endpoint = create_upstream_endpoint("oauth_token")
+
+upstream_endpoints = (video_endpoint, oauth_token_endpoint)
+
+video_hedge_budget = HedgeBudget(UPSTREAM_HEDGE_BUDGET)
+
+# Shared through Redis across workers and nodes once given a cache
+upstream_rate_limiter = TokenBucketLimiter(
+    "upstream",
+    rate=RATE_LIMIT_UPSTREAM_RATE,
+    burst=RATE_LIMIT_UPSTREAM_BURST,
+)
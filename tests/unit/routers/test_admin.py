@@ -0,0 +1,142 @@
+import json
+
+from unittest.mock import MagicMock, patch
+
+import aiohttp
+import pytest
+
+from fastapi import HTTPException, Request
+
+from dm_stream_urls_server.profiling import ProfilerBusyError
+from dm_stream_urls_server.response_cache import ResponseCache
+from dm_stream_urls_server.routers.admin import (
+    PrefetchRequest,
+    prefetch_route,
+    profile_route,
+    require_admin_token,
+    tasks_route,
+)
+from dm_stream_urls_server.token import AccessToken
+
+ACCESS_TOKEN = AccessToken("test-token", "test-key")
+
+
+def decode(response):
+    return json.loads(response.body)
+
+
+@pytest.mark.parametrize(
+    "admin_token, headers, expected_status_code",
+    (
+        ("", [(b"authorization", b"Bearer ")], 404),
+        ("secret", [], 401),
+        ("secret", [(b"authorization", b"Bearer wrong")], 401),
+        ("secret", [(b"authorization", b"Bearer secret")], None),
+    ),
+)
+def test_require_admin_token(admin_token, headers, expected_status_code):
+    request = Request(scope={"type": "http", "headers": headers})
+
+    with patch("dm_stream_urls_server.routers.admin.ADMIN_TOKEN", admin_token):
+        if expected_status_code:
+            with pytest.raises(HTTPException) as exc_info:
+                require_admin_token(request)
+
+            assert expected_status_code == exc_info.value.status_code
+        else:
+            require_admin_token(request)
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.routers.admin.prefetch_video_metadata")
+async def test_prefetch_route(prefetch_video_metadata):
+    session = MagicMock(aiohttp.ClientSession)
+    video_metadata_cache = ResponseCache(max_size=10, ttl=60)
+    prefetch_video_metadata.return_value = [
+        {"video_id": "xVideoId", "status_code": 404, "formats": {}},
+    ]
+
+    assert {
+        "results": [
+            {"video_id": "xVideoId", "status_code": 404, "formats": {}},
+        ]
+    } == decode(
+        await prefetch_route(
+            PrefetchRequest(video_ids=["xVideoId"], video_formats="format1"),
+            ACCESS_TOKEN,
+            session,
+            video_metadata_cache,
+        )
+    )
+
+    prefetch_video_metadata.assert_awaited_once_with(
+        session,
+        video_metadata_cache,
+        ["xVideoId"],
+        "format1",
+        ACCESS_TOKEN,
+        concurrency=10,
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "seconds, output_format",
+    (
+        (0, "collapsed"),
+        (61, "collapsed"),
+        (5, "svg"),
+    ),
+)
+async def test_profile_route_invalid(seconds, output_format):
+    with pytest.raises(HTTPException) as exc_info:
+        await profile_route(seconds, output_format)
+
+    assert 422 == exc_info.value.status_code
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.routers.admin.profile_calls")
+@patch("dm_stream_urls_server.routers.admin.profile_stacks")
+async def test_profile_route(m_profile_stacks, m_profile_calls):
+    m_profile_stacks.return_value = "task;frame 3\n"
+    m_profile_calls.return_value = b"pstats"
+
+    response = await profile_route(2, "collapsed")
+
+    assert b"task;frame 3\n" == response.body
+    m_profile_stacks.assert_awaited_once_with(2, 0.005)
+
+    response = await profile_route(2, "pstats")
+
+    assert b"pstats" == response.body
+    assert "application/octet-stream" == response.media_type
+    assert 'attachment; filename="profile.pstats"' == (
+        response.headers["content-disposition"]
+    )
+    m_profile_calls.assert_awaited_once_with(2)
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.routers.admin.profile_stacks")
+async def test_profile_route_busy(m_profile_stacks):
+    m_profile_stacks.side_effect = ProfilerBusyError("busy")
+
+    with pytest.raises(HTTPException) as exc_info:
+        await profile_route(2, "collapsed")
+
+    assert 409 == exc_info.value.status_code
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.routers.admin.get_pending_tasks_stats")
+async def test_tasks_route(m_get_pending_tasks_stats):
+    m_get_pending_tasks_stats.return_value = [
+        {"coroutine": "a", "count": 2, "awaiting": {"x:1": 2}},
+        {"coroutine": "b", "count": 1, "awaiting": {"y:2": 1}},
+    ]
+
+    assert {
+        "pending": 3,
+        "coroutines": m_get_pending_tasks_stats.return_value,
+    } == decode(await tasks_route())
@@ -0,0 +1,136 @@
+import json
+
+from unittest.mock import MagicMock, patch
+
+import aiohttp
+import pytest
+
+from fastapi import HTTPException, Request
+from freezegun import freeze_time
+from pydantic import ValidationError
+
+from dm_stream_urls_server.api import app
+from dm_stream_urls_server.config import STREAM_URLS_BATCH_MAX_SIZE
+from dm_stream_urls_server.lookup import LookupContext
+from dm_stream_urls_server.ratelimit import TokenBucketLimiter
+from dm_stream_urls_server.routers.batch import (
+    StreamUrlsBatchRequest,
+    enforce_batch_rate_limits,
+    get_stream_urls_batch_route,
+)
+from dm_stream_urls_server.token import AccessToken
+
+ACCESS_TOKEN = AccessToken("test-token", "test-key")
+
+
+def decode(response):
+    return json.loads(response.body)
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.lookup.get_stream_urls")
+async def test_get_stream_urls_batch_route(get_stream_urls):
+    session = MagicMock(aiohttp.ClientSession)
+
+    async def get_video_stream_urls(video_id, **_):
+        if video_id == "xNotFound":
+            raise aiohttp.ClientResponseError(
+                request_info=None,
+                history=(),
+                status=404,
+                message="Not found",
+            )
+
+        return {"stream_format1_url": f"https://a.b/{video_id}"}
+
+    get_stream_urls.side_effect = get_video_stream_urls
+
+    assert decode(
+        await get_stream_urls_batch_route(
+            StreamUrlsBatchRequest(
+                video_ids=["xVideoId1", "xNotFound", "xVideoId2"],
+                video_formats="format1",
+            ),
+            context=LookupContext(
+                session=session, client_ip="a.b.c.d", access_token=ACCESS_TOKEN
+            ),
+        )
+    ) == {
+        "results": [
+            {
+                "video_id": "xVideoId1",
+                "status_code": 200,
+                "stream_urls": {"stream_format1_url": "https://a.b/xVideoId1"},
+            },
+            {
+                "video_id": "xNotFound",
+                "status_code": 404,
+                "detail": "Not found",
+            },
+            {
+                "video_id": "xVideoId2",
+                "status_code": 200,
+                "stream_urls": {"stream_format1_url": "https://a.b/xVideoId2"},
+            },
+        ],
+    }
+
+    assert 3 == get_stream_urls.await_count
+    get_stream_urls.assert_any_await(
+        session=session,
+        video_id="xVideoId1",
+        video_formats="format1",
+        client_ip="a.b.c.d",
+        authorization="test-token",
+        key_name="test-key",
+    )
+
+
+def test_stream_urls_batch_request_too_large():
+    with pytest.raises(ValidationError):
+        StreamUrlsBatchRequest(
+            video_ids=["xVideoId"] * (STREAM_URLS_BATCH_MAX_SIZE + 1),
+            video_formats="format1",
+        )
+
+
+@pytest.mark.asyncio
+@freeze_time("2024-01-01 00:00:00")
+async def test_enforce_batch_rate_limits():
+    app.state.client_rate_limiter = TokenBucketLimiter(
+        "client", rate=1, burst=3
+    )
+    app.state.video_rate_limiter = TokenBucketLimiter("video", rate=1, burst=1)
+    request = Request(scope={"type": "http", "app": app})
+
+    def create_batch(*video_ids):
+        return StreamUrlsBatchRequest(
+            video_ids=video_ids, video_formats="stream_h264_url"
+        )
+
+    # Larger than the burst of the client, taking a full bucket
+    await enforce_batch_rate_limits(
+        request, create_batch("x1", "x2", "x3", "x4", "x5"), "a.b.c.d"
+    )
+
+    with pytest.raises(HTTPException) as exc_info:
+        await enforce_batch_rate_limits(request, create_batch("x6"), "a.b.c.d")
+
+    assert exc_info.value.status_code == 429
+
+    await enforce_batch_rate_limits(request, create_batch("x1"), "e.f.g.h")
+
+    with pytest.raises(HTTPException) as exc_info:
+        await enforce_batch_rate_limits(
+            request, create_batch("x1", "x2"), "e.f.g.h"
+        )
+
+    assert exc_info.value.status_code == 429
+
+    # No token was taken from the client by the rejected batch
+    await enforce_batch_rate_limits(
+        request, create_batch("x2", "x3"), "e.f.g.h"
+    )
+
+    assert 1 == app.state.client_rate_limiter.rejected
+    assert 1 == app.state.video_rate_limiter.rejected
@@ -0,0 +1,143 @@
+from unittest.mock import MagicMock, Mock, patch
+
+import aiohttp
+import pytest
+
+from fastapi import HTTPException
+
+from dm_stream_urls_server.lookup import LookupContext
+from dm_stream_urls_server.response_cache import ResponseCache
+from dm_stream_urls_server.routers.manifest import get_stream_manifest_route
+from dm_stream_urls_server.token import AccessToken
+
+ACCESS_TOKEN = AccessToken("test-token", "test-key")
+
+
+async def iter_lines(lines):
+    for line in lines:
+        yield line
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.routers.manifest.open_manifest")
+@patch("dm_stream_urls_server.lookup.get_stream_urls")
+async def test_get_stream_manifest_route(get_stream_urls, open_manifest):
+    manifest_cache = ResponseCache(max_size=10, ttl=30)
+    session = MagicMock(aiohttp.ClientSession)
+    manifest_response = MagicMock(aiohttp.ClientResponse)
+    manifest_response.url = "https://a.b/hls/manifest.m3u8"
+    manifest_response.content = iter_lines(
+        (b"#EXTM3U\n", b"720.m3u8\n", b"#EXT-X-ENDLIST\n")
+    )
+
+    get_stream_urls.return_value = {
+        "stream_hls_url": "https://a.b/hls/manifest.m3u8",
+        "mode": "vod",
+    }
+    open_manifest.return_value = manifest_response
+
+    response = await get_stream_manifest_route(
+        "xVideoId",
+        context=LookupContext(
+            session=session, client_ip="a.b.c.d", access_token=ACCESS_TOKEN
+        ),
+        manifest_cache=manifest_cache,
+    )
+    manifest = b"".join([chunk async for chunk in response.body_iterator])
+
+    assert b"#EXTM3U\nhttps://a.b/hls/720.m3u8\n#EXT-X-ENDLIST\n" == manifest
+    assert "application/vnd.apple.mpegurl" == response.media_type
+
+    response = await get_stream_manifest_route(
+        "xVideoId",
+        context=LookupContext(
+            session=session, client_ip="a.b.c.d", access_token=ACCESS_TOKEN
+        ),
+        manifest_cache=manifest_cache,
+    )
+
+    assert manifest == response.body
+    get_stream_urls.assert_awaited_once_with(
+        session=session,
+        video_id="xVideoId",
+        video_formats="stream_hls_url,mode",
+        client_ip="a.b.c.d",
+        authorization="test-token",
+        key_name="test-key",
+    )
+    open_manifest.assert_awaited_once_with(
+        session, "https://a.b/hls/manifest.m3u8", 2
+    )
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.routers.manifest.open_manifest")
+@patch("dm_stream_urls_server.lookup.get_stream_urls")
+async def test_get_stream_manifest_route_not_streamed(
+    get_stream_urls, open_manifest
+):
+    manifest_response = MagicMock(aiohttp.ClientResponse)
+
+    get_stream_urls.return_value = {
+        "stream_hls_url": "https://a.b/hls/manifest.m3u8",
+    }
+    open_manifest.return_value = manifest_response
+
+    response = await get_stream_manifest_route(
+        "xVideoId",
+        context=LookupContext(
+            session=MagicMock(aiohttp.ClientSession),
+            client_ip="a.b.c.d",
+            access_token=ACCESS_TOKEN,
+        ),
+        manifest_cache=None,
+    )
+
+    manifest_response.release.assert_not_called()
+
+    await response.background()
+
+    manifest_response.release.assert_called_once_with()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "stream_urls, open_manifest_side_effect, expected_status_code",
+    (
+        ({}, None, 404),
+        (
+            {"stream_hls_url": "https://a.b/hls/manifest.m3u8"},
+            aiohttp.ClientResponseError(Mock(), (), status=403),
+            403,
+        ),
+        (
+            {"stream_hls_url": "https://a.b/hls/manifest.m3u8"},
+            aiohttp.ClientConnectionError(),
+            502,
+        ),
+    ),
+)
+@patch("dm_stream_urls_server.routers.manifest.open_manifest")
+@patch("dm_stream_urls_server.lookup.get_stream_urls")
+async def test_get_stream_manifest_route_error(
+    get_stream_urls,
+    open_manifest,
+    stream_urls,
+    open_manifest_side_effect,
+    expected_status_code,
+):
+    get_stream_urls.return_value = stream_urls
+    open_manifest.side_effect = open_manifest_side_effect
+
+    with pytest.raises(HTTPException) as exc_info:
+        await get_stream_manifest_route(
+            "xVideoId",
+            context=LookupContext(
+                session=MagicMock(aiohttp.ClientSession),
+                client_ip="a.b.c.d",
+                access_token=ACCESS_TOKEN,
+            ),
+            manifest_cache=None,
+        )
+
+    assert expected_status_code == exc_info.value.status_code
@@ -0,0 +1,39 @@
+from unittest.mock import Mock, patch
+
+import pytest
+
+from dm_stream_urls_server.api import app
+from dm_stream_urls_server.response_cache import ResponseCache
+from dm_stream_urls_server.routers.metrics import get_metrics_route
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.api.get_cache_pool_stats")
+async def test_get_metrics_route(m_get_cache_pool_stats):
+    response_cache = ResponseCache(max_size=10, ttl=10)
+    response_cache.hits = 3
+
+    m_get_cache_pool_stats.return_value = {"in_use_connections": 1}
+
+    app.state.cache = Mock()
+    app.state.response_cache = response_cache
+
+    try:
+        response = await get_metrics_route()
+    finally:
+        del app.state.cache, app.state.response_cache
+
+    metrics = response.body.decode("utf8").splitlines()
+
+    assert "text/plain; version=0.0.4; charset=utf-8" == (
+        response.headers["content-type"]
+    )
+    assert (
+        'dm_stream_urls_cache_pool_connections{state="in_use_connections"} 1'
+        in metrics
+    )
+    assert (
+        'dm_stream_urls_response_cache_lookups_total{result="hit"} 3'
+        in metrics
+    )
+    assert "# TYPE dm_stream_urls_phase_duration_seconds histogram" in metrics
@@ -1,139 +1,461 @@
+import asyncio
+import json
+
 from contextlib import nullcontext as does_not_raise
-from unittest.mock import Mock, patch
+from unittest.mock import MagicMock, Mock, patch
 
 import aiohttp
 import pytest
 
-from fastapi import HTTPException, Request
+from fastapi import HTTPException
+from freezegun import freeze_time
 
-from dm_stream_urls_server.api import (
-    get_access_token,
-    get_client_ip,
-    get_client_public_ip,
-    get_stream_urls_route,
+from dm_stream_urls_server.api import get_stats_route, get_stream_urls_route
+from dm_stream_urls_server.credentials import CredentialPool
+from dm_stream_urls_server.lookup import LookupContext, revalidation_tasks
+from dm_stream_urls_server.metrics import negative_cache_hits
+from dm_stream_urls_server.ratelimit import (
+    RateLimitExceededError,
+    TokenBucketLimiter,
+)
+from dm_stream_urls_server.response_cache import ResponseCache
+from dm_stream_urls_server.singleflight import SingleFlight
+from dm_stream_urls_server.token import AccessToken
+from dm_stream_urls_server.token_store import MemoryTokenStore
+from dm_stream_urls_server.upstream import (
+    CircuitOpenError,
+    HedgeBudget,
+    create_upstream_endpoint,
 )
 
+ACCESS_TOKEN = AccessToken("test-token", "test-key")
+
+
+def decode(response):
+    return json.loads(response.body)
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.api.stream_urls_single_flight", SingleFlight())
+@patch(
+    "dm_stream_urls_server.api.upstream_endpoints",
+    (create_upstream_endpoint("video"),),
+)
+@patch("dm_stream_urls_server.api.video_hedge_budget", HedgeBudget(0.1))
+@patch(
+    "dm_stream_urls_server.api.credential_pool",
+    CredentialPool("tests/fixtures/creds.json", 60, 5),
+)
+@patch("dm_stream_urls_server.api.get_cache_pool_stats")
+async def test_get_stats_route(m_get_cache_pool_stats):
+    cache = Mock()
+    response_cache = ResponseCache(max_size=10, ttl=10)
+    m_get_cache_pool_stats.return_value = {"in_use_connections": 1}
+
+    rate_limiters = (TokenBucketLimiter("client", rate=1, burst=5),)
+
+    assert await get_stats_route(
+        cache, response_cache, rate_limiters, None, MemoryTokenStore()
+    ) == {
+        "cache_pool": {"in_use_connections": 1},
+        "token_store": "memory",
+        "response_cache": {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "size": 0,
+        },
+        "video_metadata_cache": None,
+        "single_flight": {"calls": 0, "collapsed": 0, "in_flight": 0},
+        "upstream": {
+            "video": {
+                "state": "closed",
+                "consecutive_failures": 0,
+                "rejected_calls": 0,
+                "timeout": 2.0,
+            },
+        },
+        "hedging": {"hedged": 0, "won": 0, "denied": 0},
+        "rate_limit": {
+            "client": {"rate": 1, "burst": 5, "rejected": 0, "buckets": 0},
+        },
+        "credentials": {
+            "default": {
+                "weight": 1,
+                "selected": 0,
+                "throttled": 0,
+                "available": True,
+            },
+        },
+    }
+
+    m_get_cache_pool_stats.assert_called_once_with(cache)
+
 
 @pytest.mark.asyncio
 @pytest.mark.parametrize(
-    "fastapi_request, client_ip, expected_return",
+    "get_stream_urls_side_effect, expected_exception",
     (
         (
-            Request(scope={"type": "http"}),
-            None,
-            None,
-        ),
-        (
-            Request(scope={"type": "http", "client": None}),
             None,
-            None,
-        ),
-        (
-            Request(
-                scope={"type": "http", "client": ("101.102.103.104", None)}
-            ),
-            None,
-            "101.102.103.104",
+            does_not_raise(),
         ),
         (
-            Request(
-                scope={"type": "http", "client": ("101.102.103.104", 6128)}
+            (
+                aiohttp.ClientResponseError(
+                    request_info=None,
+                    history=(),
+                    status=404,
+                    message="Not found",
+                ),
             ),
-            None,
-            "101.102.103.104",
+            pytest.raises(HTTPException),
         ),
         (
-            Request(
-                scope={"type": "http", "client": ("101.102.103.104", 6128)}
-            ),
-            "201.202.203.204",
-            "201.202.203.204",
+            (RuntimeError(),),
+            pytest.raises(HTTPException),
         ),
     ),
 )
-async def test_get_client_ip(fastapi_request, client_ip, expected_return):
-    assert expected_return == await get_client_ip(
-        request=fastapi_request,
+@patch("dm_stream_urls_server.lookup.get_stream_urls")
+async def test_get_stream_urls_route(
+    get_stream_urls,
+    get_stream_urls_side_effect,
+    expected_exception,
+):
+    video_id = "xVideoId"
+    video_formats = "format1,format2"
+    client_ip = "a.b.c.d"
+    session = MagicMock(aiohttp.ClientSession)
+
+    get_stream_urls.return_value = {"stream_format1_url": "https://a.b/c"}
+    get_stream_urls.side_effect = get_stream_urls_side_effect
+
+    with expected_exception:
+        await get_stream_urls_route(
+            video_id,
+            video_formats,
+            context=LookupContext(
+                session=session, client_ip=client_ip, access_token=ACCESS_TOKEN
+            ),
+        )
+
+    get_stream_urls.assert_awaited_once_with(
+        session=session,
+        video_id=video_id,
+        video_formats=video_formats,
         client_ip=client_ip,
+        authorization="test-token",
+        key_name="test-key",
     )
 
 
-@patch("dm_stream_urls_server.api.get_client_public_ip")
-async def test_get_client_private_ip(mock_get_client_public_ip):
-    await get_client_ip(
-        request=Request(
-            scope={"type": "http", "client": ("10.11.12.13", None)}
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.lookup.get_stream_urls")
+async def test_get_stream_urls_route_circuit_open(get_stream_urls):
+    get_stream_urls.side_effect = CircuitOpenError("video", retry_after=4.2)
+
+    with pytest.raises(HTTPException) as exc_info:
+        await get_stream_urls_route(
+            "xVideoId",
+            "format1",
+            context=LookupContext(
+                session=MagicMock(aiohttp.ClientSession),
+                client_ip="a.b.c.d",
+                access_token=ACCESS_TOKEN,
+            ),
+        )
+
+    assert exc_info.value.status_code == 503
+    assert exc_info.value.headers == {"Retry-After": "5"}
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.lookup.get_stream_urls")
+async def test_get_stream_urls_route_upstream_rate_limited(get_stream_urls):
+    get_stream_urls.side_effect = RateLimitExceededError("upstream", 0.2)
+
+    with pytest.raises(HTTPException) as exc_info:
+        await get_stream_urls_route(
+            "xVideoId",
+            "format1",
+            context=LookupContext(
+                session=MagicMock(aiohttp.ClientSession),
+                client_ip="a.b.c.d",
+                access_token=ACCESS_TOKEN,
+            ),
+        )
+
+    assert exc_info.value.status_code == 429
+    assert exc_info.value.headers == {"Retry-After": "1"}
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.lookup.get_stream_urls")
+async def test_get_stream_urls_route_unavailable_video(get_stream_urls):
+    video_metadata_cache = ResponseCache(max_size=10, ttl=60)
+    await video_metadata_cache.set(
+        "dailymotion_video_metadata:xNotFound",
+        {"status_code": 404},
+    )
+    await video_metadata_cache.set(
+        "dailymotion_video_metadata:xVideoId",
+        {"status_code": 200},
+    )
+
+    get_stream_urls.return_value = {"format1": "https://a.b/c"}
+
+    with pytest.raises(HTTPException) as exc_info:
+        await get_stream_urls_route(
+            "xNotFound",
+            "format1",
+            context=LookupContext(
+                session=MagicMock(aiohttp.ClientSession),
+                client_ip="a.b.c.d",
+                access_token=ACCESS_TOKEN,
+                video_metadata_cache=video_metadata_cache,
+            ),
+        )
+
+    assert exc_info.value.status_code == 404
+    get_stream_urls.assert_not_awaited()
+
+    await get_stream_urls_route(
+        "xVideoId",
+        "format1",
+        context=LookupContext(
+            session=MagicMock(aiohttp.ClientSession),
+            client_ip="a.b.c.d",
+            access_token=ACCESS_TOKEN,
+            video_metadata_cache=video_metadata_cache,
         ),
-        client_ip=None,
     )
 
-    mock_get_client_public_ip.assert_awaited_once()
+    get_stream_urls.assert_awaited_once()
 
 
-class MockResponse:
-    _raise_for_status: bool
-    _json: dict
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.lookup.NEGATIVE_CACHE_TTL", 0)
+@patch("dm_stream_urls_server.lookup.get_stream_urls")
+async def test_get_stream_urls_route_negative_cache_disabled(get_stream_urls):
+    video_metadata_cache = ResponseCache(max_size=10, ttl=60)
+    await video_metadata_cache.set(
+        "dailymotion_video_metadata:xVideoId",
+        {"status_code": 404},
+    )
+    await video_metadata_cache.set(
+        "dailymotion_video_metadata:xVideoId:a.b.c.d",
+        {"status_code": 403},
+    )
 
-    def __init__(
-        self,
-        raise_for_status: bool,
-        json: dict,
-    ):
-        self._raise_for_status = raise_for_status
-        self._json = json
+    get_stream_urls.return_value = {"format1": "https://a.b/c"}
 
-    def raise_for_status(self):
-        if self._raise_for_status:
-            raise aiohttp.ClientResponseError(
-                history=None,
-                request_info=None,
-            )
+    await get_stream_urls_route(
+        "xVideoId",
+        "format1",
+        context=LookupContext(
+            session=MagicMock(aiohttp.ClientSession),
+            client_ip="a.b.c.d",
+            access_token=ACCESS_TOKEN,
+            video_metadata_cache=video_metadata_cache,
+        ),
+    )
 
-    async def json(self):
-        return self._json
+    get_stream_urls.assert_awaited_once()
 
 
 @pytest.mark.asyncio
 @pytest.mark.parametrize(
-    "ip_detector_side_effect, expected_return",
+    "status_code, other_client_calls",
     (
-        (
-            (
-                MockResponse(
-                    raise_for_status=False,
-                    json={
-                        "ip_addr": "101.102.103.104",
-                    },
+        (404, 0),
+        (403, 1),
+    ),
+)
+@patch("dm_stream_urls_server.lookup.get_stream_urls")
+async def test_get_stream_urls_route_negative_cache(
+    get_stream_urls, status_code, other_client_calls
+):
+    video_metadata_cache = ResponseCache(max_size=10, ttl=60)
+    session = MagicMock(aiohttp.ClientSession)
+    hits = negative_cache_hits.labels(str(status_code)).value
+
+    get_stream_urls.side_effect = aiohttp.ClientResponseError(
+        request_info=None,
+        history=(),
+        status=status_code,
+        message="Error",
+    )
+
+    for client_ip in ("a.b.c.d", "a.b.c.d", "e.f.g.h"):
+        with pytest.raises(HTTPException) as exc_info:
+            await get_stream_urls_route(
+                "xVideoId",
+                "format1",
+                context=LookupContext(
+                    session=session,
+                    client_ip=client_ip,
+                    access_token=ACCESS_TOKEN,
+                    video_metadata_cache=video_metadata_cache,
                 ),
-            ),
-            "101.102.103.104",
-        ),
-        (
-            (MockResponse(raise_for_status=True, json={}),),
-            None,
-        ),
+            )
+
+        assert status_code == exc_info.value.status_code
+
+    assert 1 + other_client_calls == get_stream_urls.await_count
+    assert hits + 2 - other_client_calls == (
+        negative_cache_hits.labels(str(status_code)).value
+    )
+
+    with freeze_time() as frozen_time:
+        frozen_time.tick(31)
+
+        with pytest.raises(HTTPException):
+            await get_stream_urls_route(
+                "xVideoId",
+                "format1",
+                context=LookupContext(
+                    session=session,
+                    client_ip="a.b.c.d",
+                    access_token=ACCESS_TOKEN,
+                    video_metadata_cache=video_metadata_cache,
+                ),
+            )
+
+    assert 2 + other_client_calls == get_stream_urls.await_count
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "bypass_response_cache, expected_get_stream_urls_calls",
+    (
+        (False, 1),
+        (True, 2),
     ),
 )
-@patch("dm_stream_urls_server.api.aiohttp.ClientSession.get")
-async def test_get_client_public_ip(
-    mock_get,
-    ip_detector_side_effect,
-    expected_return,
+@patch("dm_stream_urls_server.lookup.get_stream_urls")
+async def test_get_stream_urls_route_response_cache(
+    get_stream_urls,
+    bypass_response_cache,
+    expected_get_stream_urls_calls,
 ):
-    mock_get.return_value.__aenter__.side_effect = ip_detector_side_effect
-    assert expected_return == await get_client_public_ip()
+    response_cache = ResponseCache(max_size=10, ttl=10)
+    session = MagicMock(aiohttp.ClientSession)
+
+    get_stream_urls.return_value = {"stream_format1_url": "https://a.b/c"}
+
+    for _ in range(2):
+        assert {"stream_format1_url": "https://a.b/c"} == decode(
+            await get_stream_urls_route(
+                "xVideoId",
+                "format1",
+                context=LookupContext(
+                    session=session,
+                    client_ip="a.b.c.d",
+                    access_token=ACCESS_TOKEN,
+                    response_cache=response_cache,
+                    bypass_response_cache=bypass_response_cache,
+                ),
+            )
+        )
+
+    assert expected_get_stream_urls_calls == get_stream_urls.await_count
 
 
 @pytest.mark.asyncio
-@patch("dm_stream_urls_server.api.get_dailymotion_api_access_token")
-async def test_get_access_token(
-    get_cached_dailymotion_api_access_token,
+@patch("dm_stream_urls_server.api.STREAM_URLS_PASS_THROUGH", True)
+@patch("dm_stream_urls_server.lookup.get_stream_urls")
+@patch("dm_stream_urls_server.lookup.get_stream_urls_body")
+async def test_get_stream_urls_route_pass_through(
+    get_stream_urls_body, get_stream_urls
 ):
-    cache = Mock()
+    response_cache = ResponseCache(max_size=10, ttl=10)
+    session = MagicMock(aiohttp.ClientSession)
+    body = b'{"stream_format1_url":"https://a.b/c"}'
 
-    await get_access_token(cache)
+    get_stream_urls_body.return_value = body
 
-    get_cached_dailymotion_api_access_token.assert_awaited_once_with(cache)
+    for _ in range(2):
+        response = await get_stream_urls_route(
+            "xVideoId",
+            "format1",
+            context=LookupContext(
+                session=session,
+                client_ip="a.b.c.d",
+                access_token=ACCESS_TOKEN,
+                response_cache=response_cache,
+            ),
+        )
+
+        assert body == response.body
+        assert "application/json" == response.media_type
+
+    get_stream_urls_body.assert_awaited_once_with(
+        session=session,
+        video_id="xVideoId",
+        video_formats="format1",
+        client_ip="a.b.c.d",
+        authorization="test-token",
+        key_name="test-key",
+    )
+    get_stream_urls.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+@patch(
+    "dm_stream_urls_server.lookup.RESPONSE_CACHE_STALE_WHILE_REVALIDATE", True
+)
+@patch("dm_stream_urls_server.lookup.get_stream_urls")
+async def test_get_stream_urls_route_stale_while_revalidate(get_stream_urls):
+    response_cache = ResponseCache(max_size=10, ttl=10, stale_ttl=20)
+    session = MagicMock(aiohttp.ClientSession)
+
+    with freeze_time("2012-11-10T09:08:07Z") as frozen_time:
+        get_stream_urls.return_value = {"stream_format1_url": "stale"}
+
+        await get_stream_urls_route(
+            "xVideoId",
+            "format1",
+            context=LookupContext(
+                session=session,
+                client_ip="a.b.c.d",
+                access_token=ACCESS_TOKEN,
+                response_cache=response_cache,
+            ),
+        )
+
+        frozen_time.tick(15)
+        get_stream_urls.return_value = {"stream_format1_url": "fresh"}
+
+        assert {"stream_format1_url": "stale"} == decode(
+            await get_stream_urls_route(
+                "xVideoId",
+                "format1",
+                context=LookupContext(
+                    session=session,
+                    client_ip="a.b.c.d",
+                    access_token=ACCESS_TOKEN,
+                    response_cache=response_cache,
+                ),
+            )
+        )
+
+        await asyncio.gather(*revalidation_tasks)
+
+        assert {"stream_format1_url": "fresh"} == decode(
+            await get_stream_urls_route(
+                "xVideoId",
+                "format1",
+                context=LookupContext(
+                    session=session,
+                    client_ip="a.b.c.d",
+                    access_token=ACCESS_TOKEN,
+                    response_cache=response_cache,
+                ),
+            )
+        )
+
+    assert get_stream_urls.await_count == 2
 
 
 @pytest.mark.asyncio
@@ -141,50 +463,112 @@ async def test_get_access_token(
     "get_stream_urls_side_effect, expected_exception",
     (
         (
-            None,
+            aiohttp.ClientResponseError(
+                request_info=None,
+                history=(),
+                status=502,
+                message="Bad gateway",
+            ),
             does_not_raise(),
         ),
         (
-            (
-                aiohttp.ClientResponseError(
-                    request_info=None,
-                    history=(),
-                    status=404,
-                    message="Not found",
-                ),
+            aiohttp.ClientResponseError(
+                request_info=None,
+                history=(),
+                status=429,
+                message="Too many requests",
             ),
-            pytest.raises(HTTPException),
+            does_not_raise(),
         ),
         (
-            (RuntimeError(),),
+            CircuitOpenError("video", retry_after=1),
+            does_not_raise(),
+        ),
+        (
+            aiohttp.ClientResponseError(
+                request_info=None,
+                history=(),
+                status=404,
+                message="Not found",
+            ),
             pytest.raises(HTTPException),
         ),
     ),
 )
-@patch("dm_stream_urls_server.api.get_stream_urls")
-async def test_get_stream_urls_route(
+@patch("dm_stream_urls_server.lookup.RESPONSE_CACHE_STALE_IF_ERROR", True)
+@patch("dm_stream_urls_server.lookup.get_stream_urls")
+async def test_get_stream_urls_route_stale_if_error(
     get_stream_urls,
     get_stream_urls_side_effect,
     expected_exception,
 ):
-    video_id = "xVideoId"
-    video_formats = "format1,format2"
-    client_ip = "a.b.c.d"
-    authorization = "test-token"
+    response_cache = ResponseCache(max_size=10, ttl=10, stale_ttl=20)
+    session = MagicMock(aiohttp.ClientSession)
 
-    get_stream_urls.side_effect = get_stream_urls_side_effect
+    with freeze_time("2012-11-10T09:08:07Z") as frozen_time:
+        get_stream_urls.return_value = {"stream_format1_url": "stale"}
 
-    with expected_exception:
         await get_stream_urls_route(
-            video_id,
-            video_formats,
-            client_ip,
-            authorization,
+            "xVideoId",
+            "format1",
+            context=LookupContext(
+                session=session,
+                client_ip="a.b.c.d",
+                access_token=ACCESS_TOKEN,
+                response_cache=response_cache,
+            ),
         )
 
-    get_stream_urls.assert_awaited_once_with(
-        video_id=video_id,
-        video_formats=video_formats,
-        client_ip=client_ip,
-        authorization=authorization,
-    )
+        frozen_time.tick(15)
+        get_stream_urls.side_effect = get_stream_urls_side_effect
+
+        with expected_exception:
+            assert {"stream_format1_url": "stale"} == decode(
+                await get_stream_urls_route(
+                    "xVideoId",
+                    "format1",
+                    context=LookupContext(
+                        session=session,
+                        client_ip="a.b.c.d",
+                        access_token=ACCESS_TOKEN,
+                        response_cache=response_cache,
+                    ),
+                )
+            )
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.lookup.get_stream_urls")
+async def test_get_stream_urls_route_single_flight(get_stream_urls):
+    upstream_response = asyncio.Event()
+    session = MagicMock(aiohttp.ClientSession)
+
+    async def wait_for_upstream_response(**_):
+        await upstream_response.wait()
+
+        return {"stream_format1_url": "https://a.b/c"}
+
+    get_stream_urls.side_effect = wait_for_upstream_response
+
+    routes = [
+        asyncio.create_task(
+            get_stream_urls_route(
+                "xVideoId",
+                video_formats,
+                context=LookupContext(
+                    session=session,
+                    client_ip="a.b.c.d",
+                    access_token=ACCESS_TOKEN,
+                ),
+            )
+        )
+        for video_formats in ("format1", "format1", " format1")
+    ]
+
+    await asyncio.sleep(0)
+    upstream_response.set()
+
+    assert 3 * [{"stream_format1_url": "https://a.b/c"}] == [
+        decode(response) for response in await asyncio.gather(*routes)
+    ]
+    get_stream_urls.assert_awaited_once()
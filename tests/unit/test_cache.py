@@ -1,55 +1,181 @@
-from unittest.mock import AsyncMock, call, patch
+import asyncio
+
+from unittest.mock import AsyncMock, MagicMock, call, patch
 
 import pytest
 
 from freezegun import freeze_time
 from redis import exceptions
-from redis.asyncio import Redis
+from redis.asyncio import BlockingConnectionPool, Redis
 
 from dm_stream_urls_server.cache import (
-    get_cache,
+    AccessTokenRecord,
+    LocalAccessTokenCache,
+    acquire_refresh_lease,
+    create_cache,
+    get_access_token_key,
+    get_cache_pool_stats,
     is_access_token_expired,
+    is_refresh_lease_held,
+    pack_access_token_record,
     read_access_token,
+    read_access_token_with_ttl,
+    release_refresh_lease,
     store_access_token,
+    unpack_access_token_record,
+    watch_access_token_invalidation,
+)
+from dm_stream_urls_server.token_store import (
+    STORE_LEASED_ACCESS_TOKEN_SCRIPT,
+    RedisTokenStore,
 )
 
 
-@patch("dm_stream_urls_server.cache.Redis.from_url")
+def test_create_cache():
+    cache = create_cache()
+
+    assert isinstance(cache, Redis)
+    assert isinstance(cache.connection_pool, BlockingConnectionPool)
+    assert cache.auto_close_connection_pool
+    assert 50 == cache.connection_pool.max_connections
+    assert 1 == cache.connection_pool.timeout
+    assert {
+        "host": "localhost",
+        "health_check_interval": 30,
+        "socket_keepalive": True,
+    }.items() <= cache.connection_pool.connection_kwargs.items()
+
+
+@patch("dm_stream_urls_server.cache.BlockingConnectionPool.from_url")
+def test_create_cache_failure(pool_from_url):
+    pool_from_url.side_effect = exceptions.RedisError()
+
+    assert create_cache() is None
+
+
+@patch("dm_stream_urls_server.cache.CACHE_HOST", "")
+@patch("dm_stream_urls_server.cache.BlockingConnectionPool.from_url")
+def test_create_cache_disabled(pool_from_url):
+    assert create_cache() is None
+
+    pool_from_url.assert_not_called()
+
+
 @pytest.mark.parametrize(
-    "from_url_side_effect, expected_return",
+    "key_name, expected_return",
     (
-        (
-            (exceptions.RedisError(),),
-            None,
-        ),
-        (
-            (Redis(),),
-            Redis(),
-        ),
+        (None, "dailymotion_api_access_token"),
+        ("test-key", "dailymotion_api_access_token:test-key"),
     ),
 )
-def test_get_cache(
-    redis_from_url,
-    from_url_side_effect,
-    expected_return,
-):
-    redis_from_url.side_effect = from_url_side_effect
+def test_get_access_token_key(key_name, expected_return):
+    assert expected_return == get_access_token_key(
+        "dailymotion_api_access_token", key_name
+    )
+
+
+def test_get_cache_pool_stats():
+    redis = Redis.from_url("redis://localhost/", max_connections=10)
+
+    assert get_cache_pool_stats(redis) == {
+        "max_connections": 10,
+        "created_connections": 0,
+        "available_connections": 0,
+        "in_use_connections": 0,
+    }
+
+
+def test_get_cache_pool_stats_unknown():
+    redis = Redis.from_url("redis://localhost/", max_connections=10)
+    del redis.connection_pool._available_connections
+
+    assert get_cache_pool_stats(redis) == {
+        "max_connections": 10,
+        "created_connections": None,
+        "available_connections": None,
+        "in_use_connections": None,
+    }
 
-    assert isinstance(get_cache(), type(expected_return))
+
+# 2012-11-10T09:08:07Z
+NOW = 1352538487
+
+RECORD = AccessTokenRecord(
+    "test-access-token", NOW - 10, NOW + 90.5, NOW + 100
+)
+PACKED_RECORD = (
+    b"1:1352538477.000:1352538577.500:1352538587.000:test-access-token"
+)
+
+
+def create_redis(execute_side_effect):
+    pipe = MagicMock()
+    pipe.execute = AsyncMock(side_effect=execute_side_effect)
+
+    redis = MagicMock(Redis)
+    redis.set = AsyncMock()
+    redis.pipeline.return_value.__aenter__.return_value = pipe
+
+    return redis, pipe
+
+
+@pytest.mark.parametrize(
+    "record",
+    (
+        RECORD,
+        RECORD._replace(access_token="test:access:token"),
+    ),
+)
+def test_pack_access_token_record(record):
+    assert record == unpack_access_token_record(
+        pack_access_token_record(record).encode("utf8")
+    )
+
+
+@pytest.mark.parametrize(
+    "value",
+    (
+        b"2:" + PACKED_RECORD[2:],
+        b"2:legacy",
+        b"legacy-access-token",
+        b"1:1352538487.000:1352538577.000",
+        b"1:now:1352538577.000:1352538587.000:test-access-token",
+        b"",
+    ),
+)
+def test_unpack_access_token_record_invalid(value):
+    assert unpack_access_token_record(value) is None
+
+
+def test_unpack_access_token_record():
+    assert RECORD == unpack_access_token_record(PACKED_RECORD)
 
 
 @pytest.mark.asyncio
+@freeze_time("2012-11-10T09:08:07Z")
 @pytest.mark.parametrize(
-    "get_side_effect, expected_return",
+    "execute_side_effect, expected_return",
     (
         (
-            (None,),
+            ([None, None, -2],),
             True,
         ),
         (
-            (b"2010-09-08T07:06:05",),
+            ([PACKED_RECORD, None, -2],),
             False,
         ),
+        (
+            (
+                [
+                    pack_access_token_record(
+                        RECORD._replace(refresh_at=NOW)
+                    ).encode(),
+                    None,
+                    -2,
+                ],
+            ),
+            True,
+        ),
         (
             (exceptions.RedisError,),
             True,
@@ -57,25 +183,30 @@ def test_get_cache(
     ),
 )
 async def test_is_access_token_expired(
-    get_side_effect,
+    execute_side_effect,
     expected_return,
 ):
-    redis = AsyncMock(autospec=Redis)
-    redis.get.side_effect = get_side_effect
+    redis, pipe = create_redis(execute_side_effect)
 
-    assert expected_return == await is_access_token_expired(redis)
+    assert expected_return == await is_access_token_expired(
+        RedisTokenStore(redis)
+    )
+
+    pipe.get.assert_any_call("dailymotion_api_access_token_record")
+    pipe.execute.assert_awaited_once()
 
 
 @pytest.mark.asyncio
+@freeze_time("2012-11-10T09:08:07Z")
 @pytest.mark.parametrize(
-    "get_side_effect, expected_return",
+    "execute_side_effect, expected_return",
     (
         (
-            (None,),
+            ([None, None, -2],),
             None,
         ),
         (
-            (b"test-access-token",),
+            ([PACKED_RECORD, None, -2],),
             "test-access-token",
         ),
         (
@@ -85,33 +216,339 @@ async def test_is_access_token_expired(
     ),
 )
 async def test_read_access_token(
-    get_side_effect,
+    execute_side_effect,
     expected_return,
 ):
-    redis = AsyncMock(autospec=Redis)
-    redis.get.side_effect = get_side_effect
+    redis, _ = create_redis(execute_side_effect)
 
-    assert expected_return == await read_access_token(redis)
+    assert expected_return == await read_access_token(RedisTokenStore(redis))
 
 
 @pytest.mark.asyncio
 @freeze_time("2012-11-10T09:08:07Z")
-async def test_store_access_token():
+@pytest.mark.parametrize(
+    "record, expected_return",
+    (
+        (
+            RECORD,
+            ("test-access-token", 90.5),
+        ),
+        (
+            RECORD._replace(refresh_at=NOW - 1),
+            ("test-access-token", 0),
+        ),
+        (
+            RECORD._replace(refresh_at=NOW - 1, expires_at=NOW),
+            (None, 0),
+        ),
+    ),
+)
+async def test_read_access_token_with_ttl(record, expected_return):
+    redis, pipe = create_redis(
+        ([pack_access_token_record(record).encode(), None, -2],)
+    )
+
+    assert expected_return == await read_access_token_with_ttl(
+        RedisTokenStore(redis)
+    )
+
+    pipe.execute.assert_awaited_once()
+    redis.set.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+@freeze_time("2012-11-10T09:08:07Z")
+@pytest.mark.parametrize(
+    "execute_side_effect, expected_return",
+    (
+        (
+            ([None, None, -2],),
+            (None, 0),
+        ),
+        (
+            ([None, b"test-access-token", 90500],),
+            ("test-access-token", 90.5),
+        ),
+        (
+            ([None, b"test-access-token", -2],),
+            (None, 0),
+        ),
+        (
+            (exceptions.RedisError,),
+            (None, 0),
+        ),
+    ),
+)
+async def test_read_access_token_with_ttl_legacy(
+    execute_side_effect,
+    expected_return,
+):
+    redis, pipe = create_redis(execute_side_effect)
+
+    assert expected_return == await read_access_token_with_ttl(
+        RedisTokenStore(redis)
+    )
+
+    redis.pipeline.assert_called_once_with(transaction=False)
+    assert [
+        call("dailymotion_api_access_token_record"),
+        call("dailymotion_api_access_token"),
+    ] == pipe.get.call_args_list
+    pipe.pttl.assert_called_once_with("dailymotion_api_access_token_cached")
+
+    if expected_return[0]:
+        redis.set.assert_awaited_once_with(
+            "dailymotion_api_access_token_record",
+            "1:1352538487.000:1352538577.500:1352538577.500:"
+            "test-access-token",
+            pxat=1352538577500,
+            nx=True,
+        )
+    else:
+        redis.set.assert_not_awaited()
+
+
+def test_local_access_token_cache():
+    local_cache = LocalAccessTokenCache()
+
+    assert local_cache.get() is None
+
+    with freeze_time("2012-11-10T09:08:07Z") as frozen_time:
+        local_cache.set("test-access-token", 10)
+
+        assert "test-access-token" == local_cache.get()
+
+        frozen_time.tick(11)
+
+        assert local_cache.get() is None
+
+    local_cache.set("test-access-token", 10)
+    local_cache.clear()
+
+    assert local_cache.get() is None
+
+
+def test_local_access_token_cache_per_key():
+    local_cache = LocalAccessTokenCache()
+
+    assert local_cache.age() is None
+    assert local_cache.time_to_expiry() is None
+
+    with freeze_time("2012-11-10T09:08:07Z") as frozen_time:
+        local_cache.set("key-1-access-token", 10, "key-1", NOW - 30)
+        frozen_time.tick(2)
+        local_cache.set("key-2-access-token", 20, "key-2")
+
+        assert local_cache.get() is None
+        assert "key-1-access-token" == local_cache.get("key-1")
+        assert "key-2-access-token" == local_cache.get("key-2")
+        assert 32 == local_cache.age()
+        assert 8 == local_cache.time_to_expiry()
+
+        frozen_time.tick(8)
+
+        # Only the tokens still held count
+        assert 8 == local_cache.age()
+
+        local_cache.clear()
+
+        assert local_cache.get("key-1") is None
+        assert local_cache.get("key-2") is None
+
+
+@pytest.mark.asyncio
+async def test_watch_access_token_invalidation():
+    local_cache = LocalAccessTokenCache()
+    cleared = asyncio.Event()
+
+    async def listen():
+        local_cache.set("test-access-token", 60)
+
+        yield {"type": "subscribe"}
+
+        assert "test-access-token" == local_cache.get()
+
+        yield {"type": "message"}
+
+        assert local_cache.get() is None
+
+        cleared.set()
+
+        await asyncio.Event().wait()
+
+    redis = MagicMock(Redis)
+    pubsub = redis.pubsub.return_value.__aenter__.return_value
+    pubsub.subscribe = AsyncMock()
+    pubsub.listen = listen
+
+    task = asyncio.create_task(
+        watch_access_token_invalidation(RedisTokenStore(redis), local_cache)
+    )
+
+    await asyncio.wait_for(cleared.wait(), timeout=1)
+
+    task.cancel()
+
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    pubsub.subscribe.assert_awaited_once_with(
+        "dailymotion_api_access_token_invalidated"
+    )
+
+
+@pytest.mark.asyncio
+@freeze_time("2012-11-10T09:08:07Z")
+@pytest.mark.parametrize(
+    "key_name, expected_key",
+    (
+        (None, "dailymotion_api_access_token_record"),
+        ("test-key", "dailymotion_api_access_token_record:test-key"),
+    ),
+)
+async def test_store_access_token(key_name, expected_key):
+    redis, pipe = create_redis(([True, 1],))
+
+    await store_access_token(
+        RedisTokenStore(redis), "test-access-token", 100, key_name=key_name
+    )
+
+    redis.pipeline.assert_called_once_with(transaction=True)
+    pipe.set.assert_called_once_with(
+        expected_key,
+        "1:1352538487.000:1352538577.000:1352538587.000:test-access-token",
+        pxat=1352538587000,
+    )
+    pipe.publish.assert_called_once_with(
+        "dailymotion_api_access_token_invalidated",
+        "1352538577.000",
+    )
+    pipe.execute.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+@freeze_time("2012-11-10T09:08:07Z")
+@pytest.mark.parametrize("eval_return", (0, 1))
+async def test_store_leased_access_token(eval_return):
     redis = AsyncMock(autospec=Redis)
+    redis.eval.return_value = eval_return
 
-    await store_access_token(redis, "test-access-token", 100)
+    await store_access_token(
+        RedisTokenStore(redis),
+        "test-access-token",
+        100,
+        lease_owner="test-owner",
+    )
 
-    assert 2 == redis.set.call_count
-    redis.set.assert_has_awaits(
-        [
-            call(
-                "dailymotion_api_access_token",
-                "test-access-token",
-            ),
-            call(
-                "dailymotion_api_access_token_cached",
-                "2012-11-10 09:09:37",
-                ex=90,
-            ),
-        ]
+    redis.set.assert_not_awaited()
+    redis.eval.assert_awaited_once_with(
+        STORE_LEASED_ACCESS_TOKEN_SCRIPT,
+        2,
+        "dailymotion_api_access_token_refresh_lease",
+        "dailymotion_api_access_token_record",
+        "test-owner",
+        "1:1352538487.000:1352538577.000:1352538587.000:test-access-token",
+        1352538587000,
+        "dailymotion_api_access_token_invalidated",
+        "1352538577.000",
+    )
+
+
+@pytest.mark.asyncio
+async def test_access_token_record_redis():
+    fakeredis = pytest.importorskip("fakeredis")
+    redis = fakeredis.FakeAsyncRedis()
+
+    # Legacy keys are migrated to a record on first read
+    await redis.set("dailymotion_api_access_token", "legacy-access-token")
+    await redis.set("dailymotion_api_access_token_cached", "1", ex=90)
+
+    access_token, ttl = await read_access_token_with_ttl(
+        RedisTokenStore(redis)
+    )
+
+    assert "legacy-access-token" == access_token
+    assert 89 < ttl <= 90
+    assert await redis.exists("dailymotion_api_access_token_record")
+    assert not await is_access_token_expired(RedisTokenStore(redis))
+
+    await redis.set("dailymotion_api_access_token_refresh_lease", "owner")
+    await store_access_token(
+        RedisTokenStore(redis), "leased-access-token", 100, lease_owner="owner"
     )
+
+    access_token, ttl = await read_access_token_with_ttl(
+        RedisTokenStore(redis)
+    )
+
+    assert "leased-access-token" == access_token
+    assert 89 < ttl <= 90
+    assert 99000 < await redis.pttl("dailymotion_api_access_token_record")
+
+    await store_access_token(RedisTokenStore(redis), "new-access-token", 100)
+
+    assert "new-access-token" == await read_access_token(
+        RedisTokenStore(redis)
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "set_side_effect, expected_return",
+    (
+        ((True,), True),
+        ((None,), False),
+        ((exceptions.RedisError,), None),
+    ),
+)
+async def test_acquire_refresh_lease(set_side_effect, expected_return):
+    redis = AsyncMock(autospec=Redis)
+    redis.set.side_effect = set_side_effect
+
+    assert expected_return is await acquire_refresh_lease(
+        RedisTokenStore(redis), "test-owner", 10
+    )
+
+    redis.set.assert_awaited_once_with(
+        "dailymotion_api_access_token_refresh_lease",
+        "test-owner",
+        nx=True,
+        px=10000,
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "exists_side_effect, expected_return",
+    (
+        ((1,), True),
+        ((0,), False),
+        ((exceptions.RedisError,), False),
+    ),
+)
+async def test_is_refresh_lease_held(exists_side_effect, expected_return):
+    redis = AsyncMock(autospec=Redis)
+    redis.exists.side_effect = exists_side_effect
+
+    assert expected_return is await is_refresh_lease_held(
+        RedisTokenStore(redis), "test-key"
+    )
+
+    redis.exists.assert_awaited_once_with(
+        "dailymotion_api_access_token_refresh_lease:test-key"
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("eval_side_effect", ((1,), (exceptions.RedisError,)))
+async def test_release_refresh_lease(eval_side_effect):
+    redis = AsyncMock(autospec=Redis)
+    redis.eval.side_effect = eval_side_effect
+
+    await release_refresh_lease(RedisTokenStore(redis), "test-owner")
+
+    redis.eval.assert_awaited_once()
+    assert (
+        "dailymotion_api_access_token_refresh_lease",
+        "test-owner",
+    ) == redis.eval.await_args.args[2:]
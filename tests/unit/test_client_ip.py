@@ -0,0 +1,148 @@
+import aiohttp
+import pytest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from dm_stream_urls_server.client_ip import (
+    PublicIpResolver,
+    fetch_public_ip,
+    get_forwarded_client_ip,
+    parse_ip_address,
+    parse_trusted_proxies,
+)
+
+TRUSTED_PROXIES = parse_trusted_proxies("10.0.0.0/8, 2001:db8::/32")
+
+
+@pytest.fixture
+async def ifconfig_me():
+    """Local stand-in for ifconfig.me whose responses are set by the test"""
+
+    responses: list[web.Response] = []
+
+    async def all_json(_: web.Request) -> web.Response:
+        return responses.pop(0)
+
+    stub = web.Application()
+    stub.router.add_get("/all.json", all_json)
+
+    async with TestServer(stub) as server:
+        server.responses = responses
+
+        yield server
+
+
+@pytest.mark.parametrize(
+    "address, expected_return",
+    (
+        ("101.102.103.104", "101.102.103.104"),
+        (" 101.102.103.104:4711", "101.102.103.104"),
+        ('"[2001:db8:cafe::17]:4711"', "2001:db8:cafe::17"),
+        ("2001:db8:cafe::17", "2001:db8:cafe::17"),
+        ("unknown", None),
+        ("_hidden", None),
+    ),
+)
+def test_parse_ip_address(address, expected_return):
+    assert expected_return == parse_ip_address(address)
+
+
+@pytest.mark.parametrize(
+    "remote_ip, headers, expected_return",
+    (
+        (
+            "101.102.103.104",
+            {"x-forwarded-for": "201.202.203.204"},
+            "101.102.103.104",
+        ),
+        (
+            "10.0.0.1",
+            {},
+            "10.0.0.1",
+        ),
+        (
+            "10.0.0.1",
+            {"x-forwarded-for": "1.1.1.1, 201.202.203.204, 10.0.0.2"},
+            "201.202.203.204",
+        ),
+        (
+            "10.0.0.1",
+            {"x-forwarded-for": "unknown, 10.0.0.2"},
+            "10.0.0.2",
+        ),
+        (
+            "10.0.0.1",
+            {
+                "forwarded": (
+                    'for=201.202.203.204;proto=https, for="[2001:db8::1]"'
+                ),
+                "x-forwarded-for": "1.1.1.1",
+            },
+            "201.202.203.204",
+        ),
+        (
+            "10.0.0.1",
+            {"x-real-ip": "201.202.203.204"},
+            "201.202.203.204",
+        ),
+    ),
+)
+def test_get_forwarded_client_ip(remote_ip, headers, expected_return):
+    assert expected_return == get_forwarded_client_ip(
+        remote_ip, headers, TRUSTED_PROXIES
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "response, expected_return",
+    (
+        (
+            web.json_response({"ip_addr": "101.102.103.104"}),
+            "101.102.103.104",
+        ),
+        (
+            web.json_response({}, status=500),
+            None,
+        ),
+    ),
+)
+async def test_fetch_public_ip(ifconfig_me, response, expected_return):
+    ifconfig_me.responses.append(response)
+
+    async with aiohttp.ClientSession() as session:
+        assert expected_return == await fetch_public_ip(
+            session, str(ifconfig_me.make_url("/all.json")), timeout=1
+        )
+
+
+@pytest.mark.asyncio
+async def test_public_ip_resolver(ifconfig_me):
+    ifconfig_me.responses.extend(
+        [
+            web.json_response({}, status=503),
+            web.json_response({"ip_addr": "101.102.103.104"}),
+            web.json_response({}, status=503),
+        ]
+    )
+
+    resolver = PublicIpResolver(
+        url=str(ifconfig_me.make_url("/all.json")),
+        timeout=1,
+        retry_delay=0,
+    )
+
+    async with aiohttp.ClientSession() as session:
+        assert await resolver.get(session) is None
+        assert "101.102.103.104" == await resolver.get(session)
+
+        # Served from memory, no further request
+        assert "101.102.103.104" == await resolver.get(session)
+
+        # A failed refresh keeps the previous address
+        await resolver.refresh(session)
+
+        assert "101.102.103.104" == await resolver.get(session)
+
+    assert not ifconfig_me.responses
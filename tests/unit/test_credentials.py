@@ -0,0 +1,181 @@
+import json
+import os
+
+from unittest.mock import patch
+
+import pytest
+
+from freezegun import freeze_time
+
+from dm_stream_urls_server.credentials import (
+    Credential,
+    CredentialPool,
+    load_credentials,
+    parse_credentials,
+)
+
+
+def write_credentials(path, creds, mtime):
+    path.write_text(json.dumps(creds), encoding="utf8")
+    os.utime(path, (mtime, mtime))
+
+
+def test_load_credentials():
+    assert [
+        Credential(
+            "tests-fixtures-creds-client-id",
+            "tests-fixtures-creds-client-secret",
+        )
+    ] == load_credentials("tests/fixtures/creds.json")
+
+
+def test_parse_credentials():
+    assert [
+        Credential("id-1", "secret-1", weight=1, name="key-0"),
+        Credential("id-2", "secret-2", weight=3, name="partner-2"),
+    ] == parse_credentials(
+        [
+            {
+                "DAILYMOTION_API_KEY_ID": "id-1",
+                "DAILYMOTION_API_KEY_SECRET": "secret-1",
+            },
+            {
+                "DAILYMOTION_API_KEY_ID": "id-2",
+                "DAILYMOTION_API_KEY_SECRET": "secret-2",
+                "weight": 3,
+                "name": "partner-2",
+            },
+        ]
+    )
+
+
+@pytest.mark.parametrize(
+    "weights, expected_names",
+    (
+        ((1,), ["key-0"] * 4),
+        ((1, 1), ["key-0", "key-1", "key-0", "key-1"]),
+        (
+            (5, 1, 1),
+            ["key-0", "key-0", "key-1", "key-0", "key-2", "key-0", "key-0"],
+        ),
+    ),
+)
+def test_credential_pool_select(tmp_path, weights, expected_names):
+    path = tmp_path.joinpath("creds.json")
+    write_credentials(
+        path,
+        [
+            {
+                "DAILYMOTION_API_KEY_ID": f"id-{i}",
+                "DAILYMOTION_API_KEY_SECRET": f"secret-{i}",
+                "weight": weight,
+            }
+            for i, weight in enumerate(weights)
+        ],
+        mtime=1,
+    )
+    pool = CredentialPool(str(path), throttle_cooldown=60, reload_interval=5)
+
+    assert expected_names == [
+        pool.select().name for _ in range(len(expected_names))
+    ]
+
+
+def test_credential_pool_throttle(tmp_path):
+    path = tmp_path.joinpath("creds.json")
+    write_credentials(
+        path,
+        [
+            {
+                "DAILYMOTION_API_KEY_ID": f"id-{i}",
+                "DAILYMOTION_API_KEY_SECRET": f"secret-{i}",
+            }
+            for i in range(2)
+        ],
+        mtime=1,
+    )
+    pool = CredentialPool(str(path), throttle_cooldown=60, reload_interval=5)
+
+    with freeze_time("2024-01-01 00:00:00") as frozen_time:
+        pool.throttle("key-0")
+
+        assert ["key-1", "key-1"] == [pool.select().name for _ in range(2)]
+        assert not pool.stats()["key-0"]["available"]
+
+        pool.throttle("key-1", retry_after=10)
+
+        # Every key throttled, the one released the soonest is picked
+        assert "key-1" == pool.select().name
+
+        frozen_time.tick(61)
+
+        assert {"key-0", "key-1"} == {pool.select().name for _ in range(2)}
+        assert {
+            "key-0": {
+                "weight": 1,
+                "selected": 1,
+                "throttled": 1,
+                "available": True,
+            },
+            "key-1": {
+                "weight": 1,
+                "selected": 4,
+                "throttled": 1,
+                "available": True,
+            },
+        } == pool.stats()
+
+
+def test_credential_pool_reload(tmp_path):
+    path = tmp_path.joinpath("creds.json")
+    write_credentials(
+        path,
+        {
+            "DAILYMOTION_API_KEY_ID": "id-1",
+            "DAILYMOTION_API_KEY_SECRET": "secret-1",
+        },
+        mtime=1,
+    )
+    pool = CredentialPool(str(path), throttle_cooldown=60, reload_interval=5)
+
+    with freeze_time("2024-01-01 00:00:00") as frozen_time:
+        assert [Credential("id-1", "secret-1")] == pool.credentials
+
+        write_credentials(
+            path,
+            [
+                {
+                    "DAILYMOTION_API_KEY_ID": "id-2",
+                    "DAILYMOTION_API_KEY_SECRET": "secret-2",
+                }
+            ],
+            mtime=2,
+        )
+
+        # Not checked again before the reload interval
+        assert "id-1" == pool.select().key_id
+
+        frozen_time.tick(6)
+
+        assert "id-2" == pool.select().key_id
+
+        path.write_text("not json", encoding="utf8")
+        os.utime(path, (3, 3))
+        frozen_time.tick(6)
+
+        # The previous keys are kept when the file cannot be loaded
+        assert "id-2" == pool.select().key_id
+
+
+def test_credential_pool_missing_file(tmp_path):
+    pool = CredentialPool(
+        str(tmp_path.joinpath("missing.json")),
+        throttle_cooldown=60,
+        reload_interval=5,
+    )
+
+    with patch("dm_stream_urls_server.credentials.load_credentials") as load:
+        assert pool.select() is None
+
+    load.assert_not_called()
+    assert {} == pool.stats()
@@ -0,0 +1,213 @@
+from unittest.mock import MagicMock, Mock, patch
+
+import aiohttp
+import pytest
+
+from fastapi import HTTPException, Request
+from freezegun import freeze_time
+
+from dm_stream_urls_server.api import app
+from dm_stream_urls_server.client_ip import parse_trusted_proxies
+from dm_stream_urls_server.dependencies import (
+    enforce_rate_limits,
+    get_access_token,
+    get_cache,
+    get_client_ip,
+    get_connection_client_ip,
+    get_lookup_context,
+    get_token_store,
+    is_response_cache_bypassed,
+)
+from dm_stream_urls_server.lookup import LookupContext
+from dm_stream_urls_server.ratelimit import TokenBucketLimiter
+from dm_stream_urls_server.token import AccessToken
+from dm_stream_urls_server.token_store import MemoryTokenStore
+
+
+def test_get_cache():
+    cache = Mock()
+    app.state.cache = cache
+
+    assert cache is get_cache(Request(scope={"type": "http", "app": app}))
+
+
+def test_get_token_store():
+    token_store = MemoryTokenStore()
+    app.state.token_store = token_store
+
+    assert token_store is get_token_store(
+        Request(scope={"type": "http", "app": app})
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "fastapi_request, expected_return",
+    (
+        (Request(scope={"type": "http"}), None),
+        (Request(scope={"type": "http", "client": None}), None),
+        (
+            Request(
+                scope={"type": "http", "client": ("101.102.103.104", None)}
+            ),
+            "101.102.103.104",
+        ),
+        (
+            Request(
+                scope={"type": "http", "client": ("101.102.103.104", 6128)}
+            ),
+            "101.102.103.104",
+        ),
+    ),
+)
+async def test_get_connection_client_ip(fastapi_request, expected_return):
+    assert expected_return == await get_connection_client_ip(
+        request=fastapi_request,
+        session=MagicMock(aiohttp.ClientSession),
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "client_ip, connection_client_ip, expected_return",
+    (
+        (None, None, None),
+        (None, "101.102.103.104", "101.102.103.104"),
+        ("201.202.203.204", "101.102.103.104", "201.202.203.204"),
+    ),
+)
+async def test_get_client_ip(client_ip, connection_client_ip, expected_return):
+    assert expected_return == await get_client_ip(
+        client_ip=client_ip,
+        connection_client_ip=connection_client_ip,
+    )
+
+
+@patch("dm_stream_urls_server.api.public_ip_resolver.get")
+async def test_get_client_private_ip(mock_public_ip_resolver_get):
+    session = MagicMock(aiohttp.ClientSession)
+
+    await get_connection_client_ip(
+        request=Request(
+            scope={"type": "http", "client": ("10.11.12.13", None)}
+        ),
+        session=session,
+    )
+
+    mock_public_ip_resolver_get.assert_awaited_once_with(session)
+
+
+@patch(
+    "dm_stream_urls_server.dependencies.trusted_proxies",
+    parse_trusted_proxies("10.0.0.0/8"),
+)
+async def test_get_client_forwarded_ip():
+    assert "101.102.103.104" == await get_connection_client_ip(
+        request=Request(
+            scope={
+                "type": "http",
+                "client": ("10.11.12.13", None),
+                "headers": [(b"x-forwarded-for", b"101.102.103.104")],
+            }
+        ),
+        session=MagicMock(aiohttp.ClientSession),
+    )
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.dependencies.get_dailymotion_api_access_token")
+async def test_get_access_token(
+    get_cached_dailymotion_api_access_token,
+):
+    cache = Mock()
+    session = MagicMock(aiohttp.ClientSession)
+
+    await get_access_token(cache, session)
+
+    get_cached_dailymotion_api_access_token.assert_awaited_once_with(
+        cache, session
+    )
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.dependencies.get_dailymotion_api_access_token")
+async def test_get_access_token_unavailable(
+    get_cached_dailymotion_api_access_token,
+):
+    get_cached_dailymotion_api_access_token.return_value = None
+
+    with pytest.raises(HTTPException) as exc_info:
+        await get_access_token(Mock(), MagicMock(aiohttp.ClientSession))
+
+    assert 503 == exc_info.value.status_code
+
+
+@pytest.mark.asyncio
+@freeze_time("2024-01-01 00:00:00")
+async def test_enforce_rate_limits():
+    app.state.client_rate_limiter = TokenBucketLimiter(
+        "client", rate=1, burst=3
+    )
+    app.state.video_rate_limiter = TokenBucketLimiter("video", rate=1, burst=1)
+
+    def create_request(query_string):
+        return Request(
+            scope={"type": "http", "app": app, "query_string": query_string}
+        )
+
+    await enforce_rate_limits(create_request(b"video_id=x1"), "a.b.c.d")
+
+    with pytest.raises(HTTPException) as exc_info:
+        await enforce_rate_limits(create_request(b"video_id=x1"), "a.b.c.d")
+
+    assert exc_info.value.status_code == 429
+    assert exc_info.value.headers == {"Retry-After": "1"}
+
+    # No token was taken from the client by the rejected request
+    await enforce_rate_limits(create_request(b"video_id=x2"), "a.b.c.d")
+    await enforce_rate_limits(create_request(b""), "a.b.c.d")
+    await enforce_rate_limits(create_request(b"video_id=x1"), "e.f.g.h")
+
+    with pytest.raises(HTTPException):
+        await enforce_rate_limits(create_request(b""), "a.b.c.d")
+
+    assert 1 == app.state.client_rate_limiter.rejected
+    assert 1 == app.state.video_rate_limiter.rejected
+
+    # Clients whose IP address is not resolved do not share a bucket
+    for _ in range(5):
+        await enforce_rate_limits(create_request(b"video_id=x1"), None)
+
+
+@pytest.mark.parametrize(
+    "headers, expected_return",
+    (
+        ([], False),
+        ([(b"cache-control", b"max-age=0")], False),
+        ([(b"cache-control", b"no-cache")], True),
+    ),
+)
+def test_is_response_cache_bypassed(headers, expected_return):
+    assert expected_return == is_response_cache_bypassed(
+        Request(scope={"type": "http", "headers": headers})
+    )
+
+
+@pytest.mark.asyncio
+async def test_get_lookup_context():
+    session = MagicMock(aiohttp.ClientSession)
+    access_token = AccessToken("test-token", "test-key")
+
+    assert LookupContext(
+        session=session,
+        client_ip="a.b.c.d",
+        access_token=access_token,
+        bypass_response_cache=True,
+    ) == await get_lookup_context(
+        client_ip="a.b.c.d",
+        access_token=access_token,
+        session=session,
+        response_cache=None,
+        bypass_response_cache=True,
+        video_metadata_cache=None,
+    )
@@ -0,0 +1,22 @@
+from unittest.mock import patch
+
+import pytest
+
+from dm_stream_urls_server.json_codec import (
+    FastJSONResponse,
+    json_dumps,
+    json_loads,
+)
+
+CONTENT = {"stream_h264_url": "https://a.b/c?d=e&f=g", "title": "Café"}
+BODY = '{"stream_h264_url":"https://a.b/c?d=e&f=g","title":"Café"}'.encode()
+
+
+@pytest.mark.parametrize("json_library", ("orjson", None))
+def test_json_codec(json_library):
+    orjson = pytest.importorskip(json_library) if json_library else None
+
+    with patch("dm_stream_urls_server.json_codec.orjson", orjson):
+        assert BODY == json_dumps(CONTENT)
+        assert CONTENT == json_loads(BODY)
+        assert BODY == FastJSONResponse(CONTENT).body
@@ -0,0 +1,178 @@
+import io
+import json
+import logging
+
+import pytest
+
+from freezegun import freeze_time
+
+from dm_stream_urls_server.logs import (
+    TEXT_FORMAT,
+    BackgroundQueueHandler,
+    JSONFormatter,
+    RateLimitFilter,
+    TextFormatter,
+    create_log_handler,
+    get_logging_config,
+    parse_log_levels,
+)
+
+
+def create_record(msg="Failed: exception_type=%s", args=("Error",), **kwargs):
+    return logging.LogRecord(
+        name="dm_stream_urls_server.api",
+        level=kwargs.pop("level", logging.WARNING),
+        pathname=__file__,
+        lineno=1,
+        msg=msg,
+        args=args,
+        exc_info=kwargs.pop("exc_info", None),
+    )
+
+
+def test_json_formatter():
+    record = create_record()
+    record.suppressed = 3
+
+    assert {
+        "time": record.created,
+        "level": "WARNING",
+        "logger": "dm_stream_urls_server.api",
+        "message": "Failed: exception_type=Error",
+        "suppressed": 3,
+    } == json.loads(JSONFormatter().format(record))
+
+
+def test_json_formatter_exception():
+    try:
+        raise ValueError("test")
+    except ValueError as e:
+        record = create_record(exc_info=(type(e), e, e.__traceback__))
+
+    assert (
+        "ValueError: test"
+        in json.loads(JSONFormatter().format(record))["exc_info"]
+    )
+
+
+def test_text_formatter():
+    record = create_record()
+
+    assert TextFormatter("%(message)s").format(record) == (
+        "Failed: exception_type=Error"
+    )
+
+    record.suppressed = 3
+
+    assert TextFormatter("%(message)s").format(record) == (
+        "Failed: exception_type=Error (suppressed=3)"
+    )
+
+
+def test_rate_limit_filter():
+    rate_limit_filter = RateLimitFilter(burst=2, interval=10)
+
+    with freeze_time("2024-01-01 00:00:00") as frozen_time:
+        assert [True, True, False, False] == [
+            rate_limit_filter.filter(create_record(args=(i,)))
+            for i in range(4)
+        ]
+
+        # Other messages and levels below warnings are let through
+        assert rate_limit_filter.filter(create_record(msg="Other"))
+        assert rate_limit_filter.filter(create_record(level=logging.INFO))
+
+        frozen_time.tick(11)
+        record = create_record()
+
+        assert rate_limit_filter.filter(record)
+        assert 2 == record.suppressed
+        assert 2 == rate_limit_filter.suppressed
+
+
+def test_rate_limit_filter_disabled():
+    rate_limit_filter = RateLimitFilter(burst=1, interval=0)
+
+    assert all(rate_limit_filter.filter(create_record()) for _ in range(3))
+
+
+def test_background_queue_handler():
+    stream = io.StringIO()
+    stream_handler = logging.StreamHandler(stream)
+    stream_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    handler = BackgroundQueueHandler(stream_handler)
+    args = ["mutable"]
+
+    try:
+        raise ValueError("test")
+    except ValueError as e:
+        handler.handle(
+            create_record(
+                msg="Failed: %s",
+                args=(args,),
+                exc_info=(type(e), e, e.__traceback__),
+            )
+        )
+
+    args.append("changed")
+    handler.close()
+
+    output = stream.getvalue()
+
+    assert "WARNING - Failed: ['mutable']\n" in output
+    assert "ValueError: test" in output
+
+
+@pytest.mark.parametrize(
+    "log_format, queue_enabled, expected_formatter, expected_handler",
+    (
+        ("text", False, TextFormatter, logging.StreamHandler),
+        ("json", True, JSONFormatter, BackgroundQueueHandler),
+    ),
+)
+def test_create_log_handler(
+    log_format,
+    queue_enabled,
+    expected_formatter,
+    expected_handler,
+):
+    handler = create_log_handler(log_format, queue_enabled)
+
+    try:
+        assert isinstance(handler, expected_handler)
+
+        if queue_enabled:
+            handler = handler.listener.handlers[0]
+
+        assert isinstance(handler.formatter, expected_formatter)
+    finally:
+        handler.close()
+
+
+def test_parse_log_levels():
+    assert {"root": "INFO", "uvicorn.access": "WARNING"} == parse_log_levels(
+        "root=info, uvicorn.access=WARNING,"
+    )
+
+
+def test_get_logging_config():
+    config = get_logging_config("json", "root=INFO,asyncio=ERROR", True, 5, 60)
+
+    assert "INFO" == config["root"]["level"]
+    assert {
+        "asyncio": {"level": "ERROR"},
+        "dm_stream_urls_server": {"level": "DEBUG"},
+    } == config["loggers"]
+    assert {
+        "()": RateLimitFilter,
+        "burst": 5,
+        "interval": 60,
+    } == config[
+        "filters"
+    ]["rate_limit"]
+    assert {
+        "()": create_log_handler,
+        "log_format": "json",
+        "queue_enabled": True,
+        "filters": ["rate_limit"],
+    } == config["handlers"]["console"]
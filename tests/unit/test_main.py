@@ -0,0 +1,134 @@
+import logging
+
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from click.testing import CliRunner
+
+from dm_stream_urls_server.__main__ import prefetch_video_metadata, start_api
+from dm_stream_urls_server.token import AccessToken
+
+
+@patch("uvicorn.run")
+@pytest.mark.parametrize(
+    "args, env, expected_options",
+    (
+        (
+            [],
+            {},
+            {
+                "host": "0.0.0.0",  # nosec
+                "port": 8000,
+                "workers": 1,
+                "backlog": 2048,
+                "timeout_keep_alive": 5,
+                "loop": "auto",
+                "http": "auto",
+                "access_log": True,
+                "log_level": logging.DEBUG,
+            },
+        ),
+        (
+            [
+                "--workers",
+                "4",
+                "--loop",
+                "uvloop",
+                "--http",
+                "httptools",
+                "--no-access-log",
+            ],
+            {
+                "API_PORT": "8080",
+                "API_BACKLOG": "4096",
+                "API_LOG_LEVEL": "warning",
+            },
+            {
+                "host": "0.0.0.0",  # nosec
+                "port": 8080,
+                "workers": 4,
+                "backlog": 4096,
+                "timeout_keep_alive": 5,
+                "loop": "uvloop",
+                "http": "httptools",
+                "access_log": False,
+                "log_level": logging.WARNING,
+            },
+        ),
+    ),
+)
+def test_start_api(uvicorn_run, args, env, expected_options):
+    result = CliRunner().invoke(start_api, args, env=env)
+
+    assert 0 == result.exit_code, result.output
+    uvicorn_run.assert_called_once_with(
+        "dm_stream_urls_server.api:app",
+        **expected_options,
+        log_config=None,
+        reload=False,
+    )
+
+
+def test_start_api_invalid_loop():
+    result = CliRunner().invoke(start_api, ["--loop", "trio"])
+
+    assert 2 == result.exit_code
+
+
+@patch("dm_stream_urls_server.config.VIDEO_METADATA_REDIS_ENABLED", True)
+@patch("dm_stream_urls_server.prefetch.prefetch_video_metadata")
+@patch("dm_stream_urls_server.token.get_dailymotion_api_access_token")
+@patch("dm_stream_urls_server.cache.create_cache")
+def test_prefetch_video_metadata(
+    create_cache, get_access_token, m_prefetch_video_metadata
+):
+    create_cache.return_value = MagicMock(close=AsyncMock())
+    get_access_token.return_value = AccessToken("test-token")
+    m_prefetch_video_metadata.return_value = [
+        {"video_id": "x1", "status_code": 200, "formats": {"f1": True}},
+        {"video_id": "x2", "status_code": 404, "formats": {}},
+    ]
+
+    result = CliRunner().invoke(
+        prefetch_video_metadata,
+        ["x1", "--video-formats", "f1", "--video-ids-file", "-"],
+        input="x2\nx1\n\n",
+    )
+
+    assert 0 == result.exit_code, result.output
+    assert [
+        '{"video_id": "x1", "status_code": 200, "formats": {"f1": true}}',
+        '{"video_id": "x2", "status_code": 404, "formats": {}}',
+    ] == result.output.splitlines()
+
+    (_, _, video_ids, video_formats, access_token), _ = (
+        m_prefetch_video_metadata.call_args
+    )
+
+    assert ["x1", "x2"] == list(video_ids)
+    assert ("f1", AccessToken("test-token")) == (video_formats, access_token)
+    create_cache.return_value.close.assert_awaited_once()
+
+
+@patch("dm_stream_urls_server.config.VIDEO_METADATA_REDIS_ENABLED", True)
+@patch("dm_stream_urls_server.cache.create_cache", return_value=None)
+def test_prefetch_video_metadata_without_cache(_):
+    result = CliRunner().invoke(
+        prefetch_video_metadata, ["x1", "--video-formats", "f1"]
+    )
+
+    assert 1 == result.exit_code
+    assert "Redis is required" in result.output
+
+
+@patch("dm_stream_urls_server.config.VIDEO_METADATA_REDIS_ENABLED", False)
+@patch("dm_stream_urls_server.cache.create_cache")
+def test_prefetch_video_metadata_without_redis_tier(create_cache):
+    result = CliRunner().invoke(
+        prefetch_video_metadata, ["x1", "--video-formats", "f1"]
+    )
+
+    assert 1 == result.exit_code
+    assert "VIDEO_METADATA_REDIS_ENABLED=1 is required" in result.output
+    create_cache.assert_not_called()
@@ -0,0 +1,146 @@
+from unittest.mock import MagicMock
+
+import aiohttp
+import pytest
+
+from freezegun import freeze_time
+from yarl import URL
+
+from dm_stream_urls_server.manifest import (
+    get_manifest_cache_key,
+    is_vod_manifest,
+    resolve_manifest_line,
+    stream_manifest,
+)
+from dm_stream_urls_server.response_cache import ResponseCache
+
+BASE_URL = "https://cdn.example/hls/x8abcd/manifest.m3u8?sec=token"
+
+LIVE_MANIFEST = [
+    b"#EXTM3U\n",
+    b"#EXT-X-MEDIA-SEQUENCE:42\n",
+    b"#EXTINF:2.0,\n",
+    b"segment42.ts\n",
+]
+VOD_MANIFEST = [
+    b"#EXTM3U\n",
+    b"#EXT-X-PLAYLIST-TYPE:VOD\n",
+    b"#EXTINF:2.0,\n",
+    b"segment1.ts\n",
+    b"#EXT-X-ENDLIST\n",
+]
+
+
+async def iterate(lines):
+    for line in lines:
+        yield line
+
+
+def create_response(lines):
+    response = MagicMock(aiohttp.ClientResponse)
+    response.url = URL(BASE_URL)
+    response.content = iterate(lines)
+
+    return response
+
+
+def test_get_manifest_cache_key():
+    assert "dailymotion_stream_manifest:xVideoId:a.b.c.d" == (
+        get_manifest_cache_key("xVideoId", "a.b.c.d")
+    )
+
+
+@pytest.mark.parametrize(
+    "manifest, expected_return",
+    (
+        (b"".join(LIVE_MANIFEST), False),
+        (b"".join(VOD_MANIFEST), True),
+        (b"#EXTM3U\n#EXT-X-ENDLIST\n", True),
+    ),
+)
+def test_is_vod_manifest(manifest, expected_return):
+    assert expected_return == is_vod_manifest(manifest)
+
+
+@pytest.mark.parametrize(
+    "line, expected_return",
+    (
+        (b"\n", b"\n"),
+        (b"#EXTINF:2.0,\n", b"#EXTINF:2.0,\n"),
+        (
+            b"segment1.ts\r\n",
+            b"https://cdn.example/hls/x8abcd/segment1.ts\r\n",
+        ),
+        (b"/other/720.m3u8", b"https://cdn.example/other/720.m3u8"),
+        (
+            b"https://other.example/720.m3u8\n",
+            b"https://other.example/720.m3u8\n",
+        ),
+        (
+            b'#EXT-X-KEY:METHOD=AES-128,URI="key.bin",IV=0x1\n',
+            b"#EXT-X-KEY:METHOD=AES-128,"
+            b'URI="https://cdn.example/hls/x8abcd/key.bin",IV=0x1\n',
+        ),
+    ),
+)
+def test_resolve_manifest_line(line, expected_return):
+    assert expected_return == resolve_manifest_line(line, BASE_URL)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "lines, live, expected_ttl",
+    (
+        (LIVE_MANIFEST, None, 2),
+        (VOD_MANIFEST, None, 30),
+        (VOD_MANIFEST, True, 2),
+        (LIVE_MANIFEST, False, 30),
+    ),
+)
+async def test_stream_manifest(lines, live, expected_ttl):
+    manifest_cache = ResponseCache(max_size=10, ttl=30)
+    response = create_response(lines)
+
+    with freeze_time("2024-01-01 00:00:00") as frozen_time:
+        manifest = b"".join(
+            [
+                chunk
+                async for chunk in stream_manifest(
+                    response,
+                    manifest_cache,
+                    "key",
+                    live=live,
+                    live_ttl=2,
+                    vod_ttl=30,
+                )
+            ]
+        )
+
+        assert b"https://cdn.example/hls/x8abcd/segment" in manifest
+        assert manifest == await manifest_cache.get("key")
+
+        frozen_time.tick(expected_ttl + 1)
+
+        assert await manifest_cache.get("key") is None
+
+    response.release.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_stream_manifest_too_large():
+    manifest_cache = ResponseCache(max_size=10, ttl=30)
+    response = create_response(VOD_MANIFEST)
+
+    async for _ in stream_manifest(
+        response,
+        manifest_cache,
+        "key",
+        live=None,
+        live_ttl=2,
+        vod_ttl=30,
+        max_cached_size=10,
+    ):
+        pass
+
+    assert await manifest_cache.get("key") is None
+    response.release.assert_called_once()
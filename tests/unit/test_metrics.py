@@ -0,0 +1,81 @@
+import pytest
+
+from dm_stream_urls_server.metrics import (
+    CallbackMetric,
+    Counter,
+    Histogram,
+    MetricsMiddleware,
+    Registry,
+    request_duration,
+)
+
+
+def test_registry_render():
+    registry = Registry()
+
+    counter: Counter = registry.register(
+        Counter("test_total", "Test counter", labelnames=("status_code",))
+    )
+    histogram: Histogram = registry.register(
+        Histogram("test_seconds", "Test histogram", buckets=(0.1, 1.0))
+    )
+    registry.register(
+        CallbackMetric(
+            "test_connections",
+            "Test gauge",
+            lambda: ((("idle",), 3), (("busy",), None)),
+            labelnames=("state",),
+        )
+    )
+
+    counter.labels("200").inc()
+    counter.labels("200").inc()
+    counter.labels("404").inc()
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert registry.render() == (
+        "# HELP test_total Test counter\n"
+        "# TYPE test_total counter\n"
+        'test_total{status_code="200"} 2.0\n'
+        'test_total{status_code="404"} 1.0\n'
+        "# HELP test_seconds Test histogram\n"
+        "# TYPE test_seconds histogram\n"
+        'test_seconds_bucket{le="0.1"} 1\n'
+        'test_seconds_bucket{le="1.0"} 2\n'
+        'test_seconds_bucket{le="+Inf"} 3\n'
+        "test_seconds_sum 5.55\n"
+        "test_seconds_count 3\n"
+        "# HELP test_connections Test gauge\n"
+        "# TYPE test_connections gauge\n"
+        'test_connections{state="idle"} 3\n'
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "path, expected_route",
+    (
+        ("/stream-urls", "/stream-urls"),
+        ("/random-path", "other"),
+    ),
+)
+async def test_metrics_middleware(path, expected_route):
+    messages = []
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 204})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def send(message):
+        messages.append(message)
+
+    middleware = MetricsMiddleware(app, routes=("/stream-urls",))
+    histogram = request_duration.labels(expected_route, "204")
+    count = sum(histogram.counts)
+
+    await middleware({"type": "http", "path": path}, None, send)
+
+    assert 2 == len(messages)
+    assert count + 1 == sum(histogram.counts)
@@ -0,0 +1,203 @@
+import asyncio
+
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import aiohttp
+import pytest
+
+from freezegun import freeze_time
+
+from dm_stream_urls_server.prefetch import (
+    get_video_metadata_cache_key,
+    prefetch_video_metadata,
+    request_video_metadata,
+    warm_up,
+)
+from dm_stream_urls_server.response_cache import ResponseCache
+from dm_stream_urls_server.token import AccessToken
+
+ACCESS_TOKEN = AccessToken("test-token", "test-key")
+
+
+def create_response_error(status):
+    return aiohttp.ClientResponseError(
+        request_info=None,
+        history=(),
+        status=status,
+        message="Error",
+    )
+
+
+def test_get_video_metadata_cache_key():
+    assert "dailymotion_video_metadata:xVideoId" == (
+        get_video_metadata_cache_key("xVideoId")
+    )
+    assert "dailymotion_video_metadata:xVideoId:a.b.c.d" == (
+        get_video_metadata_cache_key("xVideoId", "a.b.c.d")
+    )
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.prefetch.request_stream_urls")
+async def test_request_video_metadata(request_stream_urls):
+    session = MagicMock(aiohttp.ClientSession)
+    request_stream_urls.return_value = (
+        b'{"stream_h264_url": "https://a.b/c", "stream_hls_url": null}'
+    )
+
+    assert {
+        "status_code": 200,
+        "formats": {"stream_h264_url": True, "stream_hls_url": False},
+    } == await request_video_metadata(
+        session, "xVideoId", "stream_h264_url, stream_hls_url,", ACCESS_TOKEN
+    )
+
+    request_stream_urls.assert_awaited_once_with(
+        session,
+        "xVideoId",
+        "stream_h264_url,stream_hls_url",
+        None,
+        "test-token",
+        key_name="test-key",
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "status, expected_exception",
+    (
+        (403, aiohttp.ClientResponseError),
+        (404, None),
+        (500, aiohttp.ClientResponseError),
+    ),
+)
+@patch("dm_stream_urls_server.prefetch.request_stream_urls")
+async def test_request_video_metadata_unavailable(
+    request_stream_urls, status, expected_exception
+):
+    request_stream_urls.side_effect = create_response_error(status)
+
+    if expected_exception:
+        with pytest.raises(expected_exception):
+            await request_video_metadata(
+                MagicMock(), "xVideoId", "stream_h264_url", ACCESS_TOKEN
+            )
+    else:
+        assert {"status_code": status, "formats": {}} == (
+            await request_video_metadata(
+                MagicMock(), "xVideoId", "stream_h264_url", ACCESS_TOKEN
+            )
+        )
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.prefetch.request_video_metadata")
+async def test_prefetch_video_metadata(request_video_metadata):
+    video_metadata_cache = ResponseCache(max_size=10, ttl=60)
+
+    async def get_video_metadata(_, video_id, *__):
+        if video_id == "xFailing":
+            raise asyncio.TimeoutError()
+
+        return {"status_code": 200, "formats": {"stream_h264_url": True}}
+
+    request_video_metadata.side_effect = get_video_metadata
+
+    assert [
+        {
+            "video_id": "xVideoId",
+            "status_code": 200,
+            "formats": {"stream_h264_url": True},
+        },
+        {"video_id": "xFailing", "error": "TimeoutError"},
+    ] == await prefetch_video_metadata(
+        MagicMock(),
+        video_metadata_cache,
+        ["xVideoId", "xFailing"],
+        "stream_h264_url",
+        ACCESS_TOKEN,
+        concurrency=2,
+    )
+
+    assert {"status_code": 200} == (
+        await video_metadata_cache.get(
+            get_video_metadata_cache_key("xVideoId")
+        )
+    )
+    assert (
+        await video_metadata_cache.get(
+            get_video_metadata_cache_key("xFailing")
+        )
+        is None
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "negative_cache_ttl, expected_metadata",
+    ((30, {"status_code": 404}), (0, None)),
+)
+@patch("dm_stream_urls_server.prefetch.request_video_metadata")
+async def test_prefetch_video_metadata_unavailable(
+    request_video_metadata, negative_cache_ttl, expected_metadata
+):
+    video_metadata_cache = ResponseCache(max_size=10, ttl=900)
+    request_video_metadata.return_value = {"status_code": 404, "formats": {}}
+
+    with (
+        freeze_time("2024-01-01 00:00:00") as frozen_time,
+        patch(
+            "dm_stream_urls_server.prefetch.NEGATIVE_CACHE_TTL",
+            negative_cache_ttl,
+        ),
+    ):
+        await prefetch_video_metadata(
+            MagicMock(),
+            video_metadata_cache,
+            ["xNotFound"],
+            "stream_h264_url",
+            ACCESS_TOKEN,
+            concurrency=1,
+        )
+
+        assert expected_metadata == await video_metadata_cache.get(
+            get_video_metadata_cache_key("xNotFound")
+        )
+
+        # Kept for the negative cache TTL, not the video metadata one
+        frozen_time.tick(31)
+
+        assert (
+            await video_metadata_cache.get(
+                get_video_metadata_cache_key("xNotFound")
+            )
+            is None
+        )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("cache", (None, MagicMock()))
+@patch("dm_stream_urls_server.prefetch.get_dailymotion_api_access_token")
+@patch("dm_stream_urls_server.prefetch.warm_up_http_session")
+async def test_warm_up(warm_up_http_session, get_access_token, cache):
+    session = MagicMock(aiohttp.ClientSession)
+
+    await warm_up(cache, session, "https://a.b", connections=4, timeout=1)
+
+    warm_up_http_session.assert_awaited_once_with(session, "https://a.b", 4)
+
+    if cache:
+        get_access_token.assert_awaited_once_with(cache, session)
+    else:
+        get_access_token.assert_not_called()
+
+
+@pytest.mark.asyncio
+@patch(
+    "dm_stream_urls_server.prefetch.warm_up_http_session",
+    AsyncMock(side_effect=aiohttp.ClientConnectionError()),
+)
+async def test_warm_up_failure(caplog):
+    await warm_up(None, MagicMock(), "https://a.b", connections=4, timeout=1)
+
+    assert "Failed to warm up" in caplog.text
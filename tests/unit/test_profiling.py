@@ -0,0 +1,106 @@
+import asyncio
+import marshal
+import sys
+import time
+
+from collections import Counter
+
+import pytest
+
+from dm_stream_urls_server.profiling import (
+    ProfilerBusyError,
+    format_collapsed_stacks,
+    format_stack,
+    get_pending_tasks_stats,
+    profile_calls,
+    profile_stacks,
+    profiling_lock,
+)
+
+
+def test_format_stack():
+    stack = format_stack(sys._getframe(), None)
+
+    assert stack.startswith("<idle>;")
+    assert stack.endswith("test_profiling:test_format_stack")
+
+
+def test_format_collapsed_stacks():
+    assert "a;b 3\na;c 1\n" == format_collapsed_stacks(
+        Counter({"a;c": 1, "a;b": 3})
+    )
+
+
+@pytest.mark.asyncio
+async def test_profile_stacks():
+    async def block():
+        await asyncio.sleep(0.01)
+        time.sleep(0.05)
+
+    task = asyncio.create_task(block())
+    stacks = await profile_stacks(0.1, 0.001)
+    await task
+
+    # Rooted at the coroutine of the task, down to the frame blocking the loop
+    assert any(
+        line.startswith("test_profile_stacks.<locals>.block;")
+        and ":test_profile_stacks.<locals>.block " in line
+        for line in stacks.splitlines()
+    )
+    assert any(line.startswith("<idle>;") for line in stacks.splitlines())
+
+
+@pytest.mark.asyncio
+async def test_profile_calls():
+    def compute():
+        return sum(range(1000))
+
+    async def call():
+        await asyncio.sleep(0.01)
+        compute()
+
+    task = asyncio.create_task(call())
+    stats = marshal.loads(await profile_calls(0.05))
+    await task
+
+    assert any(function == "compute" for _, _, function in stats)
+
+
+@pytest.mark.asyncio
+async def test_profile_busy():
+    async with profiling_lock:
+        with pytest.raises(ProfilerBusyError):
+            await profile_stacks(0.01, 0.001)
+
+        with pytest.raises(ProfilerBusyError):
+            await profile_calls(0.01)
+
+
+@pytest.mark.asyncio
+async def test_get_pending_tasks_stats():
+    event = asyncio.Event()
+
+    async def wait():
+        await event.wait()
+
+    tasks = [asyncio.create_task(wait()) for _ in range(3)]
+    await asyncio.sleep(0)
+
+    try:
+        stats = get_pending_tasks_stats()
+    finally:
+        event.set()
+        await asyncio.gather(*tasks)
+
+    wait_stats = next(
+        coroutine_stats
+        for coroutine_stats in stats
+        if coroutine_stats["coroutine"]
+        == "test_get_pending_tasks_stats.<locals>.wait"
+    )
+
+    assert 3 == wait_stats["count"]
+    assert [3] == list(wait_stats["awaiting"].values())
+    assert next(iter(wait_stats["awaiting"])).startswith(
+        "asyncio.locks:Event.wait:"
+    )
@@ -0,0 +1,165 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from freezegun import freeze_time
+from redis import exceptions
+
+from dm_stream_urls_server.ratelimit import (
+    RateLimitExceededError,
+    TokenBucketLimiter,
+)
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_limiter():
+    limiter = TokenBucketLimiter("client", rate=2, burst=3)
+
+    with freeze_time("2024-01-01 00:00:00") as frozen_time:
+        for _ in range(3):
+            await limiter.acquire("a.b.c.d")
+
+        with pytest.raises(RateLimitExceededError) as exc_info:
+            await limiter.acquire("a.b.c.d")
+
+        assert "client" == exc_info.value.scope
+        assert 0.5 == exc_info.value.retry_after
+
+        await limiter.acquire("e.f.g.h")
+
+        frozen_time.tick(0.5)
+
+        await limiter.acquire("a.b.c.d")
+
+        with pytest.raises(RateLimitExceededError):
+            await limiter.acquire("a.b.c.d")
+
+        frozen_time.tick(10)
+
+        for _ in range(3):
+            await limiter.acquire("a.b.c.d")
+
+    assert 2 == limiter.rejected
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_limiter_disabled():
+    limiter = TokenBucketLimiter("client", rate=0, burst=1)
+
+    for _ in range(10):
+        await limiter.acquire("a.b.c.d")
+
+    assert {"rate": 0, "burst": 1, "rejected": 0, "buckets": 0} == (
+        limiter.stats()
+    )
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_limiter_max_keys():
+    limiter = TokenBucketLimiter("client", rate=1, burst=1, max_keys=2)
+
+    await limiter.acquire("a")
+    await limiter.acquire("b")
+    await limiter.acquire("c")
+
+    assert 2 == limiter.stats()["buckets"]
+
+    await limiter.acquire("a")
+
+    with pytest.raises(RateLimitExceededError):
+        await limiter.acquire("c")
+
+
+@pytest.mark.asyncio
+@freeze_time("2024-01-01 00:00:00")
+async def test_token_bucket_limiter_acquire_all():
+    client_limiter = TokenBucketLimiter("client", rate=1, burst=3)
+    video_limiter = TokenBucketLimiter("video", rate=1, burst=1)
+
+    # Capped at the burst
+    await client_limiter.acquire("a.b.c.d", 10)
+
+    await video_limiter.acquire("x1")
+
+    with pytest.raises(RateLimitExceededError) as exc_info:
+        await TokenBucketLimiter.acquire_all(
+            [
+                (client_limiter, "e.f.g.h", 2),
+                (video_limiter, "x1", 1),
+                (video_limiter, "x2", 1),
+            ]
+        )
+
+    assert "video" == exc_info.value.scope
+    assert 1 == exc_info.value.retry_after
+
+    # Nothing was taken by the rejected call
+    await TokenBucketLimiter.acquire_all(
+        [(client_limiter, "e.f.g.h", 3), (video_limiter, "x2", 1)]
+    )
+
+    assert 0 == client_limiter.rejected
+    assert 1 == video_limiter.rejected
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_limiter_acquire_all_redis():
+    fakeredis = pytest.importorskip("fakeredis")
+    cache = fakeredis.FakeAsyncRedis()
+    client_limiter = TokenBucketLimiter("client", rate=1, burst=3, cache=cache)
+    video_limiter = TokenBucketLimiter("video", rate=1, burst=1, cache=cache)
+
+    await client_limiter.acquire("a.b.c.d", 10)
+    await video_limiter.acquire("x1")
+
+    with pytest.raises(RateLimitExceededError) as exc_info:
+        await TokenBucketLimiter.acquire_all(
+            [
+                (client_limiter, "e.f.g.h", 2),
+                (video_limiter, "x2", 1),
+                (video_limiter, "x1", 1),
+            ]
+        )
+
+    assert "video" == exc_info.value.scope
+    assert 0 < exc_info.value.retry_after <= 1
+
+    await TokenBucketLimiter.acquire_all(
+        [(client_limiter, "e.f.g.h", 3), (video_limiter, "x2", 1)]
+    )
+
+    assert 0 == client_limiter.stats()["buckets"]
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_limiter_redis():
+    fakeredis = pytest.importorskip("fakeredis")
+    cache = fakeredis.FakeAsyncRedis()
+    limiters = [
+        TokenBucketLimiter("upstream", rate=1, burst=2, cache=cache)
+        for _ in range(2)
+    ]
+
+    await limiters[0].acquire("video")
+    await limiters[1].acquire("video")
+
+    with pytest.raises(RateLimitExceededError) as exc_info:
+        await limiters[0].acquire("video")
+
+    assert 0 < exc_info.value.retry_after <= 1
+    assert 0 < await cache.pttl("dm_stream_urls_rate_limit:upstream:video")
+    assert 0 == limiters[0].stats()["buckets"]
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_limiter_redis_failure():
+    cache = MagicMock()
+    cache.register_script.return_value.side_effect = (
+        exceptions.ConnectionError()
+    )
+    limiter = TokenBucketLimiter("upstream", rate=1, burst=1, cache=cache)
+
+    await limiter.acquire("video")
+
+    with pytest.raises(RateLimitExceededError):
+        await limiter.acquire("video")
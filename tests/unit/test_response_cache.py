@@ -0,0 +1,254 @@
+import json
+
+from unittest.mock import AsyncMock
+
+import pytest
+
+from freezegun import freeze_time
+from redis import exceptions
+from redis.asyncio import Redis
+
+from dm_stream_urls_server.response_cache import (
+    CachedResponse,
+    ResponseCache,
+    get_response_cache_key,
+)
+
+
+@pytest.mark.parametrize(
+    "video_formats, expected_return",
+    (
+        (
+            "format1",
+            "dailymotion_stream_urls:xVideoId:format1:a.b.c.d",
+        ),
+        (
+            "format2, format1,,format1",
+            "dailymotion_stream_urls:xVideoId:format1,format2:a.b.c.d",
+        ),
+    ),
+)
+def test_get_response_cache_key(video_formats, expected_return):
+    assert expected_return == get_response_cache_key(
+        "xVideoId", video_formats, "a.b.c.d"
+    )
+
+
+def test_get_response_cache_key_pass_through():
+    assert "dailymotion_stream_urls_body:xVideoId:format1:a.b.c.d" == (
+        get_response_cache_key("xVideoId", "format1", "a.b.c.d", True)
+    )
+
+
+@pytest.mark.asyncio
+async def test_response_cache():
+    response_cache = ResponseCache(max_size=2, ttl=10)
+
+    with freeze_time("2012-11-10T09:08:07Z") as frozen_time:
+        assert await response_cache.get("key1") is None
+
+        await response_cache.set("key1", {"test": 1})
+        await response_cache.set("key2", {"test": 2})
+
+        assert {"test": 1} == await response_cache.get("key1")
+
+        # key2 is the least recently used entry
+        await response_cache.set("key3", {"test": 3})
+
+        assert await response_cache.get("key2") is None
+        assert {"test": 3} == await response_cache.get("key3")
+
+        frozen_time.tick(11)
+
+        assert await response_cache.get("key1") is None
+
+    assert {
+        "hits": 2,
+        "stale_hits": 0,
+        "misses": 3,
+        "size": 1,
+    } == response_cache.stats()
+
+
+@pytest.mark.asyncio
+@freeze_time("2012-11-10T09:08:07Z")
+async def test_response_cache_redis():
+    redis = AsyncMock(autospec=Redis)
+    response_cache = ResponseCache(max_size=2, ttl=10, cache=redis)
+
+    await response_cache.set("key1", {"test": 1})
+
+    redis.set.assert_awaited_once_with(
+        "key1",
+        json.dumps(
+            {
+                "expires_at": 1352538497.0,
+                "stale_until": 1352538497.0,
+                "response": {"test": 1},
+            }
+        ),
+        px=10000,
+    )
+
+    redis.get.return_value = json.dumps(
+        {"expires_at": 1352538492.0, "response": {"test": 2}}
+    )
+
+    assert {"test": 2} == await response_cache.get("key2")
+
+    redis.get.return_value = json.dumps(
+        {"expires_at": 1352538480.0, "response": {"test": 3}}
+    )
+
+    assert await response_cache.get("key3") is None
+
+    redis.get.side_effect = exceptions.RedisError
+
+    assert await response_cache.get("key4") is None
+
+    assert {
+        "hits": 1,
+        "stale_hits": 0,
+        "misses": 2,
+        "size": 2,
+    } == response_cache.stats()
+
+
+@pytest.mark.asyncio
+@freeze_time("2012-11-10T09:08:07Z")
+async def test_response_cache_get_many():
+    redis = AsyncMock(autospec=Redis)
+    response_cache = ResponseCache(max_size=4, ttl=10, cache=redis)
+
+    await response_cache.set("key1", {"test": 1})
+
+    redis.mget.return_value = [
+        json.dumps({"expires_at": 1352538492.0, "response": {"test": 2}}),
+        None,
+    ]
+
+    assert [{"test": 1}, {"test": 2}, None] == await response_cache.get_many(
+        ["key1", "key2", "key3"]
+    )
+
+    redis.mget.assert_awaited_once_with(["key2", "key3"])
+    redis.get.assert_not_awaited()
+
+    redis.mget.reset_mock()
+
+    assert [{"test": 1}, {"test": 2}] == await response_cache.get_many(
+        ["key1", "key2"]
+    )
+
+    redis.mget.assert_not_awaited()
+
+    redis.mget.side_effect = exceptions.RedisError
+
+    assert [None] == await response_cache.get_many(["key4"])
+
+    assert {
+        "hits": 4,
+        "stale_hits": 0,
+        "misses": 2,
+        "size": 2,
+    } == response_cache.stats()
+
+
+@pytest.mark.asyncio
+async def test_response_cache_stale():
+    response_cache = ResponseCache(max_size=2, ttl=10, stale_ttl=20)
+
+    with freeze_time("2012-11-10T09:08:07Z") as frozen_time:
+        await response_cache.set("key1", {"test": 1})
+
+        assert CachedResponse({"test": 1}, stale=False) == (
+            await response_cache.get_entry("key1")
+        )
+
+        frozen_time.tick(15)
+
+        assert await response_cache.get("key1") is None
+        assert CachedResponse({"test": 1}, stale=True) == (
+            await response_cache.get_entry("key1")
+        )
+
+        frozen_time.tick(16)
+
+        assert await response_cache.get_entry("key1") is None
+
+    assert {
+        "hits": 1,
+        "stale_hits": 2,
+        "misses": 1,
+        "size": 0,
+    } == response_cache.stats()
+
+
+@pytest.mark.asyncio
+@freeze_time("2012-11-10T09:08:07Z")
+async def test_response_cache_redis_stale():
+    redis = AsyncMock(autospec=Redis)
+    response_cache = ResponseCache(
+        max_size=2, ttl=10, cache=redis, stale_ttl=20
+    )
+
+    await response_cache.set("key1", {"test": 1})
+
+    redis.set.assert_awaited_once_with(
+        "key1",
+        json.dumps(
+            {
+                "expires_at": 1352538497.0,
+                "stale_until": 1352538517.0,
+                "response": {"test": 1},
+            }
+        ),
+        px=30000,
+    )
+
+    redis.get.return_value = json.dumps(
+        {
+            "expires_at": 1352538480.0,
+            "stale_until": 1352538500.0,
+            "response": {"test": 2},
+        }
+    )
+
+    assert CachedResponse({"test": 2}, stale=True) == (
+        await response_cache.get_entry("key2")
+    )
+
+    redis.get.return_value = json.dumps(
+        {
+            "expires_at": 1352538470.0,
+            "stale_until": 1352538480.0,
+            "response": {"test": 3},
+        }
+    )
+
+    assert await response_cache.get_entry("key3") is None
+
+
+@pytest.mark.asyncio
+@freeze_time("2012-11-10T09:08:07Z")
+async def test_response_cache_redis_body():
+    redis = AsyncMock(autospec=Redis)
+    response_cache = ResponseCache(max_size=2, ttl=10, cache=redis)
+
+    await response_cache.set("key1", b'{"test":1}')
+
+    redis.set.assert_awaited_once_with(
+        "key1",
+        json.dumps(
+            {
+                "expires_at": 1352538497.0,
+                "stale_until": 1352538497.0,
+                "body": '{"test":1}',
+            }
+        ),
+        px=10000,
+    )
+
+    redis.get.return_value = redis.set.await_args.args[1]
+
+    assert b'{"test":1}' == await response_cache.get("key2")
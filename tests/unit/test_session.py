@@ -0,0 +1,35 @@
+from unittest.mock import MagicMock
+
+import aiohttp
+import pytest
+
+from dm_stream_urls_server.session import (
+    create_http_session,
+    warm_up_http_session,
+)
+
+
+@pytest.mark.asyncio
+async def test_create_http_session():
+    async with create_http_session() as session:
+        connector = session.connector
+
+        assert isinstance(connector, aiohttp.TCPConnector)
+        assert 100 == connector.limit
+        assert 50 == connector.limit_per_host
+        assert connector.use_dns_cache
+        assert not session.closed
+
+    assert session.closed
+
+
+@pytest.mark.asyncio
+async def test_warm_up_http_session():
+    session = MagicMock(aiohttp.ClientSession)
+    response = session.head.return_value.__aenter__.return_value
+
+    await warm_up_http_session(session, "https://a.b", 3)
+
+    assert 3 == session.head.call_count
+    session.head.assert_called_with("https://a.b")
+    assert 3 == response.read.await_count
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from dm_stream_urls_server.singleflight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_single_flight():
+    single_flight: SingleFlight[str] = SingleFlight()
+    release = asyncio.Event()
+    calls = []
+
+    async def call(result):
+        calls.append(result)
+        await release.wait()
+
+        return result
+
+    tasks = [
+        asyncio.create_task(single_flight.do(key, lambda k=key: call(k)))
+        for key in ("key1", "key1", "key2", "key1")
+    ]
+
+    await asyncio.sleep(0)
+
+    assert {"calls": 2, "collapsed": 2, "in_flight": 2} == (
+        single_flight.stats()
+    )
+
+    release.set()
+
+    assert ["key1", "key1", "key2", "key1"] == await asyncio.gather(*tasks)
+    assert ["key1", "key2"] == calls
+    assert 0 == single_flight.stats()["in_flight"]
+
+
+@pytest.mark.asyncio
+async def test_single_flight_error():
+    single_flight: SingleFlight[str] = SingleFlight()
+    release = asyncio.Event()
+
+    async def call():
+        await release.wait()
+
+        raise RuntimeError("upstream failure")
+
+    tasks = [
+        asyncio.create_task(single_flight.do("key", call)) for _ in range(3)
+    ]
+
+    await asyncio.sleep(0)
+    release.set()
+
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    assert 3 == len(results)
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert {"calls": 1, "collapsed": 2, "in_flight": 0} == (
+        single_flight.stats()
+    )
+
+
+@pytest.mark.asyncio
+async def test_single_flight_caller_cancelled():
+    single_flight: SingleFlight[str] = SingleFlight()
+    release = asyncio.Event()
+
+    async def call():
+        await release.wait()
+
+        return "result"
+
+    leader = asyncio.create_task(single_flight.do("key", call))
+    follower = asyncio.create_task(single_flight.do("key", call))
+
+    await asyncio.sleep(0)
+    leader.cancel()
+    release.set()
+
+    assert "result" == await follower
+
+    with pytest.raises(asyncio.CancelledError):
+        await leader
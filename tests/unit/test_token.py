@@ -1,55 +1,57 @@
-from unittest.mock import AsyncMock, patch
+import asyncio
 
+from unittest.mock import AsyncMock, MagicMock, call, patch
+
+import aiohttp
 import pytest
 
+from freezegun import freeze_time
 from redis.asyncio import Redis
 
+from dm_stream_urls_server.cache import (
+    AccessTokenRecord,
+    is_access_token_expired,
+    local_access_token_cache,
+)
+from dm_stream_urls_server.credentials import Credential
 from dm_stream_urls_server.token import (
+    AccessToken,
     fetch_dailymotion_api_oauth_token,
     get_dailymotion_api_access_token,
-    get_dailymotion_api_credentials,
+    read_and_keep_access_token,
     refresh_dailymotion_api_access_token,
+    refresh_dailymotion_api_access_token_periodically,
+    throttle_access_token,
 )
+from dm_stream_urls_server.token_store import MemoryTokenStore
 
+# 2012-11-10T09:08:07Z
+NOW = 1352538487
 
-def test_get_dailymotion_api_credentials():
-    assert (
-        "tests-fixtures-creds-client-id",
-        "tests-fixtures-creds-client-secret",
-    ) == get_dailymotion_api_credentials("tests/fixtures/creds.json")
+CREDENTIAL = Credential("test-client-id", "test-client-secret")
 
 
 @pytest.mark.asyncio
-@patch("aiohttp.client.ClientSession._request")
-@patch("dm_stream_urls_server.token.get_dailymotion_api_credentials")
-async def test_get_dailymotion_api_access_token(
-    get_credentials,
-    aiohttp_request,
-):
+async def test_fetch_dailymotion_api_oauth_token():
     class MockResponse:
-        def release(self):
-            ...
-
         async def json(self):
             return {
                 "this": "is",
                 "a": "test",
             }
 
-    get_credentials.return_value = ("test-client-id", "test-client-secret")
-
-    aiohttp_request.return_value = MockResponse()
+    session = MagicMock(aiohttp.ClientSession)
+    session.post.return_value.__aenter__.return_value = MockResponse()
 
-    assert await fetch_dailymotion_api_oauth_token() == {
+    assert await fetch_dailymotion_api_oauth_token(session, CREDENTIAL) == {
         "this": "is",
         "a": "test",
     }
 
-    aiohttp_request.assert_awaited_with(
-        "POST",
-        "https://partner.api.dailymotion.com/oauth/v1/token",
+    session.post.assert_called_once_with(
+        url="https://partner.api.dailymotion.com/oauth/v1/token",
         data={
-            "scope": "upload_videos read_videos edit_videos delete_videos",
+            "scope": "read_video_streams",
             "grant_type": "client_credentials",
             "client_id": "test-client-id",
             "client_secret": "test-client-secret",
@@ -57,46 +59,178 @@ async def test_get_dailymotion_api_access_token(
         headers={
             "Content-Type": "application/x-www-form-urlencoded",
         },
-        timeout=2,
+        raise_for_status=True,
+        timeout=aiohttp.ClientTimeout(total=2),
     )
 
 
 @pytest.mark.asyncio
+@patch("dm_stream_urls_server.token.credential_pool")
 @patch("dm_stream_urls_server.token.refresh_dailymotion_api_access_token")
-@patch("dm_stream_urls_server.token.read_access_token")
+@patch("dm_stream_urls_server.token.read_and_keep_access_token")
 @pytest.mark.parametrize(
     "redis, cached_access_token, expected_return",
     (
         (
             AsyncMock(autospec=Redis),
             ("cached-access-token",),
-            "cached-access-token",
+            AccessToken("cached-access-token"),
         ),
         (
             AsyncMock(autospec=Redis),
             (None, "new-access-token"),
-            "new-access-token",
+            AccessToken("new-access-token"),
+        ),
+        (
+            AsyncMock(autospec=Redis),
+            (None, None),
+            None,
         ),
     ),
 )
 async def test_get_dailymotion_api_access_token(
     m_read_access_token,
     m_refresh_dailymotion_api_access_token,
+    m_credential_pool,
     redis,
     cached_access_token,
     expected_return,
 ):
     m_read_access_token.side_effect = cached_access_token
+    m_credential_pool.select.return_value = CREDENTIAL
+    local_access_token_cache.clear()
 
-    assert expected_return == await get_dailymotion_api_access_token(redis)
+    session = MagicMock(aiohttp.ClientSession)
+
+    assert expected_return == await get_dailymotion_api_access_token(
+        redis, session
+    )
 
     if len(cached_access_token) > 1:
-        m_refresh_dailymotion_api_access_token.assert_awaited()
+        m_refresh_dailymotion_api_access_token.assert_awaited_once_with(
+            redis, session, CREDENTIAL
+        )
     else:
         m_refresh_dailymotion_api_access_token.assert_not_awaited()
 
 
 @pytest.mark.asyncio
+@patch("dm_stream_urls_server.token.read_and_keep_access_token")
+async def test_get_dailymotion_api_access_token_from_local_cache(
+    m_read_and_keep_access_token,
+):
+    local_access_token_cache.set("local-access-token", 60)
+
+    try:
+        assert AccessToken(
+            "local-access-token"
+        ) == await get_dailymotion_api_access_token(
+            AsyncMock(autospec=Redis), MagicMock(aiohttp.ClientSession)
+        )
+    finally:
+        local_access_token_cache.clear()
+
+    m_read_and_keep_access_token.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.token.credential_pool")
+@patch("dm_stream_urls_server.token.read_and_keep_access_token")
+async def test_get_dailymotion_api_access_token_per_key(
+    m_read_and_keep_access_token,
+    m_credential_pool,
+):
+    m_credential_pool.select.side_effect = (
+        CREDENTIAL._replace(name="key-1"),
+        CREDENTIAL._replace(name="key-2"),
+    )
+    local_access_token_cache.set("key-1-access-token", 60, "key-1")
+
+    try:
+        assert AccessToken(
+            "key-1-access-token", "key-1"
+        ) == await get_dailymotion_api_access_token(
+            AsyncMock(autospec=Redis), MagicMock(aiohttp.ClientSession)
+        )
+
+        m_read_and_keep_access_token.return_value = "key-2-access-token"
+
+        assert AccessToken(
+            "key-2-access-token", "key-2"
+        ) == await get_dailymotion_api_access_token(
+            AsyncMock(autospec=Redis), MagicMock(aiohttp.ClientSession)
+        )
+    finally:
+        local_access_token_cache.clear()
+
+    m_read_and_keep_access_token.assert_awaited_once()
+    assert "key-2" == m_read_and_keep_access_token.await_args.args[1]
+
+
+@pytest.mark.parametrize(
+    "retry_after, expected_cooldown",
+    (
+        (None, None),
+        ("30", 30),
+        ("Wed, 21 Oct 2015 07:28:00 GMT", None),
+    ),
+)
+@patch("dm_stream_urls_server.token.credential_pool")
+def test_throttle_access_token(
+    m_credential_pool,
+    retry_after,
+    expected_cooldown,
+):
+    throttle_access_token("key-1", retry_after)
+
+    m_credential_pool.throttle.assert_called_once_with(
+        "key-1", expected_cooldown
+    )
+
+
+@pytest.mark.asyncio
+@freeze_time("2012-11-10T09:08:07Z")
+@patch("dm_stream_urls_server.token.read_access_token_record")
+@pytest.mark.parametrize(
+    "record, expected_local_access_token",
+    (
+        (
+            AccessTokenRecord("cached-access-token", NOW - 30, NOW + 60, NOW),
+            "cached-access-token",
+        ),
+        (
+            AccessTokenRecord("cached-access-token", NOW - 30, NOW, NOW + 10),
+            None,
+        ),
+        (
+            None,
+            None,
+        ),
+    ),
+)
+async def test_read_and_keep_access_token(
+    m_read_access_token_record,
+    record,
+    expected_local_access_token,
+):
+    m_read_access_token_record.return_value = record
+    local_access_token_cache.clear()
+
+    try:
+        assert (record and record.access_token) == (
+            await read_and_keep_access_token(AsyncMock(autospec=Redis))
+        )
+        assert expected_local_access_token == local_access_token_cache.get()
+
+        if expected_local_access_token:
+            assert 30 == local_access_token_cache.age()
+    finally:
+        local_access_token_cache.clear()
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.token.release_refresh_lease")
+@patch("dm_stream_urls_server.token.acquire_refresh_lease")
 @patch("dm_stream_urls_server.token.store_access_token")
 @patch("dm_stream_urls_server.token.fetch_dailymotion_api_oauth_token")
 @patch("dm_stream_urls_server.token.is_access_token_expired")
@@ -117,25 +251,269 @@ async def test_refresh_dailymotion_api_access_token(
     m_is_access_token_expired,
     m_fetch_dailymotion_api_oauth_token,
     m_store_access_token,
+    m_acquire_refresh_lease,
+    m_release_refresh_lease,
     is_access_token_expired,
     fetched_access_token,
 ):
     redis = AsyncMock(Redis)
+    session = MagicMock(aiohttp.ClientSession)
 
     m_is_access_token_expired.return_value = is_access_token_expired
     m_fetch_dailymotion_api_oauth_token.return_value = fetched_access_token
+    m_acquire_refresh_lease.return_value = True
 
-    await refresh_dailymotion_api_access_token(redis)
+    await refresh_dailymotion_api_access_token(redis, session, CREDENTIAL)
 
     if is_access_token_expired:
-        m_fetch_dailymotion_api_oauth_token.assert_awaited()
+        m_fetch_dailymotion_api_oauth_token.assert_awaited_once_with(
+            session, CREDENTIAL
+        )
     else:
         m_fetch_dailymotion_api_oauth_token.assert_not_awaited()
 
     if fetched_access_token:
+        lease_owner = m_acquire_refresh_lease.await_args.args[1]
+
         m_store_access_token.assert_awaited_once_with(
             cache=redis,
             **fetched_access_token,
+            lease_owner=lease_owner,
+            key_name=None,
+        )
+        m_release_refresh_lease.assert_awaited_once_with(
+            redis, lease_owner, None
         )
     else:
         m_store_access_token.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.token.release_refresh_lease")
+@patch("dm_stream_urls_server.token.acquire_refresh_lease")
+@patch("dm_stream_urls_server.token.store_access_token")
+@patch("dm_stream_urls_server.token.fetch_dailymotion_api_oauth_token")
+@patch("dm_stream_urls_server.token.is_access_token_expired")
+async def test_refresh_dailymotion_api_access_token_lease_failed_open(
+    m_is_access_token_expired,
+    m_fetch_dailymotion_api_oauth_token,
+    m_store_access_token,
+    m_acquire_refresh_lease,
+    m_release_refresh_lease,
+):
+    redis = AsyncMock(Redis)
+    session = MagicMock(aiohttp.ClientSession)
+
+    m_is_access_token_expired.return_value = True
+    m_fetch_dailymotion_api_oauth_token.return_value = {
+        "access_token": "fetched-access-token",
+        "expires_in": 100,
+    }
+    m_acquire_refresh_lease.return_value = None
+
+    await refresh_dailymotion_api_access_token(redis, session, CREDENTIAL)
+
+    m_store_access_token.assert_awaited_once_with(
+        cache=redis,
+        access_token="fetched-access-token",
+        expires_in=100,
+        lease_owner=None,
+        key_name=None,
+    )
+    m_release_refresh_lease.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.token.ACCESS_TOKEN_REFRESH_POLL_INTERVAL", 0)
+@patch("dm_stream_urls_server.token.is_refresh_lease_held")
+@patch("dm_stream_urls_server.token.acquire_refresh_lease")
+@patch("dm_stream_urls_server.token.fetch_dailymotion_api_oauth_token")
+@patch("dm_stream_urls_server.token.is_access_token_expired")
+async def test_refresh_dailymotion_api_access_token_leased_elsewhere(
+    m_is_access_token_expired,
+    m_fetch_dailymotion_api_oauth_token,
+    m_acquire_refresh_lease,
+    m_is_refresh_lease_held,
+):
+    redis = AsyncMock(Redis)
+    session = MagicMock(aiohttp.ClientSession)
+
+    # Expired, then refreshed by the lease holder on the second poll
+    m_is_access_token_expired.side_effect = (True, True, False)
+    m_acquire_refresh_lease.return_value = False
+    m_is_refresh_lease_held.return_value = True
+
+    await refresh_dailymotion_api_access_token(redis, session, CREDENTIAL)
+
+    m_fetch_dailymotion_api_oauth_token.assert_not_awaited()
+    assert 3 == m_is_access_token_expired.await_count
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.token.ACCESS_TOKEN_REFRESH_POLL_INTERVAL", 0)
+@patch("dm_stream_urls_server.token.fetch_dailymotion_api_oauth_token")
+async def test_refresh_dailymotion_api_access_token_lease_released(
+    m_fetch_dailymotion_api_oauth_token,
+):
+    token_store = MemoryTokenStore()
+    session = MagicMock(aiohttp.ClientSession)
+
+    # The lease holder fails and releases the lease without a new token
+    await token_store.acquire_lease("other-owner", 10)
+
+    refresh = asyncio.create_task(
+        refresh_dailymotion_api_access_token(token_store, session, CREDENTIAL)
+    )
+    await asyncio.sleep(0.01)
+    await token_store.release_lease("other-owner")
+
+    await asyncio.wait_for(refresh, timeout=1)
+
+    m_fetch_dailymotion_api_oauth_token.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.token.ACCESS_TOKEN_REFRESH_POLL_INTERVAL", 0)
+@patch("dm_stream_urls_server.token.fetch_dailymotion_api_oauth_token")
+async def test_refresh_dailymotion_api_access_token_race(
+    m_fetch_dailymotion_api_oauth_token,
+):
+    token_store = MemoryTokenStore()
+    session = MagicMock(aiohttp.ClientSession)
+
+    async def fetch_dailymotion_api_oauth_token(*_):
+        await asyncio.sleep(0.01)
+
+        return {"access_token": "fetched-access-token", "expires_in": 100}
+
+    m_fetch_dailymotion_api_oauth_token.side_effect = (
+        fetch_dailymotion_api_oauth_token
+    )
+
+    # The second refresher waits for the lease holder
+    await asyncio.gather(
+        refresh_dailymotion_api_access_token(token_store, session, CREDENTIAL),
+        refresh_dailymotion_api_access_token(token_store, session, CREDENTIAL),
+    )
+
+    m_fetch_dailymotion_api_oauth_token.assert_awaited_once()
+
+    # A late refresher found the token expired before it was stored, then
+    # takes the lease once released
+    with patch(
+        "dm_stream_urls_server.token.is_access_token_expired",
+        side_effect=(True, await is_access_token_expired(token_store)),
+    ):
+        await refresh_dailymotion_api_access_token(
+            token_store, session, CREDENTIAL
+        )
+
+    m_fetch_dailymotion_api_oauth_token.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.token.credential_pool")
+@patch("dm_stream_urls_server.token.release_refresh_lease")
+@patch("dm_stream_urls_server.token.acquire_refresh_lease")
+@patch("dm_stream_urls_server.token.fetch_dailymotion_api_oauth_token")
+@patch("dm_stream_urls_server.token.is_access_token_expired")
+async def test_refresh_dailymotion_api_access_token_throttled(
+    m_is_access_token_expired,
+    m_fetch_dailymotion_api_oauth_token,
+    m_acquire_refresh_lease,
+    m_release_refresh_lease,
+    m_credential_pool,
+):
+    m_is_access_token_expired.return_value = True
+    m_acquire_refresh_lease.return_value = True
+    m_fetch_dailymotion_api_oauth_token.side_effect = (
+        aiohttp.ClientResponseError(MagicMock(), (), status=429)
+    )
+
+    await refresh_dailymotion_api_access_token(
+        AsyncMock(Redis),
+        MagicMock(aiohttp.ClientSession),
+        CREDENTIAL._replace(name="key-1"),
+    )
+
+    m_credential_pool.throttle.assert_called_once_with("key-1")
+    m_release_refresh_lease.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.token.credential_pool")
+@patch("dm_stream_urls_server.token.random.random")
+@patch("dm_stream_urls_server.token.asyncio.sleep")
+@patch("dm_stream_urls_server.token.read_access_token_with_ttl")
+@patch("dm_stream_urls_server.token.refresh_dailymotion_api_access_token")
+async def test_refresh_dailymotion_api_access_token_periodically(
+    m_refresh_dailymotion_api_access_token,
+    m_read_access_token_with_ttl,
+    m_sleep,
+    m_random,
+    m_credential_pool,
+):
+    redis = AsyncMock(Redis)
+    session = MagicMock(aiohttp.ClientSession)
+
+    m_credential_pool.credentials = [CREDENTIAL]
+    m_random.return_value = 0.5
+    m_read_access_token_with_ttl.side_effect = (
+        ("cached-access-token", 3000),
+        ("cached-access-token", 30),
+        (None, 0),
+    )
+    m_sleep.side_effect = (None, None, asyncio.CancelledError)
+
+    with pytest.raises(asyncio.CancelledError):
+        await refresh_dailymotion_api_access_token_periodically(
+            redis, session, interval=60, jitter=0.1
+        )
+
+    assert 3 == m_refresh_dailymotion_api_access_token.await_count
+    m_refresh_dailymotion_api_access_token.assert_awaited_with(
+        redis, session, CREDENTIAL
+    )
+    m_sleep.assert_has_awaits([call(57), call(28.5), call(57)])
+
+
+@pytest.mark.asyncio
+@patch("dm_stream_urls_server.token.credential_pool")
+@patch("dm_stream_urls_server.token.random.random")
+@patch("dm_stream_urls_server.token.asyncio.sleep")
+@patch("dm_stream_urls_server.token.read_access_token_with_ttl")
+@patch("dm_stream_urls_server.token.refresh_dailymotion_api_access_token")
+async def test_refresh_dailymotion_api_access_token_periodically_per_key(
+    m_refresh_dailymotion_api_access_token,
+    m_read_access_token_with_ttl,
+    m_sleep,
+    m_random,
+    m_credential_pool,
+):
+    redis = AsyncMock(Redis)
+    session = MagicMock(aiohttp.ClientSession)
+    credentials = [
+        CREDENTIAL._replace(name="key-1"),
+        CREDENTIAL._replace(name="key-2"),
+    ]
+
+    m_credential_pool.credentials = credentials
+    m_random.return_value = 0
+    m_read_access_token_with_ttl.side_effect = (
+        ("key-1-access-token", 40),
+        ("key-2-access-token", 20),
+    )
+    m_sleep.side_effect = asyncio.CancelledError
+
+    with pytest.raises(asyncio.CancelledError):
+        await refresh_dailymotion_api_access_token_periodically(
+            redis, session, interval=60, jitter=0.1
+        )
+
+    m_refresh_dailymotion_api_access_token.assert_has_awaits(
+        [call(redis, session, credential) for credential in credentials]
+    )
+    m_read_access_token_with_ttl.assert_has_awaits(
+        [call(redis, "key-1"), call(redis, "key-2")]
+    )
+    m_sleep.assert_awaited_once_with(20)
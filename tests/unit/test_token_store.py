@@ -0,0 +1,208 @@
+import asyncio
+
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from freezegun import freeze_time
+from redis.asyncio import Redis
+
+from dm_stream_urls_server.cache import AccessTokenRecord, TokenStore
+from dm_stream_urls_server.token_store import (
+    MMAP_HEADER,
+    MemoryTokenStore,
+    MmapTokenStore,
+    RedisTokenStore,
+    create_token_store,
+)
+
+# 2012-11-10T09:08:07Z
+NOW = 1352538487
+
+RECORD = AccessTokenRecord("test-access-token", NOW, NOW + 90, NOW + 100)
+
+
+def open_token_store(backend, tmp_path, watch_interval=0.01):
+    if backend == "mmap":
+        return MmapTokenStore(str(tmp_path / "tokens"), 4096, watch_interval)
+
+    return MemoryTokenStore()
+
+
+def test_token_store_abstract():
+    with pytest.raises(TypeError):
+        TokenStore()
+
+
+@pytest.mark.asyncio
+@freeze_time("2012-11-10T09:08:07Z")
+@pytest.mark.parametrize("backend", ("memory", "mmap"))
+async def test_token_store_record(backend, tmp_path):
+    token_store = open_token_store(backend, tmp_path)
+
+    assert await token_store.get_record() is None
+    assert await token_store.set_record(RECORD)
+    assert RECORD == await token_store.get_record()
+    assert await token_store.get_record("test-key") is None
+
+    assert await token_store.set_record(
+        RECORD._replace(access_token="test:key:access:token"),
+        key_name="test-key",
+    )
+    assert (
+        "test:key:access:token"
+        == (await token_store.get_record("test-key")).access_token
+    )
+    assert RECORD == await token_store.get_record()
+
+    assert await token_store.set_record(RECORD._replace(expires_at=NOW))
+    assert await token_store.get_record() is None
+
+    await token_store.close()
+
+
+@pytest.mark.asyncio
+@freeze_time("2012-11-10T09:08:07Z")
+@pytest.mark.parametrize("backend", ("memory", "mmap"))
+async def test_token_store_lease(backend, tmp_path):
+    token_store = open_token_store(backend, tmp_path)
+
+    assert not await token_store.is_leased()
+    assert await token_store.acquire_lease("owner", 10)
+    assert await token_store.is_leased()
+    assert not await token_store.acquire_lease("other-owner", 10)
+    assert not await token_store.is_leased("test-key")
+    assert await token_store.acquire_lease("other-owner", 10, "test-key")
+
+    assert not await token_store.set_record(RECORD, "other-owner")
+    assert await token_store.get_record() is None
+    assert await token_store.set_record(RECORD, "owner")
+    assert RECORD == await token_store.get_record()
+
+    await token_store.release_lease("other-owner")
+
+    assert not await token_store.acquire_lease("other-owner", 10)
+
+    await token_store.release_lease("owner")
+
+    assert not await token_store.is_leased()
+    assert await token_store.acquire_lease("other-owner", 10)
+
+    await token_store.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ("memory", "mmap"))
+async def test_token_store_lease_expiry(backend, tmp_path):
+    token_store = open_token_store(backend, tmp_path)
+
+    with freeze_time("2012-11-10T09:08:07Z") as frozen_time:
+        assert await token_store.acquire_lease("owner", 10)
+
+        frozen_time.tick(10)
+
+        assert not await token_store.set_record(RECORD, "owner")
+        assert await token_store.acquire_lease("other-owner", 10)
+
+    await token_store.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ("memory", "mmap"))
+async def test_token_store_watch(backend, tmp_path):
+    token_store = open_token_store(backend, tmp_path)
+    calls = asyncio.Queue()
+
+    task = asyncio.create_task(token_store.watch(lambda: calls.put_nowait(1)))
+
+    await asyncio.wait_for(calls.get(), timeout=1)
+
+    # Leases are not notified
+    await token_store.acquire_lease("owner", 10)
+    await token_store.set_record(RECORD._replace(expires_at=2e9))
+    await asyncio.wait_for(calls.get(), timeout=1)
+    await asyncio.sleep(0.05)
+
+    assert calls.empty()
+
+    task.cancel()
+
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    await token_store.close()
+
+
+@pytest.mark.asyncio
+@freeze_time("2012-11-10T09:08:07Z")
+async def test_mmap_token_store_shared(tmp_path):
+    token_store = open_token_store("mmap", tmp_path)
+    other_token_store = open_token_store("mmap", tmp_path)
+
+    assert await token_store.acquire_lease("owner", 10)
+    assert not await other_token_store.acquire_lease("other-owner", 10)
+    assert await token_store.set_record(RECORD, "owner")
+    assert RECORD == await other_token_store.get_record()
+
+    await token_store.close()
+
+    assert RECORD == await open_token_store("mmap", tmp_path).get_record()
+
+    await other_token_store.close()
+
+
+@pytest.mark.asyncio
+@freeze_time("2012-11-10T09:08:07Z")
+async def test_mmap_token_store_full(tmp_path):
+    token_store = MmapTokenStore(
+        str(tmp_path / "tokens"), MMAP_HEADER.size + 200, 1
+    )
+
+    assert await token_store.set_record(RECORD)
+
+    with pytest.raises(ValueError):
+        await token_store.set_record(RECORD, key_name="test-key")
+
+    assert await token_store.get_record("test-key") is None
+    assert RECORD == await token_store.get_record()
+
+    await token_store.close()
+
+
+@pytest.mark.parametrize(
+    "backend, cache, expected_type",
+    (
+        ("redis", MagicMock(Redis), RedisTokenStore),
+        ("redis", None, type(None)),
+        ("memory", None, MemoryTokenStore),
+        ("mmap", None, MmapTokenStore),
+    ),
+)
+def test_create_token_store(backend, cache, expected_type, tmp_path):
+    with (
+        patch(
+            "dm_stream_urls_server.token_store.TOKEN_STORE_BACKEND", backend
+        ),
+        patch(
+            "dm_stream_urls_server.token_store.TOKEN_STORE_MMAP_PATH",
+            str(tmp_path / "tokens"),
+        ),
+    ):
+        token_store = create_token_store(cache)
+
+    assert isinstance(token_store, expected_type)
+
+
+@patch("dm_stream_urls_server.token_store.TOKEN_STORE_BACKEND", "mmap")
+@patch(
+    "dm_stream_urls_server.token_store.TOKEN_STORE_MMAP_PATH",
+    "/nonexistent/tokens",
+)
+def test_create_token_store_failure():
+    assert create_token_store(None) is None
+
+
+@patch("dm_stream_urls_server.token_store.TOKEN_STORE_BACKEND", "unknown")
+def test_create_token_store_unknown():
+    with pytest.raises(ValueError):
+        create_token_store(None)
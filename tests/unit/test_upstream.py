@@ -0,0 +1,309 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from freezegun import freeze_time
+
+from dm_stream_urls_server.upstream import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    HedgeBudget,
+    LatencyTracker,
+    UpstreamEndpoint,
+    get_retry_after,
+    hedge,
+    is_upstream_failure,
+)
+
+
+def create_endpoint():
+    return UpstreamEndpoint(
+        "video",
+        breaker=CircuitBreaker("video", failure_threshold=2, reset_timeout=10),
+        latency=LatencyTracker(
+            window=10,
+            percentile=90,
+            multiplier=2,
+            min_timeout=0.1,
+            max_timeout=2,
+        ),
+    )
+
+
+def client_response_error(status):
+    return aiohttp.ClientResponseError(
+        request_info=None, history=(), status=status
+    )
+
+
+@pytest.mark.parametrize(
+    "exception, expected_return",
+    (
+        (client_response_error(500), True),
+        (client_response_error(503), True),
+        (client_response_error(429), False),
+        (client_response_error(404), False),
+        (client_response_error(403), False),
+        (asyncio.TimeoutError(), True),
+        (aiohttp.ClientConnectionError(), True),
+        (ValueError(), False),
+    ),
+)
+def test_is_upstream_failure(exception, expected_return):
+    assert is_upstream_failure(exception) is expected_return
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker("video", failure_threshold=2, reset_timeout=10)
+
+    with freeze_time("2023-01-01 00:00:00") as frozen_time:
+        breaker.before_call()
+        breaker.record_failure()
+        breaker.before_call()
+        breaker.record_success()
+        breaker.before_call()
+        breaker.record_failure()
+
+        assert breaker.state == CLOSED
+
+        breaker.before_call()
+        breaker.record_failure()
+
+        assert breaker.state == OPEN
+
+        frozen_time.tick(4)
+
+        with pytest.raises(CircuitOpenError) as exc_info:
+            breaker.before_call()
+
+        assert exc_info.value.retry_after == 6
+        assert breaker.rejected == 1
+
+        frozen_time.tick(6)
+
+        # A single probe goes through once the reset timeout has elapsed
+        breaker.before_call()
+
+        assert breaker.state == HALF_OPEN
+
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+
+        breaker.record_failure()
+
+        assert breaker.state == OPEN
+
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+
+        frozen_time.tick(10)
+
+        breaker.before_call()
+        breaker.record_cancellation()
+        breaker.before_call()
+        breaker.record_success()
+
+        assert breaker.state == CLOSED
+        assert breaker.failures == 0
+
+
+def test_latency_tracker():
+    tracker = LatencyTracker(
+        window=10,
+        percentile=90,
+        multiplier=2,
+        min_timeout=0.1,
+        max_timeout=2,
+    )
+
+    for _ in range(9):
+        tracker.observe(0.2)
+
+    assert tracker.timeout == 2
+    assert tracker.get_percentile(50) is None
+
+    tracker.observe(0.3)
+
+    assert tracker.timeout == pytest.approx(0.42)
+    assert tracker.get_percentile(50) == pytest.approx(0.2)
+
+    for _ in range(10):
+        tracker.observe(0.01)
+
+    assert tracker.timeout == 0.1
+
+    for _ in range(10):
+        tracker.observe(5)
+
+    assert tracker.timeout == 2
+
+
+@pytest.mark.asyncio
+async def test_upstream_endpoint_guard():
+    endpoint = create_endpoint()
+
+    with endpoint.guard() as timeout:
+        assert timeout == aiohttp.ClientTimeout(total=2)
+
+    for status in (404, 429, 429):
+        with pytest.raises(aiohttp.ClientResponseError):
+            with endpoint.guard():
+                raise client_response_error(status)
+
+    assert endpoint.breaker.failures == 0
+
+    for _ in range(2):
+        with pytest.raises(aiohttp.ClientResponseError):
+            with endpoint.guard():
+                raise client_response_error(502)
+
+    assert endpoint.stats() == {
+        "state": OPEN,
+        "consecutive_failures": 2,
+        "rejected_calls": 0,
+        "timeout": 2,
+    }
+
+    with pytest.raises(CircuitOpenError):
+        with endpoint.guard():
+            pytest.fail("The endpoint must not be called")
+
+
+@pytest.mark.parametrize(
+    "retry_after, expected_return",
+    (
+        (0, "1"),
+        (0.2, "1"),
+        (4.2, "5"),
+        (10, "10"),
+    ),
+)
+def test_get_retry_after(retry_after, expected_return):
+    assert get_retry_after(CircuitOpenError("video", retry_after)) == (
+        expected_return
+    )
+
+
+def test_hedge_budget():
+    budget = HedgeBudget(ratio=0.5, max_tokens=2)
+
+    assert not budget.withdraw()
+
+    for _ in range(10):
+        budget.deposit()
+
+    assert budget.withdraw()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    assert {"hedged": 2, "won": 0, "denied": 2} == budget.stats()
+
+
+def create_call(*latencies_and_results):
+    calls = iter(latencies_and_results)
+
+    async def call():
+        latency, result = next(calls)
+        await asyncio.sleep(latency)
+
+        if isinstance(result, Exception):
+            raise result
+
+        return result
+
+    return call
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "calls, delay, tokens, expected_result, expected_stats",
+    (
+        # Answered before the hedge delay
+        (
+            ((0, "first"),),
+            0.01,
+            1,
+            "first",
+            {"hedged": 0, "won": 0, "denied": 0},
+        ),
+        # No hedge delay known yet
+        (
+            ((0.02, "first"),),
+            None,
+            1,
+            "first",
+            {"hedged": 0, "won": 0, "denied": 0},
+        ),
+        # Budget exhausted
+        (
+            ((0.02, "first"),),
+            0.01,
+            0,
+            "first",
+            {"hedged": 0, "won": 0, "denied": 1},
+        ),
+        # The hedge returns first
+        (
+            ((1, "first"), (0, "second")),
+            0.01,
+            1,
+            "second",
+            {"hedged": 1, "won": 1, "denied": 0},
+        ),
+        # The first call returns first
+        (
+            ((0.02, "first"), (1, "second")),
+            0.01,
+            1,
+            "first",
+            {"hedged": 1, "won": 0, "denied": 0},
+        ),
+        # The first call fails
+        (
+            ((0.02, ValueError()), (0.03, "second")),
+            0.01,
+            1,
+            "second",
+            {"hedged": 1, "won": 1, "denied": 0},
+        ),
+    ),
+)
+async def test_hedge(calls, delay, tokens, expected_result, expected_stats):
+    budget = HedgeBudget(ratio=0)
+    budget.tokens = tokens
+
+    assert expected_result == await hedge(create_call(*calls), delay, budget)
+    assert expected_stats == budget.stats()
+
+
+@pytest.mark.asyncio
+async def test_hedge_failure():
+    budget = HedgeBudget(ratio=1)
+    call = create_call((0.02, ValueError("first")), (0, ValueError("second")))
+
+    with pytest.raises(ValueError, match="first"):
+        await hedge(call, 0.01, budget)
+
+
+@pytest.mark.asyncio
+async def test_hedge_cancels_loser():
+    cancelled = asyncio.Event()
+
+    async def slow_call():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.set()
+
+            raise
+
+    calls = iter((slow_call, create_call((0, "second"))))
+
+    assert "second" == await hedge(
+        lambda: next(calls)(), 0.01, HedgeBudget(ratio=1)
+    )
+
+    await asyncio.wait_for(cancelled.wait(), 1)